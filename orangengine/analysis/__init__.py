@@ -0,0 +1,16 @@
+# -*- coding: utf-8 -*-
+from orangengine.analysis.flowlogs import FlowLogClassifier
+from orangengine.analysis.flowlogs import FlowHits
+from orangengine.analysis.flowlogs import pan_traffic_flow
+from orangengine.analysis.flowlogs import srx_rt_flow
+from orangengine.analysis.flowlogs import iter_flows
+from orangengine.analysis.flowlogs import iter_log_lines
+from orangengine.analysis.shadow import ShadowAnalyzer
+from orangengine.analysis.shadow import ShadowedPolicy
+from orangengine.analysis.diff import Snapshot
+from orangengine.analysis.diff import ChangeSet
+from orangengine.analysis.diff import Change
+
+
+__all__ = ['FlowLogClassifier', 'FlowHits', 'pan_traffic_flow', 'srx_rt_flow', 'iter_flows', 'iter_log_lines',
+           'ShadowAnalyzer', 'ShadowedPolicy', 'Snapshot', 'ChangeSet', 'Change', ]
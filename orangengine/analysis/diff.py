@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+"""
+semantic diff of two parsed models
+
+A Snapshot keeps a digest of every object value and, per rulebase, the name,
+fingerprint and attribute digest of every policy in rule order. Snapshots are
+cheap to keep around between refreshes, and comparing two of them is a few
+dict lookups per object and policy instead of a diff of serialized models.
+"""
+from bisect import bisect_left
+from collections import OrderedDict
+
+from orangengine.utils import enum, value_digest, canonical_text
+
+from terminaltables import AsciiTable
+
+
+class Change(object):
+    """
+    a single difference between two snapshots
+    """
+
+    Kind = enum('ADDED', 'REMOVED', 'MODIFIED', 'MOVED')
+    Subject = enum('OBJECT', 'POLICY')
+
+    KindNames = {
+        Kind.ADDED: 'added',
+        Kind.REMOVED: 'removed',
+        Kind.MODIFIED: 'modified',
+        Kind.MOVED: 'moved',
+    }
+
+    def __init__(self, kind, subject, scope, name, object_type=None, fields=None, old_position=None,
+                 new_position=None):
+
+        self.kind = kind
+        self.subject = subject
+        # the rulebase (or object namespace) the change happened in, None for a flat model
+        self.scope = scope
+        self.name = name
+        # the kind of object, e.g. 'address' or 'service_group'
+        self.object_type = object_type
+        # what changed about a modified object or policy: 'value', 'match' and/or 'attributes'
+        self.fields = fields or []
+        # rule positions of policies, within their rulebase
+        self.old_position = old_position
+        self.new_position = new_position
+
+    def serialize(self):
+        """Searialize self to a json acceptable data structure
+        """
+
+        return {
+            'kind': self.KindNames[self.kind],
+            'subject': 'policy' if self.subject == self.Subject.POLICY else 'object',
+            'scope': list(self.scope) if isinstance(self.scope, tuple) else self.scope,
+            'name': self.name,
+            'object_type': self.object_type,
+            'fields': self.fields,
+            'old_position': self.old_position,
+            'new_position': self.new_position,
+        }
+
+
+class ChangeSet(object):
+    """
+    the changes between two snapshots, objects first then policies in rulebase order
+    """
+
+    def __init__(self, changes=None):
+        self.changes = changes or []
+
+    def __len__(self):
+        return len(self.changes)
+
+    def __iter__(self):
+        return iter(self.changes)
+
+    def filter(self, kind=None, subject=None):
+        """return the changes of the given kind and/or subject"""
+        return [c for c in self.changes if (kind is None or c.kind == kind) and
+                (subject is None or c.subject == subject)]
+
+    @property
+    def added_policies(self):
+        return self.filter(Change.Kind.ADDED, Change.Subject.POLICY)
+
+    @property
+    def removed_policies(self):
+        return self.filter(Change.Kind.REMOVED, Change.Subject.POLICY)
+
+    @property
+    def modified_policies(self):
+        return self.filter(Change.Kind.MODIFIED, Change.Subject.POLICY)
+
+    @property
+    def moved_policies(self):
+        return self.filter(Change.Kind.MOVED, Change.Subject.POLICY)
+
+    @property
+    def object_changes(self):
+        return self.filter(subject=Change.Subject.OBJECT)
+
+    def serialize(self):
+        return [c.serialize() for c in self.changes]
+
+    def table(self):
+
+        table_data = [["Change", "Scope", "Type", "Name", "Details"]]
+        for c in self.changes:
+            if c.subject == Change.Subject.POLICY:
+                object_type = 'policy'
+            else:
+                object_type = c.object_type
+            if c.kind == Change.Kind.MOVED:
+                details = "{0} -> {1}".format(c.old_position, c.new_position)
+            else:
+                details = ", ".join(c.fields)
+            scope = "/".join(c.scope) if isinstance(c.scope, tuple) else c.scope or ''
+            table_data.append([Change.KindNames[c.kind], scope, object_type, c.name, details])
+        table = AsciiTable(table_data)
+        table.title = "Changes"
+
+        return table.table
+
+
+def _stable_positions(sequence):
+    """return the set of indexes of a longest increasing subsequence of sequence
+
+    These are the policies that kept their relative order, every other common policy moved.
+    """
+
+    # tails[k] is the index of the smallest tail of an increasing subsequence of length k + 1
+    tails = []
+    tail_values = []
+    previous = [None] * len(sequence)
+    for i, value in enumerate(sequence):
+        k = bisect_left(tail_values, value)
+        previous[i] = tails[k - 1] if k else None
+        if k == len(tails):
+            tails.append(i)
+            tail_values.append(value)
+        else:
+            tails[k] = i
+            tail_values[k] = value
+
+    stable = set()
+    i = tails[-1] if tails else None
+    while i is not None:
+        stable.add(i)
+        i = previous[i]
+    return stable
+
+
+class Snapshot(object):
+    """
+    digests of the objects and policies of a parsed model, see BaseDriver.snapshot
+    """
+
+    def __init__(self):
+
+        # (scope, object type, name) -> value digest
+        self.objects = OrderedDict()
+        # scope -> [(name, fingerprint, attributes digest)] in rule order
+        self.rulebases = OrderedDict()
+
+    def add_object(self, scope, object_type, obj):
+        self.objects[(scope, object_type, obj.name)] = value_digest(obj.value)
+
+    def add_policy(self, scope, policy):
+        self.rulebases.setdefault(scope, []).append((policy.name, policy.fingerprint,
+                                                     self.attributes_digest(policy)))
+
+    @staticmethod
+    def attributes_digest(policy):
+        """return the digest of the policy attributes that do not change what it matches"""
+        logging = policy.logging if isinstance(policy.logging, list) else [policy.logging]
+        values = [u'description:' + canonical_text(policy.description or u'')]
+        values.extend(u'logging:' + canonical_text(l) for l in logging if l is not None)
+        return value_digest(values)
+
+    def diff(self, other):
+        """Return the ChangeSet from self (the older snapshot) to other
+        """
+
+        changes = []
+
+        for key, digest in self.objects.iteritems():
+            new_digest = other.objects.get(key)
+            if new_digest is None:
+                changes.append(Change(Change.Kind.REMOVED, Change.Subject.OBJECT, key[0], key[2], key[1]))
+            elif new_digest != digest:
+                changes.append(Change(Change.Kind.MODIFIED, Change.Subject.OBJECT, key[0], key[2], key[1],
+                                      fields=['value']))
+        for key in other.objects.iterkeys():
+            if key not in self.objects:
+                changes.append(Change(Change.Kind.ADDED, Change.Subject.OBJECT, key[0], key[2], key[1]))
+
+        scopes = list(self.rulebases.keys())
+        scopes.extend(s for s in other.rulebases.keys() if s not in self.rulebases)
+        for scope in scopes:
+            changes.extend(self._diff_rulebase(scope, self.rulebases.get(scope, []), other.rulebases.get(scope, [])))
+
+        return ChangeSet(changes)
+
+    @staticmethod
+    def _diff_rulebase(scope, old, new):
+        """return the changes between two versions of a rulebase"""
+
+        old_lookup = dict((entry[0], (position, entry)) for position, entry in enumerate(old))
+        new_names = set(entry[0] for entry in new)
+
+        changes = []
+        for position, (name, _, _) in enumerate(old):
+            if name not in new_names:
+                changes.append(Change(Change.Kind.REMOVED, Change.Subject.POLICY, scope, name,
+                                      old_position=position))
+
+        # old positions of the policies in both rulebases, in their new order
+        common = []
+        for position, (name, fingerprint, attributes) in enumerate(new):
+            if name not in old_lookup:
+                changes.append(Change(Change.Kind.ADDED, Change.Subject.POLICY, scope, name, new_position=position))
+                continue
+            old_position, (_, old_fingerprint, old_attributes) = old_lookup[name]
+            common.append((old_position, position, name))
+            fields = []
+            if fingerprint != old_fingerprint:
+                fields.append('match')
+            if attributes != old_attributes:
+                fields.append('attributes')
+            if fields:
+                changes.append(Change(Change.Kind.MODIFIED, Change.Subject.POLICY, scope, name, fields=fields,
+                                      old_position=old_position, new_position=position))
+
+        # the policies that kept their relative order did not move, even if rules around them were
+        # added or removed
+        stable = _stable_positions([c[0] for c in common])
+        for i, (old_position, position, name) in enumerate(common):
+            if i not in stable:
+                changes.append(Change(Change.Kind.MOVED, Change.Subject.POLICY, scope, name,
+                                      old_position=old_position, new_position=position))
+
+        return changes
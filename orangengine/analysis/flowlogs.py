@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+"""
+replay traffic logs against a parsed rulebase
+
+Log lines are read lazily and parsed into (source zone, destination zone,
+source ip, destination ip, protocol, destination port) flows, the same tuples
+flow_match takes. Identical flows are only evaluated once per chunk, and
+chunks can be fanned out over a pool of worker processes that share the
+parsed driver read-only, or a memory mapped PackedRulebase of it.
+"""
+import csv
+import gzip
+import os
+import re
+import tempfile
+
+from collections import Counter, defaultdict
+from itertools import islice
+from multiprocessing import Pool
+
+from orangengine.index import PackedRulebase
+
+from terminaltables import AsciiTable
+
+
+# Palo Alto traffic log (syslog / csv export) field positions
+PAN_TYPE = 3
+PAN_SOURCE_IP = 7
+PAN_DESTINATION_IP = 8
+PAN_SOURCE_ZONE = 16
+PAN_DESTINATION_ZONE = 17
+PAN_DESTINATION_PORT = 25
+PAN_PROTOCOL = 29
+
+# RT_FLOW structured-data, e.g. source-address="10.0.0.1"
+SRX_STRUCTURED_FIELD = re.compile(r'([a-z\-]+)="([^"]*)"')
+
+# RT_FLOW_SESSION_CREATE / RT_FLOW_SESSION_CLOSE in the plain (brief) format
+SRX_SESSION = re.compile(
+    r'session (?:created|closed [^:]*:) (?P<src>\S+)/\d+->(?P<dst>\S+)/(?P<port>\d+)(?: 0x\S+)? \S+ '
+    r'\S+/\d+->\S+/\d+(?: 0x\S+)? \S+ \S+ \S+ \S+ (?P<protocol>\d+) \S+ (?P<src_zone>\S+) (?P<dst_zone>\S+) ')
+
+# RT_FLOW_SESSION_DENY in the plain (brief) format
+SRX_SESSION_DENY = re.compile(
+    r'session denied (?P<src>\S+)/\d+->(?P<dst>\S+)/(?P<port>\d+)(?: 0x\S+)? \S+ '
+    r'(?P<protocol>\d+)\(\d+\) \S+ (?P<src_zone>\S+) (?P<dst_zone>\S+) ')
+
+
+def pan_traffic_flow(line):
+    """Parse a Palo Alto traffic log line (csv) into a flow
+
+    :returns a (src zone, dst zone, src ip, dst ip, protocol, port) tuple or None
+        if the line is not a traffic log (headers, other log types)
+    """
+    try:
+        fields = next(csv.reader([line]))
+        if fields[PAN_TYPE] != 'TRAFFIC':
+            return None
+        return (fields[PAN_SOURCE_ZONE], fields[PAN_DESTINATION_ZONE], fields[PAN_SOURCE_IP],
+                fields[PAN_DESTINATION_IP], fields[PAN_PROTOCOL], int(fields[PAN_DESTINATION_PORT]))
+    except (IndexError, ValueError, StopIteration, csv.Error):
+        return None
+
+
+def srx_rt_flow(line):
+    """Parse a Juniper SRX RT_FLOW session log line, structured or plain, into a flow
+
+    :returns a (src zone, dst zone, src ip, dst ip, protocol, port) tuple or None
+        if the line is not a RT_FLOW session log
+    """
+    if 'RT_FLOW_SESSION' not in line:
+        return None
+
+    if '-address="' in line:
+        fields = dict(SRX_STRUCTURED_FIELD.findall(line))
+        try:
+            return (fields['source-zone-name'], fields['destination-zone-name'], fields['source-address'],
+                    fields['destination-address'], fields['protocol-id'], int(fields['destination-port']))
+        except (KeyError, ValueError):
+            return None
+
+    match = SRX_SESSION.search(line) or SRX_SESSION_DENY.search(line)
+    if not match:
+        return None
+    return (match.group('src_zone'), match.group('dst_zone'), match.group('src'), match.group('dst'),
+            match.group('protocol'), int(match.group('port')))
+
+
+def iter_log_lines(path):
+    """Generate the lines of a (optionally gzip compressed) log file without reading it whole
+    """
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rb') as f:
+        for line in f:
+            yield line
+
+
+def iter_flows(lines, parser):
+    """Generate the flows parsed out of lines, skipping the lines the parser does not understand
+    """
+    for line in lines:
+        flow = parser(line)
+        if flow is not None:
+            yield flow
+
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _count_flows(flows, evaluate_batch):
+    """
+    count the hits of every rule position
+
+    :param flows: iterable of flows, None entries (unparsed lines) are counted as skipped
+    :param evaluate_batch: function returning the matching rule position (or None) of every flow in a list
+    :returns a ({position: hits}, unmatched, skipped) tuple
+    """
+    seen = Counter()
+    skipped = 0
+    for flow in flows:
+        if flow is None:
+            skipped += 1
+        else:
+            seen[flow] += 1
+
+    hits = defaultdict(int)
+    unmatched = 0
+    unique_flows = list(seen.keys())
+    for flow, position in zip(unique_flows, evaluate_batch(unique_flows)):
+        count = seen[flow]
+        if position is None:
+            unmatched += count
+        else:
+            hits[position] += count
+
+    return dict(hits), unmatched, skipped
+
+
+# the classifier of the pool workers. Set by the pool initializer which, with the
+# fork start method, inherits the parent's parsed driver rather than pickling it
+_worker_classifier = None
+
+# the packed rulebase of the pool workers, mapped by every worker on its own
+_worker_rulebase = None
+
+
+def _init_worker(classifier):
+    global _worker_classifier
+    _worker_classifier = classifier
+
+
+def _init_packed_worker(path):
+    global _worker_rulebase
+    _worker_rulebase = PackedRulebase(path)
+
+
+def _count_chunk(args):
+    parser, lines = args
+    return _worker_classifier.count(parser(line) for line in lines)
+
+
+def _count_packed_chunk(args):
+    parser, lines = args
+    return _count_flows((parser(line) for line in lines), _worker_rulebase.evaluate_batch)
+
+
+class FlowHits(object):
+    """
+    per rule hit counts of a log replay, in rule order
+    """
+
+    def __init__(self, policies):
+        self.policies = policies
+        self.hits = [0] * len(policies)
+        self.unmatched = 0
+        self.skipped = 0
+
+    def update(self, counts):
+        """add the (position hits, unmatched, skipped) counts of a chunk"""
+        hits, unmatched, skipped = counts
+        for position, count in hits.iteritems():
+            self.hits[position] += count
+        self.unmatched += unmatched
+        self.skipped += skipped
+
+    @property
+    def total(self):
+        return sum(self.hits) + self.unmatched
+
+    def hit_counts(self):
+        """return (policy, hits) tuples in rule order"""
+        return zip(self.policies, self.hits)
+
+    def zero_hit_policies(self):
+        """return the policies no flow hit, in rule order"""
+        return [p for p, count in zip(self.policies, self.hits) if not count]
+
+    def table(self, zero_hits_only=False):
+
+        table_data = [["Policy", "Action", "Hits"]]
+        for policy, count in self.hit_counts():
+            if zero_hits_only and count:
+                continue
+            table_data.append([policy.name, policy.action, count])
+        table = AsciiTable(table_data)
+        table.title = "Rule Hits: {0} flows, {1} unmatched".format(self.total, self.unmatched)
+
+        return table.table
+
+
+class FlowLogClassifier(object):
+    """
+    classify flows against the rulebase of a driver with flow_match
+
+    extra keyword arguments (e.g. device_group for Panorama) are passed on to
+    flow_match and get_flow_rulebase
+    """
+
+    def __init__(self, driver, **flow_match_kwargs):
+
+        self.driver = driver
+        self.flow_match_kwargs = flow_match_kwargs
+        self.policies = driver.get_flow_rulebase(**flow_match_kwargs)
+
+        # policies are shared with the workers, so their ids are too
+        self._positions = dict((id(p), i) for i, p in enumerate(self.policies))
+
+    def classify(self, flows):
+        """
+        generate a (flow, policy) tuple for every flow, policy is None when no rule matches
+        """
+        return self.driver.iter_flow_match(flows, **self.flow_match_kwargs)
+
+    def count(self, flows):
+        """
+        count the hits of every rule position
+
+        :param flows: iterable of flows, None entries (unparsed lines) are counted as skipped
+        :returns a ({position: hits}, unmatched, skipped) tuple
+        """
+        return _count_flows(flows, self._evaluate_batch)
+
+    def _evaluate_batch(self, flows):
+        policies = self.driver.flow_match_batch(flows, **self.flow_match_kwargs)
+        return [self._positions.get(id(p)) for p in policies]
+
+    def hit_counts(self, lines, parser, processes=1, chunk_size=10000, packed=False):
+        """
+        replay log lines and count the hits of every rule
+
+        :param lines: iterable of log lines, read lazily (see iter_log_lines)
+        :param parser: line parser returning a flow or None, e.g. pan_traffic_flow or srx_rt_flow
+        :param processes: number of worker processes, 1 classifies in this process
+        :param chunk_size: number of lines handed to a worker at once
+        :param packed: have the workers evaluate flows against a memory mapped PackedRulebase
+            rather than the parsed driver, so they share its pages instead of touching (and
+            thereby copying) the object graph
+        :returns FlowHits
+        """
+
+        result = FlowHits(self.policies)
+
+        if processes > 1 and packed:
+            fd, path = tempfile.mkstemp(suffix='.rulebase')
+            os.close(fd)
+            try:
+                self.driver.pack_flow_rulebase(path, **self.flow_match_kwargs)
+                self._pool_counts(result, lines, parser, processes, chunk_size, _init_packed_worker, (path,),
+                                  _count_packed_chunk)
+            finally:
+                os.remove(path)
+            return result
+
+        # build the evaluators once so the workers inherit them instead of building their own
+        self.driver.prepare_flow_match(**self.flow_match_kwargs)
+
+        if processes == 1:
+            for chunk in _chunks(lines, chunk_size):
+                result.update(self.count(parser(line) for line in chunk))
+            return result
+
+        self._pool_counts(result, lines, parser, processes, chunk_size, _init_worker, (self,), _count_chunk)
+        return result
+
+    @staticmethod
+    def _pool_counts(result, lines, parser, processes, chunk_size, initializer, initargs, count_chunk):
+        """fan the chunks of lines out over a pool of workers and add up their counts"""
+        pool = Pool(processes, initializer=initializer, initargs=initargs)
+        try:
+            chunks = ((parser, chunk) for chunk in _chunks(lines, chunk_size))
+            for counts in pool.imap_unordered(count_chunk, chunks):
+                result.update(counts)
+        finally:
+            pool.terminate()
+            pool.join()
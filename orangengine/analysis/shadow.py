@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+from orangengine.index import PolicyIndex
+from orangengine.index.bitset import iter_bits
+from orangengine.utils import enum
+
+from terminaltables import AsciiTable
+
+
+class ShadowedPolicy(object):
+    """
+    a policy that can never be hit because earlier policies cover all of it
+    """
+
+    # shadowed: the first covering policy has a different action
+    # redundant: the first covering policy has the same action
+    Kind = enum('SHADOWED', 'REDUNDANT')
+
+    def __init__(self, policy, covered_by):
+
+        self.policy = policy
+        # the earlier policies covering all of policy, in rule order
+        self.covered_by = covered_by
+        if covered_by[0].action == policy.action:
+            self.kind = self.Kind.REDUNDANT
+        else:
+            self.kind = self.Kind.SHADOWED
+
+
+class ShadowAnalyzer(object):
+    """
+    find every policy of an ordered rulebase that is fully covered by a single earlier policy
+
+    A policy covers another when each of its fields contains the other's: zones and applications
+    by value (or 'any'), addresses by interval containment and services by port range coverage.
+    Instead of comparing policies pairwise, the containing policies of every field value are looked
+    up in the rulebase indexes as bitsets, which are and-ed together and with the positions before
+    the policy.
+    Lookups are cached by value as the same values are referenced by many policies.
+    The PolicyIndex of the rulebase can be passed in when the caller already holds one.
+    """
+
+    def __init__(self, policies, index=None):
+
+        self.policies = policies
+        self.index = index if index is not None else PolicyIndex(policies)
+        self._containing_cache = dict()
+
+    def _value_mask(self, key, value):
+        """return the bitset of the policies containing a zone or application value"""
+        masks = self.index.value_masks[key]
+        if value == 'any':
+            return masks.get('any', 0)
+        return masks.get(value, 0) | masks.get('any', 0)
+
+    def _containing(self, key, value):
+        """return the (cached) bitset of the policies containing a single field value"""
+        cache_key = key, value
+        mask = self._containing_cache.get(cache_key)
+        if mask is None:
+            if key in PolicyIndex.ADDRESS_KEYS:
+                mask = self.index.address_indexes[key].containing(value)
+            elif key == 'services':
+                protocol, first, last = value
+                mask = self.index.service_index.covering(None, first, last)
+                if protocol is not None:
+                    mask |= self.index.service_index.covering(protocol, first, last)
+            else:
+                mask = self._value_mask(key, value)
+            self._containing_cache[cache_key] = mask
+        return mask
+
+    def _field_values(self, policy):
+        """generate the (key, value) pairs of every field value of policy"""
+        for key in ['source_zones', 'destination_zones', 'applications']:
+            for value in getattr(policy, key, None) or ():
+                yield key, value
+        for key in PolicyIndex.ADDRESS_KEYS:
+            intervals, fqdns = policy.address_intervals(key)
+            for value in intervals:
+                yield key, value
+            for value in fqdns:
+                yield key, value
+        for value in policy.service_intervals():
+            yield 'services', value
+
+    def covering_mask(self, position):
+        """return the bitset of the earlier policies covering the policy at position
+        """
+
+        policy = self.policies[position]
+        if policy.services and not policy.service_intervals():
+            # services that cannot be parsed into intervals cannot be compared
+            return 0
+
+        mask = (1 << position) - 1
+        for key, value in self._field_values(policy):
+            mask &= self._containing(key, value)
+            if not mask:
+                break
+        return mask
+
+    def analyze(self):
+        """return a ShadowedPolicy for every covered policy, in rule order
+        """
+
+        results = []
+        for position, policy in enumerate(self.policies):
+            mask = self.covering_mask(position)
+            if mask:
+                results.append(ShadowedPolicy(policy, [self.policies[p] for p in iter_bits(mask)]))
+        return results
+
+    @staticmethod
+    def table(results):
+
+        table_data = [["Policy", "Kind", "Covered By"]]
+        for result in results:
+            kind = 'redundant' if result.kind == ShadowedPolicy.Kind.REDUNDANT else 'shadowed'
+            table_data.append([result.policy.name, kind, "\n".join([p.name for p in result.covered_by])])
+        table = AsciiTable(table_data)
+        table.title = "Shadowed Policies"
+
+        return table.table
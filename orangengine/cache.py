@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+on-disk cache of parsed driver models
+
+The parsed model of a driver (its object lookups and policies) is pickled to
+a single file per device along with the config version it was parsed from,
+so a refresh of an unchanged device, or an offline start, skips pulling and
+parsing the config. The device connection itself is never pickled, it is
+swapped for a persistent id and swapped back for the current device on load.
+"""
+import cPickle
+import os
+import re
+import tempfile
+
+
+# bump when the cached model layout changes, files of another format are ignored
+CACHE_FORMAT = 2
+
+# persistent id of the device connection
+DEVICE_ID = 'device'
+
+
+class ModelCache(object):
+    """
+    directory of cached driver models, one file per device identity
+    """
+
+    def __init__(self, directory):
+
+        self.directory = directory
+
+    def path(self, identity):
+        """return the path of the cache file of a device identity (a tuple of strings)"""
+        name = re.sub(r'[^\w.\-]', '_', '-'.join(identity))
+        return os.path.join(self.directory, name + '.model')
+
+    @staticmethod
+    def _read_header(f):
+        """return the config version of an open cache file, None if it is in another format"""
+        cache_format, version = cPickle.load(f)
+        if cache_format != CACHE_FORMAT:
+            return None
+        return version
+
+    def version(self, identity):
+        """Return the config version of the cached model of a device, or None
+        """
+
+        try:
+            with open(self.path(identity), 'rb') as f:
+                return self._read_header(f)
+        except Exception:
+            # missing, truncated or foreign files are all cache misses
+            return None
+
+    def load(self, identity, version=None, device=None):
+        """Return the cached model state of a device, or None on a miss
+
+        :param identity: device identity, see BaseDriver._cache_identity
+        :param version: config version the model has to have been parsed from, None for any
+        :param device: the object to restore in place of the device the model was parsed with
+        """
+
+        def persistent_load(pid):
+            if pid == DEVICE_ID:
+                return device
+            raise cPickle.UnpicklingError("unknown persistent id {0}".format(pid))
+
+        try:
+            with open(self.path(identity), 'rb') as f:
+                cached_version = self._read_header(f)
+                if cached_version is None or (version is not None and cached_version != version):
+                    return None
+                unpickler = cPickle.Unpickler(f)
+                unpickler.persistent_load = persistent_load
+                return unpickler.load()
+        except Exception:
+            return None
+
+    def save(self, identity, version, state, device=None):
+        """Write the model state of a device, replacing the cached model atomically
+        """
+
+        def persistent_id(obj):
+            if device is not None and obj is device:
+                return DEVICE_ID
+            return None
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                cPickle.dump((CACHE_FORMAT, version), f, cPickle.HIGHEST_PROTOCOL)
+                pickler = cPickle.Pickler(f, cPickle.HIGHEST_PROTOCOL)
+                pickler.persistent_id = persistent_id
+                pickler.dump(state)
+            os.rename(temp_path, self.path(identity))
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
@@ -1,10 +1,12 @@
 # -*- coding: utf-8 -*-
 from orangengine.drivers import JuniperSRXDriver
+from orangengine.drivers import JuniperSRXFileDriver
 from orangengine.drivers import PaloAltoPanoramaDriver
 
 
 DRIVER_MAPPINGS = {
     'juniper_srx': JuniperSRXDriver,
+    'juniper_srx_file': JuniperSRXFileDriver,
     'palo_alto_panorama': PaloAltoPanoramaDriver,
 }
 
@@ -1,8 +1,9 @@
 # -*- coding: utf-8 -*-
 from orangengine.drivers.base import BaseDriver
 from orangengine.drivers.juniper_srx import JuniperSRXDriver
+from orangengine.drivers.juniper_srx_file import JuniperSRXFileDriver
 from orangengine.drivers.palo_alto_panorama import PaloAltoPanoramaDriver
 from orangengine.drivers.palo_alto_base import PaloAltoBaseDriver
 
 
-__all__ = ['BaseDriver', 'JuniperSRXDriver', 'PaloAltoPanoramaDriver', 'PaloAltoBaseDriver', ]
+__all__ = ['BaseDriver', 'JuniperSRXDriver', 'JuniperSRXFileDriver', 'PaloAltoPanoramaDriver', 'PaloAltoBaseDriver', ]
@@ -1,4 +1,6 @@
 # -*- coding: utf-8 -*-
+import re
+
 from lxml import etree as letree
 from orangengine.utils import is_ipv4
 
@@ -69,3 +71,227 @@ def create_element(tag, text=None, parent=None):
     return e
 
 # --- end xml generation functions
+
+
+# --- begin config parsing functions
+
+
+def is_inactive(e):
+    """return True if e or one of its ancestors is deactivated"""
+    while e is not None:
+        if e.get('inactive') is not None:
+            return True
+        e = e.getparent()
+    return False
+
+
+def strip_inactive(e):
+    """remove the deactivated descendants of e, return e"""
+    for inactive in list(e.iterfind('.//*[@inactive]')):
+        parent = inactive.getparent()
+        if parent is not None:
+            parent.remove(inactive)
+    return e
+
+# --- end config parsing functions
+
+
+# --- begin display set parsing functions
+
+
+# a quoted or a bare token of a set line
+SET_TOKEN = re.compile(r'"((?:[^"\\]|\\.)*)"|(\S+)')
+
+# statements that take a value, every other statement is a container
+SET_VALUE_TAGS = frozenset([
+    'description', 'protocol', 'source-port', 'destination-port', 'icmp-type', 'icmp-code', 'icmp6-type',
+    'icmp6-code', 'inactivity-timeout', 'application-protocol', 'rpc-program-number', 'uuid', 'ether-type',
+    'source-address', 'destination-address', 'application', 'source-identity', 'scheduler-name',
+    'dynamic-application', 'wildcard-address',
+])
+
+# statements that contain other statements (or are flags), statements that are neither are skipped
+SET_CONTAINER_TAGS = frozenset([
+    'match', 'then', 'permit', 'deny', 'reject', 'log', 'session-init', 'session-close', 'count',
+])
+
+# statements of an address entry, an address entry with anything else is "address NAME PREFIX"
+SET_ADDRESS_TAGS = frozenset(['description', 'dns-name', 'range-address', 'wildcard-address'])
+
+
+def tokenize_set_line(line):
+    """split a display set line into its tokens, unquoting quoted tokens"""
+    tokens = []
+    for match in SET_TOKEN.finditer(line):
+        if match.group(2) is None:
+            tokens.append(re.sub(r'\\(.)', r'\1', match.group(1)))
+        else:
+            tokens.append(match.group(2))
+    return tokens
+
+
+class SetConfigBuilder(object):
+    """
+    builds the configuration element of the display set lines of the hierarchies the srx driver parses
+
+    Lines of any other hierarchy are skipped, so only the parsed part of a config is ever held in memory.
+    """
+
+    def __init__(self):
+        self.configuration = create_element('configuration')
+        # (tag, name) path -> element, to find the entries later lines add to
+        self._elements = {}
+        # whether the line being added is a deactivate line
+        self._deactivate = False
+
+        # the hierarchies in config order, whatever the order of the lines
+        root = ((), self.configuration)
+        self._node(self._node(root, 'groups', 'junos-defaults'), 'applications')
+        security = self._node(root, 'security')
+        self._node(security, 'address-book', 'global')
+        self._node(security, 'policies')
+        self._node(root, 'applications')
+
+    def _node(self, node, tag, name=None):
+        """return the (path, element) node of the (named) child, creating it on first use"""
+        path, parent = node
+        path = path + ((tag, name),)
+        e = self._elements.get(path)
+        if e is None:
+            e = create_element(tag, parent=parent)
+            if name is not None:
+                create_element('name', text=name, parent=e)
+            self._elements[path] = e
+        return path, e
+
+    def _value(self, parent, tag, text):
+        """return the value element of parent, appended unless a deactivate line names an existing one"""
+        if self._deactivate:
+            for e in parent.findall(tag):
+                if e.text == text:
+                    return e
+        return create_element(tag, text=text, parent=parent)
+
+    def _values(self, node, tokens):
+        """add a statement to node, its containers are shared with earlier lines and its value is appended
+
+        Values are never made into tags, the statement is cut at the first token that is neither a known
+        value statement nor a known container. Returns the element of the statement, None if it was cut.
+        """
+        while tokens:
+            tag = tokens[0]
+            if tag in SET_VALUE_TAGS:
+                if len(tokens) > 1:
+                    return self._value(node[1], tag, tokens[1])
+                return None
+            if tag not in SET_CONTAINER_TAGS:
+                return None
+            node = self._node(node, tag)
+            tokens = tokens[1:]
+        return node[1]
+
+    def add_line(self, line):
+        """add a display set line
+
+        deactivate lines mark the element of their statement inactive, like the inactive attribute of
+        the xml config, set lines add to the config and any other line is skipped.
+        """
+
+        tokens = tokenize_set_line(line)
+        if len(tokens) < 2 or tokens[0] not in ('set', 'deactivate'):
+            return
+        self._deactivate = tokens[0] == 'deactivate'
+        tokens = tokens[1:]
+
+        root = ((), self.configuration)
+        security = self._node(root, 'security')
+        defaults = self._node(root, 'groups', 'junos-defaults')
+        e = None
+        if tokens[:3] == ['groups', 'junos-defaults', 'applications']:
+            e = self._add_application(self._node(defaults, 'applications'), tokens[3:])
+        elif tokens[:2] == ['groups', 'junos-defaults']:
+            e = defaults[1]
+        elif tokens[0] == 'applications':
+            e = self._add_application(self._node(root, 'applications'), tokens[1:])
+        elif tokens[:3] == ['security', 'address-book', 'global']:
+            e = self._add_address(self._node(security, 'address-book', 'global'), tokens[3:])
+        elif tokens[:2] == ['security', 'policies']:
+            e = self._add_policy(self._node(security, 'policies'), tokens[2:])
+        elif tokens == ['security']:
+            e = security[1]
+
+        if self._deactivate and e is not None:
+            e.set('inactive', 'inactive')
+
+    def _add_application(self, applications, tokens):
+        if not tokens:
+            return applications[1]
+        if len(tokens) < 2 or tokens[0] not in ('application', 'application-set'):
+            return None
+        entry = self._node(applications, tokens[0], tokens[1])
+        rest = tokens[2:]
+        if tokens[0] == 'application-set' and len(rest) > 1 and rest[0] in ('application', 'application-set'):
+            return self._node(entry, rest[0], rest[1])[1]
+        if tokens[0] == 'application' and len(rest) > 1 and rest[0] == 'term':
+            entry = self._node(entry, 'term', rest[1])
+            rest = rest[2:]
+        return self._values(entry, rest)
+
+    def _add_address(self, book, tokens):
+        if not tokens:
+            return book[1]
+        if len(tokens) < 2 or tokens[0] not in ('address', 'address-set'):
+            return None
+        entry = self._node(book, tokens[0], tokens[1])
+        rest = tokens[2:]
+        if tokens[0] == 'address-set':
+            if not rest:
+                return entry[1]
+            if len(rest) > 1 and rest[0] in ('address', 'address-set'):
+                return self._node(entry, rest[0], rest[1])[1]
+            return None
+        elif len(rest) == 1 and rest[0] not in SET_ADDRESS_TAGS:
+            return self._value(entry[1], 'ip-prefix', rest[0])
+        elif len(rest) > 1 and rest[0] == 'dns-name':
+            return self._value(self._node(entry, 'dns-name')[1], 'name', rest[1]).getparent()
+        elif len(rest) > 3 and rest[0] == 'range-address' and rest[2] == 'to':
+            e_range = self._node(entry, 'range-address')[1]
+            if not self._deactivate:
+                create_element('low', text=rest[1], parent=e_range)
+                create_element('high', text=rest[3], parent=e_range)
+            return e_range
+        return self._values(entry, rest)
+
+    def _add_policy(self, policies, tokens):
+        if not tokens:
+            return policies[1]
+        if tokens[0] == 'global':
+            zone_set = self._node(policies, 'global')
+            tokens = tokens[1:]
+        elif len(tokens) > 3 and tokens[0] == 'from-zone' and tokens[2] == 'to-zone':
+            path = policies[0] + (('zone-pair', (tokens[1], tokens[3])),)
+            e = self._elements.get(path)
+            if e is None:
+                e = build_zone_pair(tokens[1], tokens[3])
+                policies[1].append(e)
+                self._elements[path] = e
+            zone_set = path, e
+            tokens = tokens[4:]
+        else:
+            # default policy and other policy options
+            return None
+        if not tokens:
+            return zone_set[1]
+        if len(tokens) < 2 or tokens[0] != 'policy':
+            return None
+        return self._values(self._node(zone_set, 'policy', tokens[1]), tokens[2:])
+
+
+def parse_set_config(lines):
+    """return the configuration element of an iterable of display set lines, see SetConfigBuilder"""
+    builder = SetConfigBuilder()
+    for line in lines:
+        builder.add_line(line)
+    return builder.configuration
+
+# --- end display set parsing functions
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+from lxml import etree as letree
+
+
+"""
+palo alto driver specific utility functions
+"""
+
+
+# --- begin config xml parsing functions
+
+
+class XmlEntry(object):
+    """
+    stand-in for the pandevice object of an entry parsed straight from config xml
+
+    Carries the attributes the models read from pandevice objects, under the same names, so the
+    models can be built without constructing pandevice objects.
+    """
+
+    def __init__(self, **attributes):
+        self.__dict__.update(attributes)
+
+
+def members(e, path, default=None):
+    """return the member texts under path of e, default if there are none"""
+    values = [m.text for m in e.findall(path + '/member')]
+    return values or default
+
+
+def yesno(e, path):
+    """return the yes/no value at path of e as a bool, None if it is not set"""
+    text = e.findtext(path)
+    if text is None:
+        return None
+    return text == 'yes'
+
+
+def address_entry(e):
+    for a_type in ['ip-netmask', 'ip-range', 'fqdn']:
+        value = e.findtext(a_type)
+        if value is not None:
+            break
+    else:
+        a_type = 'ip-netmask'
+    return XmlEntry(name=e.get('name'), type=a_type, value=value, description=e.findtext('description'),
+                    tag=members(e, 'tag'))
+
+
+def address_group_entry(e):
+    return XmlEntry(name=e.get('name'), static_value=members(e, 'static'),
+                    dynamic_value=e.findtext('dynamic/filter'), description=e.findtext('description'),
+                    tag=members(e, 'tag'))
+
+
+def service_entry(e):
+    protocol = source_port = destination_port = None
+    e_protocol = e.find('protocol')
+    if e_protocol is not None and len(e_protocol):
+        protocol = e_protocol[0].tag
+        source_port = e_protocol[0].findtext('source-port')
+        destination_port = e_protocol[0].findtext('port')
+    return XmlEntry(name=e.get('name'), protocol=protocol, source_port=source_port,
+                    destination_port=destination_port, description=e.findtext('description'),
+                    tag=members(e, 'tag'))
+
+
+def service_group_entry(e):
+    return XmlEntry(name=e.get('name'), value=members(e, 'members', []), tag=members(e, 'tag'))
+
+
+def application_entry(e):
+    default_type = default_port = None
+    e_default = e.find('default')
+    if e_default is not None and len(e_default):
+        default_type = e_default[0].tag
+        if default_type == 'port':
+            default_port = members(e_default, 'port', [])
+    return XmlEntry(name=e.get('name'), default_type=default_type, default_port=default_port,
+                    description=e.findtext('description'), tag=members(e, 'tag'))
+
+
+def application_group_entry(e):
+    # members are directly under the entry in older versions
+    return XmlEntry(name=e.get('name'), value=members(e, 'members') or members(e, '.', []), tag=members(e, 'tag'))
+
+
+def application_container_entry(e):
+    return XmlEntry(name=e.get('name'), applications=members(e, 'functions', []), is_container=True)
+
+
+def security_rule_entry(e):
+    return XmlEntry(
+        name=e.get('name'),
+        fromzone=members(e, 'from', ['any']),
+        tozone=members(e, 'to', ['any']),
+        source=members(e, 'source', ['any']),
+        destination=members(e, 'destination', ['any']),
+        application=members(e, 'application', ['any']),
+        service=members(e, 'service', ['application-default']),
+        action=e.findtext('action'),
+        log_start=yesno(e, 'log-start'),
+        log_end=yesno(e, 'log-end'),
+        description=e.findtext('description'),
+        tag=members(e, 'tag'),
+    )
+
+
+def parse_xml_file(path):
+    """return the root element of an xml file"""
+    return letree.parse(path, letree.XMLParser(remove_comments=True, huge_tree=True)).getroot()
+
+
+def predefined_entries(root):
+    """return the (applications, application containers) entries of predefined content xml
+
+    Like the pandevice predefined module, apps and containers are the entries of any element
+    named like an application, containers are the ones with functions.
+    """
+    applications = []
+    containers = []
+    for e in root.iter('entry'):
+        parent = e.getparent()
+        if parent is None or 'application' not in parent.tag:
+            continue
+        if e.find('functions') is not None:
+            containers.append(application_container_entry(e))
+        else:
+            applications.append(application_entry(e))
+    return applications, containers
+
+# --- end config xml parsing functions
@@ -5,9 +5,12 @@ from collections import defaultdict
 
 from orangengine.errors import ShadowedPolicyError
 from orangengine.errors import DuplicatePolicyError
-from orangengine.models.base import CandidatePolicy, BasePolicy
+from orangengine.models.base import CandidatePolicy, BasePolicy, MatchCriteria
 from orangengine.utils import is_ipv4, missing_cidr
 from orangengine.models.base import EffectivePolicy
+from orangengine.index import PolicyIndex, FlowEvaluator, HAS_NUMPY, pack_rulebase
+from orangengine.analysis import ShadowAnalyzer, Snapshot
+from orangengine.cache import ModelCache
 
 from netaddr import IPNetwork
 
@@ -33,6 +36,24 @@ class BaseDriver(object):
         'logging',
     )
 
+    # the attributes holding the parsed model, these are what the model cache saves and restores
+    MODEL_ATTRIBUTES = (
+        'address_name_lookup',
+        'address_value_lookup',
+        'address_group_name_lookup',
+        'address_group_value_lookup',
+        'service_name_lookup',
+        'service_value_lookup',
+        'service_group_name_lookup',
+        'service_group_value_lookup',
+        'policies',
+        'policy_name_lookup',
+        'zone_map',
+    )
+
+    # zones flows are evaluated with again when no policy of their own zones matches them
+    FLOW_FALLBACK_ZONE_PAIR = None
+
     def __init__(self, refresh=False, *args, **kwargs):
 
         self._connected = False
@@ -42,6 +63,16 @@ class BaseDriver(object):
         self._username = kwargs.pop('username')
         self._password = kwargs.pop('password')
         self._host = kwargs.pop('host')
+
+        # answer address containment with numpy arrays, when numpy is installed
+        self.vectorized = kwargs.pop('vectorized', False) and HAS_NUMPY
+
+        # on-disk cache of the parsed model, see refresh
+        cache_dir = kwargs.pop('cache_dir', None)
+        self.model_cache = ModelCache(cache_dir) if cache_dir else None
+        # load the cached model, whatever its config version, without contacting the device
+        self.cache_offline = kwargs.pop('cache_offline', False)
+
         self._additional_params = kwargs
 
         # address lookup dictionaries
@@ -60,6 +91,8 @@ class BaseDriver(object):
         self.policies = list()
         self.policy_tuple_lookup = list()
         self.policy_name_lookup = dict()
+        self.policy_index = None
+        self.flow_evaluator = None
 
         # zones mappings
         self.zone_map = dict()
@@ -67,6 +100,12 @@ class BaseDriver(object):
         # share some output between methods
         self.config_output = dict()
 
+        # snapshot of the parsed model and the changes the last refresh made to it
+        self.last_snapshot = None
+        self.changes = None
+        # config version the model was parsed from, if known
+        self.config_version = None
+
         # retrieve, parse, and store objects
         # order matters here as objects have to already
         # exist in the lookup dictionaries
@@ -79,44 +118,146 @@ class BaseDriver(object):
         This method will connect to the device and pull down the config and
         parse all of the objects into the models
 
+        With a cache_dir, the parsed model is cached on disk and reused as long
+        as the config version of the device is unchanged. With cache_offline,
+        the cached model is used without contacting the device at all.
         """
 
+        if self.model_cache is not None and self.cache_offline and self._load_cached_model():
+            self.config_version = self.model_cache.version(self._cache_identity())
+            return
+
         if not self._connected:
             self.open_connection(self._username, self._password, self._host, **self._additional_params)
 
+        version = None
+        if self.model_cache is not None:
+            version = self._config_version()
+            if version is not None and self._load_cached_model(version):
+                self.config_version = version
+                return
+
         # first we need to clear all of the current objects
+        self._clear_model()
 
-        # address lookup dictionaries
+        # now we parse the new config
+
+        self._get_config()
+        self._parse_config()
+
+        self.config_version = version
+        self._model_loaded()
+        self._save_cached_model()
+
+    def _parse_config(self):
+        """parse the retrieved config into the models"""
+
+        self._parse_addresses()
+        self._parse_address_groups()
+        self._parse_services()
+        self._parse_service_groups()
+        self._parse_applications()
+        self._parse_application_groups()
+        self._parse_policies()
+
+    def _save_cached_model(self):
+        """write the model to the model cache, if there is one and the config version is known"""
+        if self.model_cache is not None and self.config_version is not None:
+            self.model_cache.save(self._cache_identity(), self.config_version, self._model_state(), self.device)
+
+    def _clear_model(self):
+        """drop every parsed object and policy"""
+
+        self._clear_addresses()
+        self._clear_services()
+        self._clear_policies()
+
+        # zones mappings
+        self.zone_map = dict()
+
+    def _clear_addresses(self):
+        """drop the address lookup dictionaries"""
         self.address_name_lookup = dict()
         self.address_value_lookup = defaultdict(list)
         self.address_group_name_lookup = dict()
         self.address_group_value_lookup = defaultdict(list)
 
-        # service lookup dictionaries
+    def _clear_services(self):
+        """drop the service lookup dictionaries"""
         self.service_name_lookup = dict()
         self.service_value_lookup = defaultdict(list)
         self.service_group_name_lookup = dict()
         self.service_group_value_lookup = defaultdict(list)
 
-        # policies
+    def _clear_policies(self):
+        """drop the policies and their index"""
         self.policies = list()
         self.policy_tuple_lookup = list()
         self.policy_name_lookup = dict()
+        self.policy_index = None
+        self.flow_evaluator = None
 
-        # zones mappings
-        self.zone_map = dict()
+    def _model_loaded(self):
+        """index a freshly parsed (or loaded) model and record what changed since the last one"""
 
-        # now we parse the new config
+        self.policy_index = PolicyIndex(self.policies, self.vectorized)
 
-        self._get_config()
+        # compare against the model of the previous refresh, if any
+        snapshot = self.snapshot()
+        if self.last_snapshot is not None:
+            self.changes = self.last_snapshot.diff(snapshot)
+        self.last_snapshot = snapshot
 
-        self._parse_addresses()
-        self._parse_address_groups()
-        self._parse_services()
-        self._parse_service_groups()
-        self._parse_applications()
-        self._parse_application_groups()
-        self._parse_policies()
+    def _config_version(self):
+        """return an identifier of the running config that changes with every commit, None if unknown
+
+        Models are only cached (and cached models only used while connected) when it is known.
+        """
+        return None
+
+    def _cache_identity(self):
+        """return the key of the device in the model cache"""
+        return type(self).__name__, self._host
+
+    def _model_state(self):
+        """return the parsed model as a dict of attribute name to value, see MODEL_ATTRIBUTES"""
+        return dict((name, getattr(self, name)) for name in self.MODEL_ATTRIBUTES)
+
+    def _load_cached_model(self, version=None):
+        """replace the model with the cached one, returns False on a cache miss"""
+
+        state = self.model_cache.load(self._cache_identity(), version, self.device)
+        if state is None:
+            return False
+
+        self._clear_model()
+        self._set_model_state(state)
+        self._model_loaded()
+        return True
+
+    def _set_model_state(self, state):
+        """set the parsed model from a dict returned by _model_state"""
+        for name, value in state.iteritems():
+            setattr(self, name, value)
+
+    def _policy_scope(self, policy):
+        """return the rulebase a policy belongs to for snapshots, policy names are unique within it"""
+        return None
+
+    def snapshot(self):
+        """
+        return a Snapshot of the parsed objects and policies, compare two with Snapshot.diff
+        """
+        snapshot = Snapshot()
+        for object_type, lookup in [('address', self.address_name_lookup),
+                                    ('address_group', self.address_group_name_lookup),
+                                    ('service', self.service_name_lookup),
+                                    ('service_group', self.service_group_name_lookup)]:
+            for obj in lookup.itervalues():
+                snapshot.add_object(None, object_type, obj)
+        for p in self.policies:
+            snapshot.add_policy(self._policy_scope(p), p)
+        return snapshot
 
     def _address_lookup_by_name(self, name):
         return self.address_name_lookup[name]
@@ -176,6 +317,21 @@ class BaseDriver(object):
         self.policies.append(policy)
         # self.policy_tuple_lookup.append((policy.value, policy))
         self.policy_name_lookup[policy.name] = policy
+        # the rulebase changed so the index and evaluator are stale
+        self.policy_index = None
+        self.flow_evaluator = None
+
+    def _get_policy_index(self):
+        """return the index of self.policies, (re)building it if needed"""
+        if self.policy_index is None:
+            self.policy_index = PolicyIndex(self.policies, self.vectorized)
+        return self.policy_index
+
+    def _get_flow_evaluator(self):
+        """return the flow evaluator of self.policies, (re)building it if needed"""
+        if self.flow_evaluator is None:
+            self.flow_evaluator = FlowEvaluator(self.policies, self.vectorized)
+        return self.flow_evaluator
 
     @staticmethod
     @abc.abstractmethod
@@ -203,15 +359,35 @@ class BaseDriver(object):
 
         return match_criteria
 
-    def policy_match(self, match_criteria, match_containing_networks=True, exact=False, policies=None):
+    def policy_match(self, match_criteria, match_containing_networks=True, exact=False, policies=None,
+                     match_containing_services=False):
         """
         match policy tuples exactly by match criteria (also a tuple) and return those policies
+
+        with match_containing_services, services match policies whose port ranges cover them,
+        e.g. ('tcp', '443') matches a policy allowing tcp 400-500
         """
+        index = None
         if not policies:
             policies = self.policies
+            index = self._get_policy_index()
+
+        return self._policy_match(match_criteria, match_containing_networks, exact, policies, index,
+                                  match_containing_services)
+
+    def compile_match_criteria(self, match_criteria):
+        """
+        check, normalize and pre-parse the match criteria once
+
+        The returned MatchCriteria can be reused for any number of queries, including
+        the same query against many rulebases (device groups).
+        """
+        if isinstance(match_criteria, MatchCriteria):
+            # already compiled
+            return match_criteria
 
         self._policy_key_check(match_criteria.keys())
-        match_criteria = self._sanitize_match_criteria(match_criteria)
+        match_criteria = self._sanitize_match_criteria(dict(match_criteria))
 
         # silently append /32 to any ipv4 address that is missing cidr
         if 'source_addresses' in match_criteria:
@@ -220,11 +396,73 @@ class BaseDriver(object):
         if 'destination_addresses' in match_criteria:
             match_criteria['destination_addresses'] = [missing_cidr(a) for a in match_criteria['destination_addresses']]
 
+        return MatchCriteria(match_criteria)
+
+    def _policy_match(self, match_criteria, match_containing_networks, exact, policies, index=None,
+                      match_containing_services=False):
+        """
+        match the given policies, narrowing them down with the rulebase index first when one is provided
+        """
+        match_criteria = self.compile_match_criteria(match_criteria)
+
+        if index is not None:
+            policies = index.candidates(match_criteria, match_containing_networks, match_containing_services, exact)
+
         matches = [p for p in policies if p.match(match_criteria, exact=exact,
-                                                  match_containing_networks=match_containing_networks)]
+                                                  match_containing_networks=match_containing_networks,
+                                                  match_containing_services=match_containing_services)]
 
         return matches
 
+    def find_duplicate_policies(self, policies=None):
+        """
+        return the lists of policies matching exactly the same traffic with the same action, in rule order
+        """
+        if not policies:
+            return self._get_policy_index().duplicates()
+
+        return PolicyIndex(policies, self.vectorized).duplicates()
+
+    def fingerprint_policies(self, policies=None):
+        """
+        return a dict of policy fingerprint to the list of policies with that fingerprint, in rule order
+        """
+        if not policies:
+            policies = self.policies
+
+        fingerprints = defaultdict(list)
+        for p in policies:
+            fingerprints[p.fingerprint].append(p)
+        return dict(fingerprints)
+
+    def _duplicate_candidate_check(self, candidate_policy, index):
+        """
+        raise a DuplicatePolicyError if applying the candidate policy would result in a rule that already
+        exists in the index
+        """
+        if candidate_policy.method == CandidatePolicy.Method.NEW_POLICY:
+            values = candidate_policy.policy_criteria
+            try:
+                action = self.PolicyClass.ActionMap[values.get('action')]
+            except KeyError:
+                # no (known) action, so no rule can be the same
+                return
+            base_policy = None
+        elif candidate_policy.method == CandidatePolicy.Method.APPEND:
+            # the base policy along with the appended values
+            base_policy = candidate_policy.policy
+            values = dict((key, set(getattr(base_policy, key, None) or ())) for key in base_policy.FINGERPRINT_KEYS)
+            for key, value in candidate_policy.policy_criteria.iteritems():
+                if key in values:
+                    values[key].update(value)
+            action = base_policy.action
+        else:
+            return
+
+        duplicates = [p for p in index.find_rule(values, action) if p is not base_policy]
+        if duplicates:
+            raise DuplicatePolicyError(message="Candidate is a duplicate of {0}".format(duplicates[0].name))
+
     def candidate_policy_match(self, match_criteria, policies=None):
         """
         determine the best policy to append an element from the match criteria to
@@ -233,19 +471,18 @@ class BaseDriver(object):
         if not policies:
             policies = self.policies
 
-        self._policy_key_check(match_criteria.keys())
-
-        # shadow policy check (shadow implicitly includes duplicates)
-        shadow_policies = list(self.policy_match(match_criteria, policies=policies))
-        if len(shadow_policies) != 0:
-            # this is a shadowed policy
-            raise ShadowedPolicyError(message="Candidate is shadowed by {0}".format(shadow_policies[0].name))
+        match_criteria = self.compile_match_criteria(match_criteria)
 
-        # now we find all candidate policies
-        candidate_match = tuple([(p, p.candidate_match(match_criteria, match_containing_networks=True, exact=True))
-                                for p in policies])
-        # filter out tuples that are false (not a candidate match)
-        candidate_tuples = list(filter((lambda x: x[1]), candidate_match))
+        # one pass over the policies for both the shadow check (shadow implicitly includes duplicates)
+        # and the candidate policies
+        candidate_tuples = []
+        for p in policies:
+            shadows, target_element_key = p.shadow_candidate_match(match_criteria, match_containing_networks=True)
+            if shadows:
+                # this is a shadowed policy
+                raise ShadowedPolicyError(message="Candidate is shadowed by {0}".format(p.name))
+            if target_element_key:
+                candidate_tuples.append((p, target_element_key))
 
         if candidate_tuples:
             target_element_key = candidate_tuples[0][1]
@@ -254,7 +491,7 @@ class BaseDriver(object):
 
         if len(candidate_tuples) == 0 and all(target_element_key == ct[1] for ct in candidate_tuples):
             # no valid matches or more than one target element identified (meaning this will have to be a new policy)
-            return CandidatePolicy(policy_criteria=match_criteria, method=CandidatePolicy.Method.NEW_POLICY)
+            return CandidatePolicy(policy_criteria=dict(match_criteria), method=CandidatePolicy.Method.NEW_POLICY)
         else:
 
             matches = [ct[0] for ct in candidate_tuples]
@@ -263,6 +500,116 @@ class BaseDriver(object):
                                    matched_policies=matches,
                                    method=CandidatePolicy.Method.APPEND)
 
+    def iter_policy_match(self, criteria_list, match_containing_networks=True, exact=False, policies=None,
+                          match_containing_services=False):
+        """
+        generate a (match_criteria, matched policies) tuple for every criteria in criteria_list,
+        as soon as it is computed
+
+        The rulebase index (built once for the batch when policies are given) and the parsed
+        policy values are shared by the whole batch.
+        """
+        index = PolicyIndex(policies, self.vectorized) if policies else None
+
+        for match_criteria in criteria_list:
+            compiled = self.compile_match_criteria(match_criteria)
+            if index is None:
+                matches = self.policy_match(compiled, match_containing_networks, exact,
+                                            match_containing_services=match_containing_services)
+            else:
+                matches = self._policy_match(compiled, match_containing_networks, exact, policies, index,
+                                             match_containing_services)
+            yield match_criteria, matches
+
+    def policy_match_batch(self, criteria_list, *args, **kwargs):
+        """
+        return a list of the matched policies of every criteria in criteria_list, in order
+
+        takes the same arguments as iter_policy_match
+        """
+        return [matches for _, matches in self.iter_policy_match(criteria_list, *args, **kwargs)]
+
+    def iter_candidate_policy_match(self, criteria_list, *args, **kwargs):
+        """
+        generate a (match_criteria, result) tuple for every criteria in criteria_list, as soon as
+        it is computed
+
+        result is either the CandidatePolicy or the ShadowedPolicyError raised for that criteria so
+        one shadowed candidate does not end the batch. Takes the same arguments as candidate_policy_match.
+        """
+        for match_criteria in criteria_list:
+            try:
+                result = self.candidate_policy_match(match_criteria, *args, **kwargs)
+            except ShadowedPolicyError as e:
+                result = e
+            yield match_criteria, result
+
+    def candidate_policy_match_batch(self, criteria_list, *args, **kwargs):
+        """
+        return a list of the results of iter_candidate_policy_match, in order
+        """
+        return [result for _, result in self.iter_candidate_policy_match(criteria_list, *args, **kwargs)]
+
+    def flow_match(self, src_zone, dst_zone, src_ip, dst_ip, protocol, port):
+        """
+        return the first policy (in rule order) the flow hits, or None if no policy matches it
+
+        This is the policy the device would evaluate the flow against. Applications cannot be
+        identified from the flow so only the zones, addresses and services of policies are evaluated.
+        """
+        return self._get_flow_evaluator().evaluate(src_zone, dst_zone, src_ip, dst_ip, protocol, port)
+
+    def flow_match_batch(self, flows):
+        """
+        return the first policy every (src_zone, dst_zone, src_ip, dst_ip, protocol, port) flow in flows
+        hits, in order
+
+        the addresses of all of the flows are looked up at once, which is vectorized with vectorized=True
+        """
+        return self._get_flow_evaluator().evaluate_batch(flows)
+
+    def get_flow_rulebase(self):
+        """
+        return every policy flow_match can return
+        """
+        return self.policies
+
+    def prepare_flow_match(self):
+        """
+        build everything flow_match needs ahead of the first flow, e.g. before forking workers
+        """
+        self._get_flow_evaluator()
+
+    def pack_flow_rulebase(self, path, *args, **kwargs):
+        """
+        write the rulebase flow_match evaluates to path in the packed layout, see PackedRulebase
+
+        extra arguments are passed on to get_flow_rulebase
+        """
+        pack_rulebase(self.get_flow_rulebase(*args, **kwargs), path, self.FLOW_FALLBACK_ZONE_PAIR)
+
+    def iter_flow_match(self, flows, *args, **kwargs):
+        """
+        generate a (flow, policy) tuple for every (src_zone, dst_zone, src_ip, dst_ip, protocol, port)
+        flow in flows, as soon as it is evaluated
+
+        extra arguments are passed on to flow_match
+        """
+        for flow in flows:
+            yield flow, self.flow_match(*(tuple(flow) + args), **kwargs)
+
+    def find_shadowed_policies(self, policies=None):
+        """
+        return a ShadowedPolicy for every policy that is fully covered by an earlier policy, in rule order
+
+        covered policies can never be hit, they are either shadowed (the covering policy has a different
+        action) or redundant (same action)
+        """
+        if not policies:
+            return ShadowAnalyzer(self.policies, self._get_policy_index()).analyze()
+
+        return ShadowAnalyzer(policies).analyze()
+
     def effective_policy(self, address, match_containing_networks=True):
         """
         Match source and destination rules based on address and return an EffectivePolicy object
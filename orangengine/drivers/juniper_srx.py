@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
-import xml.etree.ElementTree as ET
+import re
+from xml.sax.saxutils import escape
 from lxml import etree as letree
 
 from orangengine.drivers import BaseDriver
@@ -13,17 +14,239 @@ from orangengine.models.juniper import JuniperSRXPolicy
 from orangengine.errors import ConnectionError
 from orangengine.errors import BadCandidatePolicyError
 from orangengine.errors import PolicyImplementationError
+from orangengine.index import PolicyIndex, FlowEvaluator
+from orangengine.analysis import ChangeSet, ShadowAnalyzer
 from _juniper_utils import build_base, create_element, build_zone_pair, create_new_address, create_new_service
+from _juniper_utils import is_inactive, strip_inactive
 
 from jnpr.junos import Device
 from jnpr.junos.utils.config import Config
 
+from collections import OrderedDict, defaultdict
+
 
 # TODO refactor comments
 class JuniperSRXDriver(BaseDriver):
 
     PolicyClass = JuniperSRXPolicy
 
+    GLOBAL_ZONE_PAIR = ('global', 'global')
+
+    # the global policies are evaluated after those of the zone pair
+    FLOW_FALLBACK_ZONE_PAIR = GLOBAL_ZONE_PAIR
+
+    MODEL_ATTRIBUTES = BaseDriver.MODEL_ATTRIBUTES + (
+        'zone_pair_policies',
+        'global_policies',
+        # the config sections the model was parsed from, needed by incremental refreshes
+        'config_output',
+    )
+
+    # config_output key -> filter of the config section
+    CONFIG_SECTION_FILTERS = OrderedDict([
+        ('policies', '<configuration><security><policies></policies></security></configuration>'),
+        ('address_book',
+         '<configuration><security><address-book><global /></address-book></security></configuration>'),
+        ('output_junos_default',
+         '<configuration><groups><name>junos-defaults</name><applications></applications></groups></configuration>'),
+        ('output_applications', '<configuration><applications></applications></configuration>'),
+    ])
+
+    # every config section in a single filter, so a full refresh is one round trip
+    CONFIG_FILTER = ('<configuration>'
+                     '<security><policies></policies><address-book><global /></address-book></security>'
+                     '<groups><name>junos-defaults</name><applications></applications></groups>'
+                     '<applications></applications>'
+                     '</configuration>')
+
+    # the model reflects the committed config, never uncommitted candidate edits
+    CONFIG_OPTIONS = {'database': 'committed'}
+
+    # config_output key -> (path of the section in the configuration, tag of an empty section)
+    CONFIG_SECTION_PATHS = {
+        'policies': ("security/policies", 'policies'),
+        'address_book': ("security/address-book", 'address-book'),
+        'output_junos_default': ("groups[name='junos-defaults']/applications", 'applications'),
+        'output_applications': ("applications", 'applications'),
+    }
+
+    # the "[edit ...]" headers of a text config diff
+    DIFF_HEADER = re.compile(r'^\[edit(?: (?P<path>.*))?\]$')
+
+    def __init__(self, *args, **kwargs):
+
+        # policies bucketed by (from zone, to zone), in rule order
+        # global policies are kept apart as they are evaluated after every zone pair
+        self.zone_pair_policies = OrderedDict()
+        self.global_policies = list()
+        self._zone_pair_indexes = dict()
+        self._zone_pair_evaluators = dict()
+
+        # parse the config element by element as it is read, without keeping it around
+        self.streaming = kwargs.pop('streaming', False)
+        # name -> stand-in of an application no parsed config defines, see _find_service
+        self._unresolved_services = dict()
+
+        super(JuniperSRXDriver, self).__init__(*args, **kwargs)
+
+    def _clear_policies(self):
+        """also drop the zone pair buckets and their indexes"""
+
+        super(JuniperSRXDriver, self)._clear_policies()
+
+        self.zone_pair_policies = OrderedDict()
+        self.global_policies = list()
+        self._zone_pair_indexes = dict()
+        self._zone_pair_evaluators = dict()
+
+    def _add_policy(self, policy):
+        """add the policy to the flat rulebase and to its zone pair bucket"""
+
+        super(JuniperSRXDriver, self)._add_policy(policy)
+
+        zone_pair = (policy.src_zones[0], policy.dst_zones[0])
+        if zone_pair == self.GLOBAL_ZONE_PAIR:
+            self.global_policies.append(policy)
+        else:
+            self.zone_pair_policies.setdefault(zone_pair, []).append(policy)
+        self._zone_pair_indexes.pop(zone_pair, None)
+        self._zone_pair_evaluators.pop(zone_pair, None)
+
+    def _policy_scope(self, policy):
+        """policy names are only unique within a zone pair"""
+        return policy.src_zones[0], policy.dst_zones[0]
+
+    def get_zone_pair_policies(self, from_zone, to_zone):
+        """return the ordered policies of the given zone pair, 'global' for the global policies"""
+        if (from_zone, to_zone) == self.GLOBAL_ZONE_PAIR:
+            return self.global_policies
+        return self.zone_pair_policies.get((from_zone, to_zone), [])
+
+    def _get_zone_pair_index(self, zone_pair):
+        """return the (cached) index of a zone pair bucket"""
+        index = self._zone_pair_indexes.get(zone_pair)
+        if index is None:
+            index = PolicyIndex(self.get_zone_pair_policies(*zone_pair), self.vectorized)
+            self._zone_pair_indexes[zone_pair] = index
+        return index
+
+    def _get_zone_pair_evaluator(self, zone_pair):
+        """return the (cached) flow evaluator of a zone pair bucket"""
+        evaluator = self._zone_pair_evaluators.get(zone_pair)
+        if evaluator is None:
+            evaluator = FlowEvaluator(self.get_zone_pair_policies(*zone_pair), self.vectorized)
+            self._zone_pair_evaluators[zone_pair] = evaluator
+        return evaluator
+
+    def _zone_pair_buckets(self, match_criteria):
+        """return the zone pairs that can match the zones named in the criteria, in rule order
+
+        Every SRX policy has exactly one from and one to zone, so a bucket can only match when
+        the criteria zones are a subset of its zone pair. Returns None if the criteria names no zones.
+        """
+        source_zones = set(match_criteria.get('source_zones') or [])
+        destination_zones = set(match_criteria.get('destination_zones') or [])
+        if not source_zones and not destination_zones:
+            return None
+
+        zone_pairs = list(self.zone_pair_policies.keys())
+        if self.global_policies:
+            zone_pairs.append(self.GLOBAL_ZONE_PAIR)
+
+        return [(s, d) for s, d in zone_pairs if source_zones.issubset([s]) and destination_zones.issubset([d])]
+
+    def policy_match(self, match_criteria, match_containing_networks=True, exact=False, policies=None,
+                     match_containing_services=False):
+        """Policy Match
+
+        Overridden to only search the zone pair buckets named by the criteria, if any.
+        """
+        if policies:
+            return super(JuniperSRXDriver, self).policy_match(match_criteria, match_containing_networks, exact,
+                                                              policies, match_containing_services)
+
+        match_criteria = self.compile_match_criteria(match_criteria)
+        zone_pairs = self._zone_pair_buckets(match_criteria)
+        if zone_pairs is None:
+            return super(JuniperSRXDriver, self).policy_match(match_criteria, match_containing_networks, exact,
+                                                              match_containing_services=match_containing_services)
+
+        matches = []
+        for zone_pair in zone_pairs:
+            index = self._get_zone_pair_index(zone_pair)
+            matches.extend(self._policy_match(match_criteria, match_containing_networks, exact, index.policies,
+                                              index, match_containing_services))
+        return matches
+
+    def flow_match(self, src_zone, dst_zone, src_ip, dst_ip, protocol, port):
+        """Flow Match
+
+        Overridden to evaluate the flow the way the SRX does: against the policies of its zone
+        pair first and the global policies only if none of them matched.
+        """
+        policy = self._get_zone_pair_evaluator((src_zone, dst_zone)).evaluate(
+            src_zone, dst_zone, src_ip, dst_ip, protocol, port)
+        if policy is None and self.global_policies:
+            policy = self._get_zone_pair_evaluator(self.GLOBAL_ZONE_PAIR).evaluate(
+                'global', 'global', src_ip, dst_ip, protocol, port)
+        return policy
+
+    def flow_match_batch(self, flows):
+        """Batch Flow Match
+
+        Overridden to evaluate the flows of every zone pair together, then the flows none of
+        them matched against the global policies.
+        """
+        flows = list(flows)
+        results = [None] * len(flows)
+
+        zone_pairs = defaultdict(list)
+        for i, flow in enumerate(flows):
+            zone_pairs[(flow[0], flow[1])].append(i)
+
+        for zone_pair, batch in zone_pairs.iteritems():
+            evaluator = self._get_zone_pair_evaluator(zone_pair)
+            for i, policy in zip(batch, evaluator.evaluate_batch([flows[i] for i in batch])):
+                results[i] = policy
+
+        batch = [i for i, policy in enumerate(results) if policy is None]
+        if batch and self.global_policies:
+            evaluator = self._get_zone_pair_evaluator(self.GLOBAL_ZONE_PAIR)
+            global_flows = [('global', 'global') + tuple(flows[i][2:]) for i in batch]
+            for i, policy in zip(batch, evaluator.evaluate_batch(global_flows)):
+                results[i] = policy
+
+        return results
+
+    def find_shadowed_policies(self, policies=None):
+        """Find Shadowed Policies
+
+        Overridden to analyze every zone pair bucket on its own, as policies of different zone
+        pairs never cover each other.
+        """
+        if policies:
+            return super(JuniperSRXDriver, self).find_shadowed_policies(policies)
+
+        zone_pairs = list(self.zone_pair_policies.keys())
+        if self.global_policies:
+            zone_pairs.append(self.GLOBAL_ZONE_PAIR)
+
+        results = []
+        for zone_pair in zone_pairs:
+            index = self._get_zone_pair_index(zone_pair)
+            results.extend(ShadowAnalyzer(index.policies, index).analyze())
+        return results
+
+    def prepare_flow_match(self):
+        """Prepare Flow Match
+
+        Overridden to build the evaluator of every zone pair bucket.
+        """
+        for zone_pair in self.zone_pair_policies.keys():
+            self._get_zone_pair_evaluator(zone_pair)
+        if self.global_policies:
+            self._get_zone_pair_evaluator(self.GLOBAL_ZONE_PAIR)
+
     def apply_policy(self, policy, commit=False):
         pass
 
@@ -87,6 +310,8 @@ class JuniperSRXDriver(BaseDriver):
         if not self._connected:
             raise ConnectionError("Device connection is not open")
 
+        self._duplicate_candidate_check(candidate_policy, self._get_policy_index())
+
         c_policy = candidate_policy.policy
 
         configuration = build_base()
@@ -168,31 +393,358 @@ class JuniperSRXDriver(BaseDriver):
         self.device.open()
         self._connected = True
 
+    def refresh(self, incremental=False):
+        """Refresh the device
+
+        With incremental, the commit history is checked first and nothing is pulled if there
+        was no commit since the model was parsed. Otherwise only the config sections the commits
+        changed are pulled and patched into the model, only the changed zone pairs when nothing
+        but policies changed. Falls back to a full refresh when the changes cannot be told from
+        the commit history, e.g. after more commits than the history holds or changes to groups.
+        """
+
+        if not incremental or self.config_version is None or not self.config_output:
+            version = None
+            if incremental:
+                if not self._connected:
+                    self.open_connection(self._username, self._password, self._host, **self._additional_params)
+                # read before pulling the config, so a commit in between is not missed by the next refresh
+                version = self._config_version()
+            super(JuniperSRXDriver, self).refresh()
+            if self.config_version is None:
+                self.config_version = version
+            return
+
+        if not self._connected:
+            self.open_connection(self._username, self._password, self._host, **self._additional_params)
+
+        history = self._commit_history()
+        versions = self._commit_versions(history)
+        version = versions[0] if versions else None
+        if version == self.config_version:
+            self.changes = ChangeSet()
+            return
+
+        changed = self._changed_hierarchies(versions)
+        if changed is None:
+            self.config_version = None
+            return self.refresh(incremental=True)
+
+        sections, zone_pairs = changed
+        self._patch_model(sections, zone_pairs)
+        self.config_version = version
+        self._model_loaded()
+        self._save_cached_model()
+
+    def _commit_history(self):
+        """return the commit-history elements of the commit information, newest first"""
+        return self.device.rpc.get_commit_information().findall('commit-history')
+
+    @staticmethod
+    def _commit_versions(history):
+        """return the versions of commit-history elements, newest first
+
+        A version is the time and author of a commit, and its ordinal among the commits of the same
+        time and author counted from the oldest, so commits within the same second are told apart.
+        The sequence number cannot be used, it is the rollback number and shifts with every commit.
+        """
+        counts = defaultdict(int)
+        versions = []
+        for commit in reversed(history):
+            key = commit.findtext('date-time'), commit.findtext('user')
+            counts[key] += 1
+            versions.append('{0} {1} #{2}'.format(key[0], key[1], counts[key]))
+        versions.reverse()
+        return versions
+
+    def _config_version(self):
+        """
+        the version of the last commit, from the commit history
+        """
+        versions = self._commit_versions(self._commit_history())
+        if not versions:
+            return None
+        return versions[0]
+
+    def _compare_rollback(self, rollback):
+        """return the text diff of the candidate config against a rollback"""
+        diff = self.device.rpc.get_configuration({'compare': 'rollback', 'rollback': str(rollback), 'format': 'text'})
+        return diff.findtext('.//configuration-output') or ''
+
+    def _changed_hierarchies(self, versions):
+        """return what the commits since the parsed config version changed, see _parse_config_diff
+
+        Junos only compares the candidate config, so uncommitted candidate edits show up in the diff
+        against the parsed rollback. What the candidate changes against the committed config (rollback 0)
+        is added as well: every section the commits changed is in one of the diffs, and changed sections
+        are pulled from the committed config, so the model never picks up uncommitted edits.
+        None if the parsed version is no longer in the commit history.
+        """
+        if self.config_version not in versions:
+            return None
+
+        changed = self._parse_config_diff(self._compare_rollback(versions.index(self.config_version)))
+        uncommitted = self._parse_config_diff(self._compare_rollback(0))
+        if changed is None or uncommitted is None:
+            return None
+
+        sections = changed[0] | uncommitted[0]
+        if changed[1] is None or uncommitted[1] is None:
+            return sections, None
+        return sections, changed[1] | uncommitted[1]
+
+    @classmethod
+    def _parse_config_diff(cls, text):
+        """Parse a text config diff (show | compare) into the config sections and zone pairs it changes
+
+        :returns a (set of config_output keys, set of zone pairs) tuple, the zone pairs are None if
+            the policies changed in some other way. None if the changes cannot be told apart.
+        """
+
+        sections = set()
+        zone_pairs = set()
+        for line in text.splitlines():
+            match = cls.DIFF_HEADER.match(line.strip())
+            if not match:
+                continue
+            path = (match.group('path') or '').split()
+            if not path or path[0] == 'groups' or path == ['security']:
+                # whole hierarchies or groups that may be applied anywhere
+                return None
+            elif path[:2] == ['security', 'policies']:
+                sections.add('policies')
+                if len(path) >= 6 and path[2] == 'from-zone' and path[4] == 'to-zone':
+                    if zone_pairs is not None:
+                        zone_pairs.add((path[3], path[5]))
+                elif len(path) >= 3 and path[2] == 'global':
+                    if zone_pairs is not None:
+                        zone_pairs.add(cls.GLOBAL_ZONE_PAIR)
+                else:
+                    zone_pairs = None
+            elif path[:2] == ['security', 'address-book']:
+                sections.add('address_book')
+            elif path[0] == 'applications':
+                sections.add('output_applications')
+
+        return sections, zone_pairs
+
+    def _patch_model(self, sections, zone_pairs):
+        """pull and re-parse the changed config sections, keeping the rest of the model"""
+
+        if not sections:
+            return
+
+        if sections == set(['policies']) and zone_pairs is not None:
+            self._patch_zone_pairs(zone_pairs)
+            return
+
+        for key in sections:
+            self.config_output[key] = self._get_config_section(key)
+        if 'address_book' in sections:
+            self._clear_addresses()
+            self._parse_addresses()
+            self._parse_address_groups()
+        if 'output_applications' in sections:
+            self._clear_services()
+            self._parse_services()
+            self._parse_service_groups()
+
+        # policies reference the objects, so they are always parsed again
+        self._clear_policies()
+        self._parse_policies()
+
+    def _patch_zone_pairs(self, zone_pairs):
+        """pull and re-parse the policies of the given zone pairs only"""
+
+        e_policies = self.config_output['policies']
+        for zone_pair in zone_pairs:
+            e_new = self._get_zone_pair_config(zone_pair)
+            e_old = None
+            for e_zone_set in list(e_policies):
+                if self._zone_set_pair(e_zone_set) == zone_pair:
+                    e_old = e_zone_set
+                    break
+            if e_old is not None:
+                position = list(e_policies).index(e_old)
+                e_policies.remove(e_old)
+                if e_new is not None:
+                    e_policies.insert(position, e_new)
+            elif e_new is not None:
+                e_policies.append(e_new)
+
+        # keep the policies and the indexes of the zone pairs that did not change
+        buckets = dict(self.zone_pair_policies)
+        buckets[self.GLOBAL_ZONE_PAIR] = self.global_policies
+        indexes = self._zone_pair_indexes
+        evaluators = self._zone_pair_evaluators
+
+        self._clear_policies()
+        for e_zone_set in list(e_policies):
+            zone_pair = self._zone_set_pair(e_zone_set)
+            if zone_pair is None:
+                continue
+            if zone_pair in zone_pairs:
+                policies = self._parse_zone_set(e_zone_set, zone_pair)
+            else:
+                policies = buckets.get(zone_pair, [])
+            for policy in policies:
+                self._add_policy(policy)
+
+        self._zone_pair_indexes = dict((z, i) for z, i in indexes.iteritems() if z not in zone_pairs)
+        self._zone_pair_evaluators = dict((z, e) for z, e in evaluators.iteritems() if z not in zone_pairs)
+
+    def _get_zone_pair_config(self, zone_pair):
+        """return the policies element of a single zone pair (or the global element), None if it is gone"""
+
+        if zone_pair == self.GLOBAL_ZONE_PAIR:
+            e_filter = '<global />'
+        else:
+            e_filter = '<policy><from-zone-name>{0}</from-zone-name><to-zone-name>{1}</to-zone-name></policy>'.format(
+                escape(zone_pair[0]), escape(zone_pair[1]))
+        configuration = self.device.rpc.get_config(filter_xml=letree.XML(
+            '<configuration><security><policies>{0}</policies></security></configuration>'.format(e_filter)),
+            options=self.CONFIG_OPTIONS)
+        zone_set = configuration.find(
+            'security/policies/' + ('global' if zone_pair == self.GLOBAL_ZONE_PAIR else 'policy'))
+        if zone_set is None or is_inactive(zone_set):
+            return None
+        return strip_inactive(zone_set)
+
+    def _config_section(self, configuration, key):
+        """
+        return a config section of a configuration element, an empty one if the device has none
+
+        Deactivated statements are left out, an inactive section is empty.
+        """
+        path, tag = self.CONFIG_SECTION_PATHS[key]
+        section = configuration.find(path)
+        if section is None or is_inactive(section):
+            section = letree.Element(tag)
+        return strip_inactive(section)
+
+    def _get_config_section(self, key):
+        """
+        get a single config section from the device, see CONFIG_SECTION_FILTERS
+        """
+        configuration = self.device.rpc.get_config(filter_xml=letree.XML(self.CONFIG_SECTION_FILTERS[key]),
+                                                   options=self.CONFIG_OPTIONS)
+        return self._config_section(configuration, key)
+
     def _get_config(self):
         """
         get the config from the device and store it
+
+        The sections are pulled in a single rpc and kept as the lxml elements of the reply.
+        In streaming mode the config is pulled by _parse_config instead.
         """
-        # TODO: fix this xml library conversion nonsense
-        # get config sections
+        if self.streaming:
+            return
+
+        configuration = self.device.rpc.get_config(filter_xml=letree.XML(self.CONFIG_FILTER),
+                                                   options=self.CONFIG_OPTIONS)
+        for key in self.CONFIG_SECTION_FILTERS.keys():
+            self.config_output[key] = self._config_section(configuration, key)
 
-        # TODO: needs xml refactoring
-        self.config_output['policies'] = ET.fromstring(letree.tostring(self.device.rpc.get_config(
-            filter_xml=letree.XML('<configuration><security><policies></policies></security></configuration>'))))[0][0]
+    def _model_state(self):
+        """lxml elements do not pickle, the config sections are cached as xml text"""
 
-        # TODO: needs xml refactoring
-        self.config_output['address_book'] = ET.fromstring(letree.tostring(self.device.rpc.get_config(
-            filter_xml=letree.XML(
-                '<configuration><security><address-book><global /></address-book></security></configuration>'))))[0][0]
+        state = super(JuniperSRXDriver, self)._model_state()
+        state['config_output'] = dict((key, letree.tostring(e)) for key, e in self.config_output.iteritems())
+        return state
 
-        # TODO: needs xml refactoring
-        self.config_output['output_junos_default'] = ET.fromstring(letree.tostring(self.device.rpc.get_config(
-            filter_xml=letree.XML(
-                '<configuration><groups><name>junos-defaults</name><applications></applications></groups></configuration>'))))[
-            0].find('applications')
+    def _set_model_state(self, state):
+        """parse the cached config sections back into elements"""
 
-        # TODO: needs xml refactoring
-        self.config_output['output_applications'] = ET.fromstring(letree.tostring(self.device.rpc.get_config(
-            filter_xml=letree.XML('<configuration><applications></applications></configuration>'))))[0]
+        state = dict(state)
+        state['config_output'] = dict((key, letree.fromstring(xml))
+                                      for key, xml in state.get('config_output', {}).iteritems())
+        super(JuniperSRXDriver, self)._set_model_state(state)
+
+    def _parse_config(self):
+        """
+        parse the config, element by element straight off the config source in streaming mode
+        """
+        if not self.streaming:
+            return super(JuniperSRXDriver, self)._parse_config()
+
+        self._parse_config_events(self._config_events())
+
+    def _config_events(self):
+        """
+        return an iterator of ('end', element) events over the config, see _parse_config_events
+        """
+        configuration = self.device.rpc.get_config(filter_xml=letree.XML(self.CONFIG_FILTER),
+                                                   options=self.CONFIG_OPTIONS)
+        return letree.iterwalk(configuration, events=('end',))
+
+    @staticmethod
+    def _is_top_level(e, *tags):
+        """true if the ancestors of e are the given tags, innermost first, up to the configuration element"""
+        for tag in tags + ('configuration',):
+            e = e.getparent()
+            if e is None or e.tag != tag:
+                return False
+        return True
+
+    def _parse_config_events(self, events):
+        """Build the model from 'end' events of the config elements, releasing every subtree once consumed
+
+        Addresses, services and their groups are parsed as their elements end, policies are built as
+        their elements end but only linked to the objects they reference once the whole config was read,
+        as the applications come after the security policies in the config. Nothing is kept in config_output.
+        """
+
+        pending = []
+        for _, e in events:
+            parent = e.getparent()
+            if parent is None or not isinstance(e.tag, basestring):
+                continue
+            tag = e.tag
+            if tag in ('address', 'address-set') and parent.tag == 'address-book':
+                if parent.findtext('name') != 'global' or not self._is_top_level(parent, 'security'):
+                    continue
+                if is_inactive(e):
+                    pass
+                elif tag == 'address':
+                    self._parse_address(strip_inactive(e))
+                else:
+                    self._parse_address_set(strip_inactive(e))
+            elif tag in ('application', 'application-set') and parent.tag == 'applications':
+                grandparent = parent.getparent()
+                if grandparent is None:
+                    continue
+                if grandparent.tag == 'groups':
+                    if grandparent.findtext('name') != 'junos-defaults' or not self._is_top_level(grandparent):
+                        continue
+                elif grandparent.tag != 'configuration':
+                    continue
+                if is_inactive(e):
+                    pass
+                elif tag == 'application':
+                    self._parse_application(strip_inactive(e))
+                else:
+                    self._parse_application_set(strip_inactive(e))
+            elif tag == 'policy' and parent.tag in ('policy', 'global'):
+                if not self._is_top_level(parent, 'policies', 'security'):
+                    continue
+                if not is_inactive(e):
+                    pending.append(self._parse_policy(strip_inactive(e), self._zone_set_pair(parent)))
+            elif parent.tag != 'configuration':
+                # part of an entry still being read, or of a hierarchy released as a whole
+                continue
+
+            # release the consumed subtree, and the empty shell of the entry before it
+            e.clear()
+            previous = e.getprevious()
+            if previous is not None and previous.tag == tag and len(previous) == 0:
+                parent.remove(previous)
+
+        self._add_any_address()
+        for policy, references in pending:
+            self._link_policy(policy, references)
+            self._add_policy(policy)
+
+        self.config_output = dict()
 
     def _parse_addresses(self):
         """
@@ -203,23 +755,39 @@ class JuniperSRXDriver(BaseDriver):
         addresses = self.config_output['address_book']
 
         for e_address in addresses.findall('address'):
-            name = value = a_type = None
-            for e in list(e_address):
-                if e.tag == 'name':
-                    name = e.text
-                elif e.tag == 'ip-prefix':
-                    value = e.text
-                    a_type = JuniperSRXAddress.AddressTypes.IPv4
-                elif e.tag == 'dns-name':
-                    value = e.find('name').text
-                    a_type = JuniperSRXAddress.AddressTypes.DNS
-                else:
-                    pass
+            self._parse_address(e_address)
 
-            address = JuniperSRXAddress(name, value, a_type)
-            self.address_name_lookup[name] = address
-            self.address_value_lookup[value].append(address)
+        self._add_any_address()
 
+    def _parse_address(self, e_address):
+        """
+        parse a single address element
+        """
+        name = value = a_type = None
+        for e in list(e_address):
+            if e.tag == 'name':
+                name = e.text
+            elif e.tag == 'ip-prefix':
+                value = e.text
+                a_type = JuniperSRXAddress.AddressTypes.IPv4
+            elif e.tag == 'dns-name':
+                value = e.find('name').text
+                a_type = JuniperSRXAddress.AddressTypes.DNS
+            elif e.tag == 'range-address':
+                # <name>low</name><to><range-high>high</range-high></to>, low/high in parsed set configs
+                low = e.findtext('low') or e.findtext('name')
+                high = e.findtext('high') or e.findtext('to/range-high')
+                if low and high:
+                    value = '{0}-{1}'.format(low, high)
+                    a_type = JuniperSRXAddress.AddressTypes.RANGE
+            else:
+                pass
+
+        address = JuniperSRXAddress(name, value, a_type)
+        self.address_name_lookup[name] = address
+        self.address_value_lookup[value].append(address)
+
+    def _add_any_address(self):
         # special case: manually create "any" address
         any_address = JuniperSRXAddress("any", "any", 1)
         self.address_name_lookup['any'] = any_address
@@ -234,21 +802,27 @@ class JuniperSRXDriver(BaseDriver):
         address_sets = self.config_output['address_book']
 
         for e_address_set in address_sets.findall('address-set'):
-            name = e_address_set.find('name').text
-            address_set = JuniperSRXAddressGroup(name)
-            value_lookup_list = []
-            for e in e_address_set.findall('address'):
-                a = e.find('name').text
-                a_obj = self._address_lookup_by_name(a)
-                address_set.add(a_obj)
-                value_lookup_list.append(a_obj)
-                # self.address_group_value_lookup[a].append(address_set)
+            self._parse_address_set(e_address_set)
 
-            # set the address value lookup to the value of all addresses in the group
-            # self.address_value_lookup[[a.value for a in value_lookup_list]].append(address_set)
+    def _parse_address_set(self, e_address_set):
+        """
+        parse a single address-set element, its addresses have to be parsed already
+        """
+        name = e_address_set.find('name').text
+        address_set = JuniperSRXAddressGroup(name)
+        value_lookup_list = []
+        for e in e_address_set.findall('address'):
+            a = e.find('name').text
+            a_obj = self._address_lookup_by_name(a)
+            address_set.add(a_obj)
+            value_lookup_list.append(a_obj)
+            # self.address_group_value_lookup[a].append(address_set)
+
+        # set the address value lookup to the value of all addresses in the group
+        # self.address_value_lookup[[a.value for a in value_lookup_list]].append(address_set)
 
-            # set he address group name lookup
-            self.address_group_name_lookup[name] = address_set
+        # set he address group name lookup
+        self.address_group_name_lookup[name] = address_set
 
     def _parse_services(self):
         """
@@ -259,54 +833,60 @@ class JuniperSRXDriver(BaseDriver):
 
         for applications in [self.config_output['output_junos_default'], self.config_output['output_applications']]:
             for e_application in applications.findall('application'):
-                s_name = e_application.find('name').text
-                if s_name == 'any':
-                    # special case: manually build the any object
-                    any_service = JuniperSRXService(s_name, 'any', 'any')
-                    self.service_value_lookup[('any', 'any')].append(any_service)
-                    self.service_name_lookup[s_name] = any_service
-                    continue
-                port = None
-                if e_application.find('term') is not None:
-                    # term based application
-                    service = JuniperSRXService(s_name)
-                    value_lookup_list = []
-                    for e_term in e_application.findall('term'):
-                        t_name = e_term.find('name').text
-                        protocol = e_term.find('protocol').text
-                        if protocol == 'icmp':
-                            icmp_type = icmp_code = 'unknown'
-                            if e_term.find('icmp-type') is not None:
-                                icmp_type = e_term.find('icmp-type').text
-                            if e_term.find('icmp-code') is not None:
-                                icmp_code = e_term.find('icmp-code').text
-                            port = ",".join([icmp_type, icmp_code])
-                        elif e_term.find('destination-port') is not None:
-                            port = e_term.find('destination-port').text
-                        term = BaseServiceTerm(t_name, protocol, port)
-                        service.add_term(term)
-                        if isinstance(port, BasePortRange):
-                            # reset the port value to insert into the lookup dictionary
-                            port = port.value
-                        value_lookup_list.append((protocol, port))
-                    # set the lookup value to the list of all actual services
-                    # self.service_value_lookup[value_lookup_list].append(service)
-                else:
-                    # regular application
-                    protocol = e_application.find('protocol').text
-                    if protocol == 'icmp':
-                        icmp_type = icmp_code = 'unknown'
-                        if e_term.find('icmp-type') is not None:
-                            icmp_type = e_term.find('icmp-type').text
-                        if e_term.find('icmp-code') is not None:
-                            icmp_code = e_term.find('icmp-code').text
-                        port = ",".join([icmp_type, icmp_code])
-                    if e_application.find('destination-port') is not None:
-                        port = e_application.find('destination-port').text
-                    service = JuniperSRXService(s_name, protocol, port)
-                    self.service_value_lookup[(protocol, port)].append(service)
-
-                self.service_name_lookup[s_name] = service
+                self._parse_application(e_application)
+
+    def _parse_application(self, e_application):
+        """
+        parse a single application element
+        """
+        s_name = e_application.find('name').text
+        if s_name == 'any':
+            # special case: manually build the any object
+            any_service = JuniperSRXService(s_name, 'any', 'any')
+            self.service_value_lookup[('any', 'any')].append(any_service)
+            self.service_name_lookup[s_name] = any_service
+            return
+        port = None
+        if e_application.find('term') is not None:
+            # term based application
+            service = JuniperSRXService(s_name)
+            value_lookup_list = []
+            for e_term in e_application.findall('term'):
+                t_name = e_term.find('name').text
+                protocol = e_term.find('protocol').text
+                if protocol == 'icmp':
+                    icmp_type = icmp_code = 'unknown'
+                    if e_term.find('icmp-type') is not None:
+                        icmp_type = e_term.find('icmp-type').text
+                    if e_term.find('icmp-code') is not None:
+                        icmp_code = e_term.find('icmp-code').text
+                    port = ",".join([icmp_type, icmp_code])
+                elif e_term.find('destination-port') is not None:
+                    port = e_term.find('destination-port').text
+                term = BaseServiceTerm(t_name, protocol, port)
+                service.add_term(term)
+                if isinstance(port, BasePortRange):
+                    # reset the port value to insert into the lookup dictionary
+                    port = port.value
+                value_lookup_list.append((protocol, port))
+            # set the lookup value to the list of all actual services
+            # self.service_value_lookup[value_lookup_list].append(service)
+        else:
+            # regular application
+            protocol = e_application.find('protocol').text
+            if protocol == 'icmp':
+                icmp_type = icmp_code = 'unknown'
+                if e_application.find('icmp-type') is not None:
+                    icmp_type = e_application.find('icmp-type').text
+                if e_application.find('icmp-code') is not None:
+                    icmp_code = e_application.find('icmp-code').text
+                port = ",".join([icmp_type, icmp_code])
+            if e_application.find('destination-port') is not None:
+                port = e_application.find('destination-port').text
+            service = JuniperSRXService(s_name, protocol, port)
+            self.service_value_lookup[(protocol, port)].append(service)
+
+        self.service_name_lookup[s_name] = service
 
     def _parse_service_groups(self):
         """
@@ -316,69 +896,135 @@ class JuniperSRXDriver(BaseDriver):
         # rpc-reply > configuration > applications
         for application_sets in [self.config_output['output_junos_default'], self.config_output['output_applications']]:
             for e_service_set in application_sets.findall('application-set'):
-                name = e_service_set.find('name').text
-                service_group = JuniperSRXServiceGroup(name)
-                value_lookup_list = []
-                for e_application in e_service_set.findall('application'):
-                    s = e_application.find('name').text
-                    s_obj = self._service_lookup_by_name(s)
-                    service_group.add(s_obj)
-                    value_lookup_list.append(s_obj)
-                    # self.service_group_value_lookup[a].append(service_group)
-
-                # set the service object lookup value to the value of all containing services
-                # self.service_value_lookup[[s.value for s in value_lookup_list]].append(service_group)
-
-                # service group name lookup
-                self.service_group_name_lookup[name] = service_group
+                self._parse_application_set(e_service_set)
+
+    def _parse_application_set(self, e_service_set):
+        """
+        parse a single application-set element, its applications have to be parsed already
+        """
+        name = e_service_set.find('name').text
+        service_group = JuniperSRXServiceGroup(name)
+        value_lookup_list = []
+        for e_application in e_service_set.findall('application'):
+            s = e_application.find('name').text
+            s_obj = self._find_service(s)
+            service_group.add(s_obj)
+            value_lookup_list.append(s_obj)
+            # self.service_group_value_lookup[a].append(service_group)
+
+        # set the service object lookup value to the value of all containing services
+        # self.service_value_lookup[[s.value for s in value_lookup_list]].append(service_group)
+
+        # service group name lookup
+        self.service_group_name_lookup[name] = service_group
+
+    def _find_service(self, name):
+        """
+        find a service (set) by name, a stand-in when the parsed config does not define it
+
+        'any' and the junos-* applications are defined by the junos-defaults group, which saved configs
+        rarely hold. 'any' stands in as any protocol and port, any other application as an unknown
+        protocol, which matches no flow.
+        """
+        service = self.get_service_object_by_name(name)
+        if service is None:
+            service = self._unresolved_services.get(name)
+            if service is None:
+                if name == 'any':
+                    service = JuniperSRXService(name, 'any', 'any')
+                else:
+                    service = JuniperSRXService(name)
+                self._unresolved_services[name] = service
+        return service
 
     def _parse_policies(self):
         """
         retrieve and parse polices
         """
 
+        self.zone_pair_policies = OrderedDict()
+        self.global_policies = list()
+        self._zone_pair_indexes = dict()
+        self._zone_pair_evaluators = dict()
+
         for e_zone_set in list(self.config_output['policies']):
-            if e_zone_set.tag == 'policy':
-                # regular policy zone set
-                from_zone = e_zone_set.find('from-zone-name').text
-                to_zone = e_zone_set.find('to-zone-name').text
-            elif e_zone_set.tag == 'global':
-                # global policies
-                from_zone = to_zone = 'global'
-            else:
+            zone_pair = self._zone_set_pair(e_zone_set)
+            if zone_pair is None:
                 # not a policy type element
                 continue
-            action = None
-            logging = []
-            for e_policy in e_zone_set.findall('policy'):
-                name = e_policy.find('name').text
-                description = e_policy.find('description')
-                if description is not None:
-                    description = description.text
-                for e_then in list(e_policy.find('then')):
-                    if e_then.tag in ['permit', 'deny', 'reject']:
-                        action = JuniperSRXPolicy.ActionMap[e_then.tag]
-                    elif e_then.tag == 'log':
-                        for e_log in e_then:
-                            logging.append(JuniperSRXPolicy.LoggingMap[e_log.tag])
-                    else:
-                        # currently unsupported element
-                        pass
-                policy = JuniperSRXPolicy(name, action, description, logging)
-                policy.add_src_zone(from_zone)
-                policy.add_dst_zone(to_zone)
-                e_match = e_policy.find('match')
-                for e_type in ['source-address', 'destination-address', 'application']:
-                    for e in e_match.findall(e_type):
-                        if e_type == 'source-address':
-                            policy.add_src_address(self.get_address_object_by_name(e.text))
-                        elif e_type == 'destination-address':
-                            policy.add_dst_address(self.get_address_object_by_name(e.text))
-                        elif e_type == 'application':
-                            policy.add_service(self.get_service_object_by_name(e.text))
-
+            for policy in self._parse_zone_set(e_zone_set, zone_pair):
                 self._add_policy(policy)
 
+    @staticmethod
+    def _zone_set_pair(e_zone_set):
+        """return the (from zone, to zone) of a policies child element, None if it holds no policies"""
+        if e_zone_set.tag == 'policy':
+            # regular policy zone set
+            return e_zone_set.find('from-zone-name').text, e_zone_set.find('to-zone-name').text
+        elif e_zone_set.tag == 'global':
+            # global policies
+            return 'global', 'global'
+        return None
+
+    def _parse_zone_set(self, e_zone_set, zone_pair):
+        """
+        parse the policies of a zone pair element, in rule order
+        """
+
+        policies = []
+        for e_policy in e_zone_set.findall('policy'):
+            policy, references = self._parse_policy(e_policy, zone_pair)
+            self._link_policy(policy, references)
+            policies.append(policy)
+
+        return policies
+
+    def _parse_policy(self, e_policy, zone_pair):
+        """
+        parse a single policy element of a zone pair
+
+        :returns a (policy, references) tuple, the references are the (match element tag, object name)
+            of the addresses and applications the policy matches, see _link_policy
+        """
+        from_zone, to_zone = zone_pair
+        action = None
+        logging = []
+        name = e_policy.find('name').text
+        description = e_policy.find('description')
+        if description is not None:
+            description = description.text
+        for e_then in list(e_policy.find('then')):
+            if e_then.tag in ['permit', 'deny', 'reject']:
+                action = JuniperSRXPolicy.ActionMap[e_then.tag]
+            elif e_then.tag == 'log':
+                for e_log in e_then:
+                    logging.append(JuniperSRXPolicy.LoggingMap[e_log.tag])
+            else:
+                # currently unsupported element
+                pass
+        policy = JuniperSRXPolicy(name, action, description, logging)
+        policy.add_src_zone(from_zone)
+        policy.add_dst_zone(to_zone)
+        e_match = e_policy.find('match')
+        references = []
+        for e_type in ['source-address', 'destination-address', 'application']:
+            for e in e_match.findall(e_type):
+                references.append((e_type, e.text))
+
+        return policy, references
+
+    def _link_policy(self, policy, references):
+        """
+        add the objects a policy references to it, see _parse_policy
+        """
+        for e_type, name in references:
+            if e_type == 'source-address':
+                policy.add_src_address(self.get_address_object_by_name(name))
+            elif e_type == 'destination-address':
+                policy.add_dst_address(self.get_address_object_by_name(name))
+            elif e_type == 'application':
+                policy.add_service(self._find_service(name))
+
     def _parse_applications(self):
         # we don't do applications for SRX
         pass
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+import os
+
+from lxml import etree as letree
+
+from orangengine.drivers.juniper_srx import JuniperSRXDriver
+from orangengine.utils import file_version
+from _juniper_utils import parse_set_config
+
+
+class JuniperSRXFileDriver(JuniperSRXDriver):
+    """
+    Juniper SRX driver reading a saved config file instead of the device
+
+    The file is either a "show configuration | display xml" dump (or a saved get-config reply) or
+    "show configuration | display set" output, told apart by its first character unless config_format
+    is given. The junos-defaults applications are only known if the file holds the junos-defaults group,
+    otherwise they are stand-ins, see JuniperSRXDriver._find_service.
+    With streaming, xml files are parsed with lxml iterparse and never held in memory as a whole, set
+    files are read line by line and only the parsed hierarchies are kept until parsed.
+    """
+
+    FORMATS = ('xml', 'set')
+
+    def __init__(self, *args, **kwargs):
+
+        self.config_file = kwargs.pop('config_file')
+        self.config_format = kwargs.pop('config_format', None) or self._detect_format(self.config_file)
+        if self.config_format not in self.FORMATS:
+            raise ValueError("unknown config format {0}".format(self.config_format))
+
+        # there is no device to log into, the file stands in for the host
+        kwargs.setdefault('username', None)
+        kwargs.setdefault('password', None)
+        kwargs.setdefault('host', os.path.abspath(self.config_file))
+
+        super(JuniperSRXFileDriver, self).__init__(*args, **kwargs)
+
+    @staticmethod
+    def _detect_format(path):
+        """return 'xml' if the first non blank character of the file opens a tag, 'set' otherwise"""
+        with open(path, 'rb') as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    return 'xml' if line.startswith('<') else 'set'
+        return 'set'
+
+    def open_connection(self, *args, **kwargs):
+        # nothing to connect to
+        self._connected = True
+
+    def refresh(self, incremental=False):
+        """Parse the config file again
+
+        There is no commit history to tell what changed, so the whole file is parsed every time.
+        """
+        super(JuniperSRXDriver, self).refresh()
+
+    def _config_version(self):
+        """the modification time and size of the config file"""
+        return file_version(self.config_file)
+
+    def _read_configuration(self):
+        """return the configuration element of the file"""
+
+        if self.config_format == 'set':
+            with open(self.config_file, 'rb') as f:
+                return parse_set_config(f)
+
+        root = letree.parse(self.config_file, letree.XMLParser(remove_comments=True, huge_tree=True)).getroot()
+        for e in root.iter(tag=letree.Element):
+            e.tag = letree.QName(e).localname
+        if root.tag == 'configuration':
+            return root
+        return root.find('.//configuration')
+
+    def _get_config(self):
+        """
+        read the config sections from the file
+        """
+        if self.streaming:
+            return
+
+        configuration = self._read_configuration()
+        for key in self.CONFIG_SECTION_FILTERS.keys():
+            self.config_output[key] = self._config_section(configuration, key)
+
+    def _config_events(self):
+        """
+        iterparse the xml file, or walk the configuration of the set file
+        """
+        if self.config_format == 'set':
+            return letree.iterwalk(self._read_configuration(), events=('end',))
+        return self._iterparse_events()
+
+    def _iterparse_events(self):
+        """yield the 'end' events of the xml file, with the namespaces stripped from the tags"""
+        for event, e in letree.iterparse(self.config_file, events=('start', 'end'), remove_comments=True,
+                                         huge_tree=True):
+            if not isinstance(e.tag, basestring):
+                continue
+            if event == 'start':
+                # renamed on start, so the tags of the ancestors are local at the end of their children
+                e.tag = letree.QName(e).localname
+            else:
+                yield event, e
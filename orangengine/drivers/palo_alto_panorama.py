@@ -8,8 +8,13 @@ from orangengine.models.paloalto import PaloAltoServiceGroup
 from orangengine.models.paloalto import PaloAltoApplication
 from orangengine.models.paloalto import PaloAltoApplicationGroup
 from orangengine.models.base import CandidatePolicy
-from orangengine.utils import missing_cidr
+from orangengine.utils import missing_cidr, file_version
 from orangengine.errors import BadCandidatePolicyError
+from orangengine.index import PolicyIndex, FlowEvaluator
+from orangengine.analysis import Snapshot
+from _palo_alto_utils import parse_xml_file, predefined_entries, security_rule_entry
+from _palo_alto_utils import address_entry, address_group_entry, service_entry, service_group_entry
+from _palo_alto_utils import application_entry, application_group_entry
 
 from pandevice import panorama
 from pandevice import objects
@@ -17,6 +22,7 @@ from pandevice import policies
 
 from collections import defaultdict
 import json
+import os
 
 
 class PaloAltoPanoramaDriver(PaloAltoBaseDriver):
@@ -27,11 +33,42 @@ class PaloAltoPanoramaDriver(PaloAltoBaseDriver):
     # true. Please remember this later... it took a while to figure this out the first time John...
     # when doing a lookup, start with the local context and go up the tree
 
+    MODEL_ATTRIBUTES = PaloAltoBaseDriver.MODEL_ATTRIBUTES + (
+        'dg_hierarchy',
+    )
+
+    # pandevice class -> (tag of its entries in config xml, stand-in parser), for configs read from files
+    XML_ENTRY_TYPES = {
+        objects.AddressObject: ('address', address_entry),
+        objects.AddressGroup: ('address-group', address_group_entry),
+        objects.ServiceObject: ('service', service_entry),
+        objects.ServiceGroup: ('service-group', service_group_entry),
+        objects.ApplicationObject: ('application', application_entry),
+        objects.ApplicationGroup: ('application-group', application_group_entry),
+    }
+
     def __init__(self, *args, **kwargs):
         """
         We need additional information for this driver
+
+        With config_file, the exported running config of a Panorama (and, with predefined_file,
+        its predefined content) is parsed straight into the models without a device connection
+        or pandevice objects. Meant for offline analysis, nothing can be applied in this mode.
         """
 
+        self.config_file = kwargs.pop('config_file', None)
+        self.predefined_file = kwargs.pop('predefined_file', None)
+        if self.config_file is not None:
+            # there is no device to log into, the file stands in for the host
+            kwargs.setdefault('username', None)
+            kwargs.setdefault('password', None)
+            kwargs.setdefault('host', os.path.abspath(self.config_file))
+        # predefined (applications, application containers) of a predefined_file
+        self._predefined = None
+        self._builtins = None
+        # name -> stand-in of an application no config defines, see _find_application
+        self._unresolved_applications = dict()
+
         # now call the super
         super(PaloAltoPanoramaDriver, self).__init__(*args, **kwargs)
 
@@ -54,21 +91,130 @@ class PaloAltoPanoramaDriver(PaloAltoBaseDriver):
             return self.dg_context
 
     def policy_match(self, match_criteria, match_containing_networks=True, exact=False, policies=None,
-                     device_group=None, include_parents=True):
+                     device_group=None, include_parents=True, match_containing_services=False):
         """Policy Match
 
         Overriden to allow passing an optional device group context which defaults to the shared
         namespace.
         """
         context = self._get_context(device_group)
+        index = None
         if not policies:
-            policies = context.get_rulebase(include_parents)
+            index = context.get_policy_index(include_parents, self.vectorized)
+            policies = index.policies
 
         # now call the super to actually do the work
-        matches = super(PaloAltoPanoramaDriver, self).policy_match(match_criteria, match_containing_networks=True,
-                                                                   exact=False, policies=policies)
+        matches = self._policy_match(match_criteria, match_containing_networks=True, exact=False, policies=policies,
+                                     index=index, match_containing_services=match_containing_services)
         return matches
 
+    def iter_policy_match(self, criteria_list, match_containing_networks=True, exact=False, policies=None,
+                          device_group=None, include_parents=True, match_containing_services=False):
+        """Batch Policy Match
+
+        Overriden to resolve the device group context and its rulebase index once for the whole batch.
+        """
+        context = self._get_context(device_group)
+        if policies:
+            index = PolicyIndex(policies, self.vectorized)
+        else:
+            index = context.get_policy_index(include_parents, self.vectorized)
+
+        for match_criteria in criteria_list:
+            # same as policy_match, always match containing networks
+            matches = self._policy_match(match_criteria, match_containing_networks=True, exact=False,
+                                         policies=index.policies, index=index,
+                                         match_containing_services=match_containing_services)
+            yield match_criteria, matches
+
+    def flow_match(self, src_zone, dst_zone, src_ip, dst_ip, protocol, port, device_group=None):
+        """Flow Match
+
+        Overriden to evaluate the flow against the rulebase a device in the device group context
+        would evaluate: every pre rulebase from shared down, then every post rulebase from the
+        device group back up to shared.
+        """
+        context = self._get_context(device_group)
+        evaluator = context.get_flow_evaluator(self.vectorized)
+        return evaluator.evaluate(src_zone, dst_zone, src_ip, dst_ip, protocol, port)
+
+    def flow_match_batch(self, flows, device_group=None):
+        """Batch Flow Match
+
+        Overriden to evaluate the flows against the rulebase of the device group context, see flow_match.
+        """
+        return self._get_context(device_group).get_flow_evaluator(self.vectorized).evaluate_batch(flows)
+
+    def get_flow_rulebase(self, device_group=None):
+        """Flow Rulebase
+
+        Overriden to return the evaluation rulebase of the device group context.
+        """
+        return self._get_context(device_group).get_evaluation_rulebase()
+
+    def prepare_flow_match(self, device_group=None):
+        """Prepare Flow Match
+
+        Overriden to build the flow evaluator of the device group context.
+        """
+        self._get_context(device_group).get_flow_evaluator(self.vectorized)
+
+    def find_duplicate_policies(self, policies=None, device_group=None):
+        """Find Duplicate Policies
+
+        Overriden to look for duplicates in the evaluation rulebase of the device group context.
+        """
+        if not policies:
+            policies = self.get_flow_rulebase(device_group)
+
+        return super(PaloAltoPanoramaDriver, self).find_duplicate_policies(policies)
+
+    def fingerprint_policies(self, policies=None):
+        """Fingerprint Policies
+
+        Overriden to default to the policies of every device group, so the same rule defined in
+        several device groups shares a fingerprint.
+        """
+        if not policies:
+            policies = []
+            for node in self.dg_hierarchy.get_all_nodes():
+                policies.extend(node.get_rulebase(include_parents=False))
+
+        return super(PaloAltoPanoramaDriver, self).fingerprint_policies(policies)
+
+    def snapshot(self):
+        """Snapshot
+
+        Overriden to snapshot the objects and the pre and post rulebases of every device group
+        in their own namespace.
+        """
+        snapshot = Snapshot()
+        if self.dg_hierarchy is None:
+            return snapshot
+
+        for name, node in self.dg_hierarchy.lookup.iteritems():
+            for object_type, objects_key in [('address', 'addresses'), ('address_group', 'address_groups'),
+                                             ('service', 'services'), ('service_group', 'service_groups'),
+                                             ('application', 'applications'),
+                                             ('application_group', 'application_groups')]:
+                for obj in node.objects[objects_key]:
+                    snapshot.add_object(name, object_type, obj)
+            for rulebase in ['pre_rulebase', 'post_rulebase']:
+                for p in node.objects[rulebase]:
+                    snapshot.add_policy((name, rulebase), p)
+        return snapshot
+
+    def find_shadowed_policies(self, policies=None, device_group=None):
+        """Find Shadowed Policies
+
+        Overriden to analyze the evaluation rulebase of the device group context, so policies
+        can be covered by the pre rules of parent device groups and cover their post rules.
+        """
+        if not policies:
+            policies = self.get_flow_rulebase(device_group)
+
+        return super(PaloAltoPanoramaDriver, self).find_shadowed_policies(policies)
+
     def candidate_policy_match(self, match_criteria, policies=None, device_group=None, include_parents=True,
                                post_rulebase=True):
         """Policy Match
@@ -176,122 +322,264 @@ class PaloAltoPanoramaDriver(PaloAltoBaseDriver):
 
         return linked_objects
 
+    def open_connection(self, *args, **kwargs):
+        if self.config_file is not None:
+            # nothing to connect to
+            self._connected = True
+            return
+        super(PaloAltoPanoramaDriver, self).open_connection(*args, **kwargs)
+
+    def _config_version(self):
+        """the id of the last finished commit job, or the version of the config files"""
+        if self.config_file is not None:
+            return file_version(*filter(None, [self.config_file, self.predefined_file]))
+
+        jobs = self.device.op('<show><jobs><all></all></jobs></show>', cmd_xml=False)
+        commits = [int(job.findtext('id')) for job in jobs.findall('result/job')
+                   if job.findtext('type') == 'Commit' and job.findtext('status') == 'FIN']
+        if not commits:
+            return None
+        return str(max(commits))
+
     def _get_config(self):
         """refresh the pandevice object and create the device group hierarchy"""
 
+        if self.config_file is not None:
+            config = parse_xml_file(self.config_file)
+            if config.tag != 'config':
+                # an api response
+                config = config.find('.//config')
+            self.dg_hierarchy = _DeviceGroupHierarchy.from_config(config)
+            self._predefined = ([], [])
+            if self.predefined_file is not None:
+                self._predefined = predefined_entries(parse_xml_file(self.predefined_file))
+            return
+
         # now call the super
         super(PaloAltoPanoramaDriver, self)._get_config()
 
         dg_xml = self.device.op('<show><dg-hierarchy></dg-hierarchy></show>', cmd_xml=False)
         self.dg_hierarchy = _DeviceGroupHierarchy(self.device, dg_xml)
 
-    def _parse_addresses(self):
-        """retrieve all the pandevice.objects.AddressObjects's and parse them and store in the dg node"""
+    def _parse_config(self):
+        """parse the device groups level by level, then drop the xml of a config read from a file
 
-        # create the "any" object
-        any_address_pandevice_obj = objects.AddressObject()
-        any_address_pandevice_obj.name = 'any'
-        any_address_pandevice_obj.type = 'any'
-        any_address_pandevice_obj.value = 'any'
-        any_address = PaloAltoAddress(any_address_pandevice_obj)
+        Every device group only looks up objects in itself and its parents, so the device groups are
+        parsed one by one into their own node, every level of the hierarchy after the level above it.
+        """
 
-        for dg_node in self.dg_hierarchy.get_all_nodes():
-            for a in dg_node.device_group.findall(objects.AddressObject):
-                dg_node.insert(PaloAltoAddress(a))
+        self._builtins = None
+        self._unresolved_applications = dict()
+        for level in self.dg_hierarchy.get_levels():
+            for dg_node in level:
+                self._parse_device_group(dg_node)
+        self._builtins = None
+
+        if self.config_file is not None:
+            for dg_node in self.dg_hierarchy.get_all_nodes():
+                dg_node.config = None
+            self._predefined = None
+
+    def _entries(self, dg_node, pandevice_cls):
+        """return the pandevice objects of a type in a device group, their stand-ins for a config file"""
+
+        if self.config_file is None:
+            return dg_node.device_group.findall(pandevice_cls)
+
+        if dg_node.config is None:
+            return []
+        tag, parse = self.XML_ENTRY_TYPES[pandevice_cls]
+        return [parse(e) for e in dg_node.config.iterfind(tag + '/entry')]
+
+    def _security_rules(self, dg_node):
+        """yield the (rulebase, security rule) of a device group, pre rulebase first, in rule order"""
+
+        if self.config_file is None:
+            for rulebase, rulebase_cls in [('pre_rulebase', policies.PreRulebase),
+                                           ('post_rulebase', policies.PostRulebase)]:
+                for pandevice_rulebase in dg_node.device_group.findall(rulebase_cls):
+                    for security_rule in pandevice_rulebase.findall(policies.SecurityRule):
+                        yield rulebase, security_rule
+            return
+
+        if dg_node.config is None:
+            return
+        for rulebase, tag in [('pre_rulebase', 'pre-rulebase'), ('post_rulebase', 'post-rulebase')]:
+            for e in dg_node.config.iterfind(tag + '/security/rules/entry'):
+                yield rulebase, security_rule_entry(e)
+
+    def _predefined_applications(self):
+        """return the predefined (applications, application containers)"""
+        if self.config_file is not None:
+            return self._predefined
+        return (self.device.predefined.application_objects.values(),
+                self.device.predefined.application_container_objects.values())
+
+    def _builtin_objects(self):
+        """return the objects every device group has but no config defines, created once per parse"""
+
+        if self._builtins is None:
+            # create the "any" objects
+            any_address_pandevice_obj = objects.AddressObject()
+            any_address_pandevice_obj.name = 'any'
+            any_address_pandevice_obj.type = 'any'
+            any_address_pandevice_obj.value = 'any'
+
+            any_service_pandevice_obj = objects.ServiceObject()
+            any_service_pandevice_obj.name = 'any'
+            any_service_pandevice_obj.protocol = 'any'
+            any_service_pandevice_obj.destination_port = 'any'
+
+            # create the "application-default" object
+            app_default_service_pan_obj = objects.ServiceObject()
+            app_default_service_pan_obj.name = 'application-default'
+
+            any_application_pandevice_obj = objects.ApplicationObject()
+            any_application_pandevice_obj.name = 'any'
+
+            self._builtins = {
+                'address': PaloAltoAddress(any_address_pandevice_obj),
+                'service': PaloAltoService(any_service_pandevice_obj),
+                'application_default': PaloAltoService(app_default_service_pan_obj),
+                'application': PaloAltoApplication(any_application_pandevice_obj),
+            }
+        return self._builtins
 
-            # add the "any" abject
-            dg_node.insert(any_address)
+    def _find_application(self, dg_node, name):
+        """find an application by name, a stand-in without default ports when no config defines it
+
+        Predefined applications are unknown when a config file is read without its predefined content,
+        the stand-in keeps their name in the policies and groups that reference them.
+        """
+        application = dg_node.find(name, PaloAltoApplication)
+        if application is None:
+            application = self._unresolved_applications.get(name)
+            if application is None:
+                application_pandevice_obj = objects.ApplicationObject()
+                application_pandevice_obj.name = name
+                application = self._unresolved_applications.setdefault(
+                    name, PaloAltoApplication(application_pandevice_obj))
+        return application
+
+    def _parse_addresses(self):
+        """retrieve all the pandevice.objects.AddressObjects's and parse them and store in the dg node"""
+        for dg_node in self.dg_hierarchy.get_all_nodes():
+            self._parse_node_addresses(dg_node)
 
     def _parse_address_groups(self):
         """retrieve all the pandevice.objects.AddressGroup's and parse them and store in the dg node"""
         for dg_node in self.dg_hierarchy.get_all_nodes():
-            for ag in dg_node.device_group.findall(objects.AddressGroup):
-                address_group = PaloAltoAddressGroup(ag)
-                if ag.static_value:
-                    for v in ag.static_value:
-                        # find and link the actual object
-                        address_group.add(dg_node.find(v, PaloAltoAddress))
-                else:
-                    address_group.dynamic_value = ag.dynamic_value
-                dg_node.insert(address_group)
+            self._parse_node_address_groups(dg_node)
 
     def _parse_services(self):
         """retrieve all the pandevice.objects.ServiceObject's and parse them and store in the dg node"""
-
-        # create the "any" object
-        any_service_pandevice_obj = objects.ServiceObject()
-        any_service_pandevice_obj.name = 'any'
-        any_service_pandevice_obj.protocol = 'any'
-        any_service_pandevice_obj.destination_port = 'any'
-        any_service = PaloAltoService(any_service_pandevice_obj)
-
-        # create the "application-default" object
-        app_default_service_pan_obj = objects.ServiceObject()
-        app_default_service_pan_obj.name = 'application-default'
-        app_default_service = PaloAltoService(app_default_service_pan_obj)
-
         for dg_node in self.dg_hierarchy.get_all_nodes():
-            for s in dg_node.device_group.findall(objects.ServiceObject):
-                dg_node.insert(PaloAltoService(s))
-
-            # add the "any" object
-            dg_node.insert(any_service)
-
-            # add the "application-default" object
-            dg_node.insert(app_default_service)
+            self._parse_node_services(dg_node)
 
     def _parse_service_groups(self):
         """retrieve all the pandevice.objects.ServiceGroup's and parse them and store in the dg node"""
         for dg_node in self.dg_hierarchy.get_all_nodes():
-            for sg in dg_node.device_group.findall(objects.ServiceGroup):
-                service_group = PaloAltoServiceGroup(sg)
-                for v in sg.value:
-                    # find and link the actual object
-                    service_group.add(dg_node.find(v, PaloAltoService))
-                dg_node.insert(service_group)
+            self._parse_node_service_groups(dg_node)
 
     def _parse_applications(self):
         """retrieve all the pandevice.objects.Application's and parse them and store in the dg node"""
+        for dg_node in self.dg_hierarchy.get_all_nodes():
+            self._parse_node_applications(dg_node)
 
-        # create the "any" object
-        any_application_pandevice_obj = objects.ApplicationObject()
-        any_application_pandevice_obj.name = 'any'
-        any_applciation = PaloAltoApplication(any_application_pandevice_obj)
+    def _parse_application_groups(self):
+        """retrieve all the pandevice.objects.ApplicationGroups's and parse them and store in the dg node"""
+        for dg_node in self.dg_hierarchy.get_all_nodes():
+            self._parse_node_application_groups(dg_node)
 
+    def _parse_policies(self):
+        """retrieve all the pandevice.policies.SecurityRule's and parse them and store in the dg node"""
         for dg_node in self.dg_hierarchy.get_all_nodes():
-            for app in dg_node.device_group.findall(objects.ApplicationObject):
-                dg_node.insert(PaloAltoApplication(app))
+            self._parse_node_policies(dg_node)
 
-            # add the "any" object
-            dg_node.insert(any_applciation)
+    def _parse_device_group(self, dg_node):
+        """parse the objects and policies of a single device group, its parents have to be parsed already"""
+        self._parse_node_addresses(dg_node)
+        self._parse_node_address_groups(dg_node)
+        self._parse_node_services(dg_node)
+        self._parse_node_service_groups(dg_node)
+        self._parse_node_applications(dg_node)
+        self._parse_node_application_groups(dg_node)
+        self._parse_node_policies(dg_node)
 
-        # now load the predefined applications into the shared namespace
-        for app in self.device.predefined.application_objects.values():
-            self.dg_hierarchy.root.insert(PaloAltoApplication(app))
+    def _parse_node_addresses(self, dg_node):
 
-    def _parse_application_groups(self):
-        """retrieve all the pandevice.objects.ApplicationGroups's and parse them and store in the dg node"""
-        for dg_node in self.dg_hierarchy.get_all_nodes():
+        for a in self._entries(dg_node, objects.AddressObject):
+            dg_node.insert(PaloAltoAddress(a))
 
-            # grab teh regular groups
-            for app_group in dg_node.device_group.findall(objects.ApplicationGroup):
-                application_group = PaloAltoApplicationGroup(app_group)
-                for app in app_group.value:
+        # add the "any" abject
+        dg_node.insert(self._builtin_objects()['address'])
+
+    def _parse_node_address_groups(self, dg_node):
+
+        for ag in self._entries(dg_node, objects.AddressGroup):
+            address_group = PaloAltoAddressGroup(ag)
+            if ag.static_value:
+                for v in ag.static_value:
                     # find and link the actual object
+                    address_group.add(dg_node.find(v, PaloAltoAddress))
+            else:
+                address_group.dynamic_value = ag.dynamic_value
+            dg_node.insert(address_group)
+
+    def _parse_node_services(self, dg_node):
+
+        for s in self._entries(dg_node, objects.ServiceObject):
+            dg_node.insert(PaloAltoService(s))
+
+        # add the "any" object
+        dg_node.insert(self._builtin_objects()['service'])
+
+        # add the "application-default" object
+        dg_node.insert(self._builtin_objects()['application_default'])
+
+    def _parse_node_service_groups(self, dg_node):
+
+        for sg in self._entries(dg_node, objects.ServiceGroup):
+            service_group = PaloAltoServiceGroup(sg)
+            for v in sg.value:
+                # find and link the actual object
+                service_group.add(dg_node.find(v, PaloAltoService))
+            dg_node.insert(service_group)
+
+    def _parse_node_applications(self, dg_node):
+
+        for app in self._entries(dg_node, objects.ApplicationObject):
+            dg_node.insert(PaloAltoApplication(app))
+
+        # add the "any" object
+        dg_node.insert(self._builtin_objects()['application'])
+
+        if dg_node is self.dg_hierarchy.root:
+            # now load the predefined applications into the shared namespace
+            for app in self._predefined_applications()[0]:
+                dg_node.insert(PaloAltoApplication(app))
+
+    def _parse_node_application_groups(self, dg_node):
+
+        # grab teh regular groups
+        for app_group in self._entries(dg_node, objects.ApplicationGroup):
+            application_group = PaloAltoApplicationGroup(app_group)
+            for app in app_group.value:
+                # find and link the actual object
+                application_group.add(self._find_application(dg_node, app))
+            dg_node.insert(application_group)
+
+        if dg_node is self.dg_hierarchy.root:
+            # now grab the application containers from the predefined area and store them in the shared namespace
+            for app_container in self._predefined_applications()[1]:
+                # app containers are semantically app groups
+                application_group = PaloAltoApplicationGroup(app_container)
+                for app in app_container.applications:
+                    # find and link the actual objects from the shared namespace
                     application_group.add(dg_node.find(app, PaloAltoApplication))
                 dg_node.insert(application_group)
 
-        # now grab the application containers from the predefined area and store them in the shared namespace
-        for app_container in self.device.predefined.application_container_objects.values():
-            # app containers are semantically app groups
-            application_group = PaloAltoApplicationGroup(app_container)
-            for app in app_container.applications:
-                # find and link the actual objects from the shared namespace
-                application_group.add(self.dg_hierarchy.root.find(app, PaloAltoApplication))
-            self.dg_hierarchy.root.insert(application_group)
-
-    def _parse_policies(self):
-        """retrieve all the pandevice.policies.SecurityRule's and parse them and store in the dg node"""
+    def _parse_node_policies(self, dg_node):
 
         def link_objects(policy, node):
             """given a PaloAltoPolicy and a dg node, find and link all the objects"""
@@ -314,7 +602,7 @@ class PaloAltoPanoramaDriver(PaloAltoBaseDriver):
 
             # applications
             for app in policy.pandevice_object.application:
-                application = node.find(app, PaloAltoApplication)
+                application = self._find_application(node, app)
                 policy.add_application(application)
 
             # services
@@ -322,20 +610,10 @@ class PaloAltoPanoramaDriver(PaloAltoBaseDriver):
                 service = node.find(s, PaloAltoService)
                 policy.add_service(service)
 
-        # get all the device groups
-        for dg_node in self.dg_hierarchy.get_all_nodes():
-            # pre rulebase
-            for pre_rulebase in dg_node.device_group.findall(policies.PreRulebase):
-                for security_rule in pre_rulebase.findall(policies.SecurityRule):
-                    palo_alto_policy = PaloAltoPolicy(security_rule)
-                    link_objects(palo_alto_policy, dg_node)
-                    dg_node.insert(palo_alto_policy)
-            # post rulebase
-            for post_rulebase in dg_node.device_group.findall(policies.PostRulebase):
-                for security_rule in post_rulebase.findall(policies.SecurityRule):
-                    palo_alto_policy = PaloAltoPolicy(security_rule)
-                    link_objects(palo_alto_policy, dg_node)
-                    dg_node.insert(palo_alto_policy)
+        for rulebase, security_rule in self._security_rules(dg_node):
+            palo_alto_policy = PaloAltoPolicy(security_rule)
+            link_objects(palo_alto_policy, dg_node)
+            dg_node.insert(palo_alto_policy, rulebase)
 
     def apply_candidate_policy(self, candidate_policy, commit=False):
         """Given a candidate policy, use its method to apply the effect of that policy.
@@ -416,6 +694,9 @@ class PaloAltoPanoramaDriver(PaloAltoBaseDriver):
 
             # either APPEND or NEW_POLICY but we treat them mostly the same
 
+            self._duplicate_candidate_check(candidate_policy,
+                                            candidate_policy.context.get_policy_index(True, self.vectorized))
+
             interesting_keys = [
                 'source_addresses',
                 'destination_addresses',
@@ -550,7 +831,10 @@ class PaloAltoPanoramaDriver(PaloAltoBaseDriver):
 
 class _DeviceGroupNode(object):
     def __init__(self):
+        self.name = None
         self.device_group = None
+        # the config xml of the device group, while a config file is parsed
+        self.config = None
         self.parent = None
         self.children = []
         self.objects = {
@@ -575,9 +859,86 @@ class _DeviceGroupNode(object):
             'addresses': defaultdict(list),
             'applications': defaultdict(list),
         }
+        self.policy_indexes = dict()  # include_parents -> PolicyIndex
+        self.flow_evaluator = None
+        # (lookup, namespace) -> the lookup resolved through the parents, see _resolved
+        self.resolved = dict()
+        # the keys of resolved that are copies of their own, the others are shared with the parent
+        self.resolved_copies = set()
+
+    def __getstate__(self):
+        """leave the indexes out of cached models, they are rebuilt on demand"""
+        state = self.__dict__.copy()
+        state['policy_indexes'] = dict()
+        state['flow_evaluator'] = None
+        state['config'] = None
+        state['resolved'] = dict()
+        state['resolved_copies'] = set()
+        return state
+
+    def _resolved(self, lookup, namespace):
+        """return a name_lookup or value_lookup namespace with the entries of every parent, self shadowing them
+
+        Resolved namespaces are copy on write: the shared root uses its own lookup, and a device group
+        without entries that hide parent ones uses the resolved namespace of its parent.
+        """
+        key = (lookup, namespace)
+        resolved = self.resolved.get(key)
+        if resolved is None:
+            local = getattr(self, lookup)[namespace]
+            if self.parent is None:
+                resolved = local
+            else:
+                resolved = self.parent._resolved(lookup, namespace)
+                shadowing = dict((k, v) for k, v in local.iteritems() if self._shadows(v, resolved.get(k)))
+                if shadowing:
+                    resolved = dict(resolved)
+                    resolved.update(shadowing)
+                    self.resolved_copies.add(key)
+            self.resolved[key] = resolved
+        return resolved
 
-    def insert(self, obj):
-        """insert a object into the necasary data stores"""
+    @staticmethod
+    def _shadows(value, parent_value):
+        """return True if a local lookup entry hides the entry of the parents
+
+        Empty entries (value lookups are defaultdicts) never do, and neither do the builtin objects
+        every device group holds, they are the same objects as the parent ones.
+        """
+        if not value or value is parent_value:
+            return False
+        if isinstance(value, list) and isinstance(parent_value, list):
+            return len(value) != len(parent_value) or any(v is not p for v, p in zip(value, parent_value))
+        return True
+
+    def _resolve_insert(self, lookup, namespace, entry):
+        """keep the resolved namespaces in sync with a new entry of a local lookup"""
+        key = (lookup, namespace)
+        resolved = self.resolved.get(key)
+        if resolved is not None:
+            if key in self.resolved_copies:
+                resolved[entry] = getattr(self, lookup)[namespace][entry]
+            elif self.parent is not None:
+                # shared with the parent, copied on the next lookup
+                del self.resolved[key]
+        for child in self.children:
+            child._invalidate_resolved(key)
+
+    def _invalidate_resolved(self, key):
+        """drop a resolved namespace of self and every child, they are resolved again on the next lookup"""
+        if self.resolved.pop(key, None) is None:
+            # the children only resolve through self, so theirs are gone as well
+            return
+        self.resolved_copies.discard(key)
+        for child in self.children:
+            child._invalidate_resolved(key)
+
+    def insert(self, obj, rulebase=None):
+        """insert a object into the necasary data stores
+
+        :param rulebase: 'pre_rulebase' or 'post_rulebase' for policies, by default the rulebase
+            the pandevice object belongs to
+        """
 
         cls = type(obj)
 
@@ -585,17 +946,21 @@ class _DeviceGroupNode(object):
             if cls == PaloAltoAddress:
                 self.objects['addresses'].append(obj)
                 self.value_lookup['addresses'][missing_cidr(obj.value)].append(obj)
+                self._resolve_insert('value_lookup', 'addresses', missing_cidr(obj.value))
             else:
                 self.objects['address_groups'].append(obj)
             self.name_lookup['addresses'][obj.name] = obj
+            self._resolve_insert('name_lookup', 'addresses', obj.name)
 
         elif cls == PaloAltoService or cls == PaloAltoServiceGroup:
             if cls == PaloAltoService:
                 self.objects['services'].append(obj)
                 self.value_lookup['services'][obj.value].append(obj)
+                self._resolve_insert('value_lookup', 'services', obj.value)
             else:
                 self.objects['service_groups'].append(obj)
             self.name_lookup['services'][obj.name] = obj
+            self._resolve_insert('name_lookup', 'services', obj.name)
 
         elif cls == PaloAltoApplication or cls == PaloAltoApplicationGroup:
             if cls == PaloAltoApplication:
@@ -604,15 +969,20 @@ class _DeviceGroupNode(object):
                 self.objects['application_groups'].append(obj)
             self.name_lookup['applications'][obj.name] = obj
             self.value_lookup['applications'][obj.name].append(obj)  # special case to include predefined containers
+            self._resolve_insert('name_lookup', 'applications', obj.name)
+            self._resolve_insert('value_lookup', 'applications', obj.name)
 
         elif cls == PaloAltoPolicy:
-            rule_base_type = type(obj.pandevice_object.parent)
-            if rule_base_type == policies.PreRulebase:
+            if rulebase is None:
+                rule_base_type = type(obj.pandevice_object.parent)
+                rulebase = 'pre_rulebase' if rule_base_type == policies.PreRulebase else 'post_rulebase'
+            if rulebase == 'pre_rulebase':
                 self.objects['pre_rulebase'].append(obj)
                 self.name_lookup['pre_rulebase'][obj.name] = obj
             else:
                 self.objects['post_rulebase'].append(obj)
                 self.name_lookup['post_rulebase'][obj.name] = obj
+            self._invalidate_policy_indexes()
 
         else:
             raise TypeError("Object of this type ({0}) cannot be insert".format(cls))
@@ -626,21 +996,70 @@ class _DeviceGroupNode(object):
             rulebase.extend(self.parent.get_rulebase())
         return rulebase
 
-    def find(self, name, cls, recursive=True):
-        """find an object by name"""
+    def get_policy_index(self, include_parents=True, vectorized=False):
+        """return the (cached) index of the rulebase returned by get_rulebase"""
+        index = self.policy_indexes.get(include_parents)
+        if index is None:
+            index = PolicyIndex(self.get_rulebase(include_parents), vectorized)
+            self.policy_indexes[include_parents] = index
+        return index
 
-        obj = None
+    def get_evaluation_rulebase(self):
+        """return the policies in the order a device in this device group evaluates them
 
-        if cls == PaloAltoAddress or cls == PaloAltoAddressGroup:
-            obj = self.name_lookup['addresses'].get(name)
+        pre rules from the shared device group down to self, then post rules from self up
+        to the shared device group
+        """
+        ancestors = []
+        node = self
+        while node:
+            ancestors.append(node)
+            node = node.parent
 
-        elif cls == PaloAltoService or cls == PaloAltoServiceGroup:
-            obj = self.name_lookup['services'].get(name)
+        rulebase = []
+        for node in reversed(ancestors):
+            rulebase.extend(node.objects['pre_rulebase'])
+        for node in ancestors:
+            rulebase.extend(node.objects['post_rulebase'])
+        return rulebase
+
+    def get_flow_evaluator(self, vectorized=False):
+        """return the (cached) flow evaluator of the rulebase returned by get_evaluation_rulebase"""
+        if self.flow_evaluator is None:
+            self.flow_evaluator = FlowEvaluator(self.get_evaluation_rulebase(), vectorized)
+        return self.flow_evaluator
 
+    def _invalidate_policy_indexes(self):
+        """drop the cached indexes of self and every child rulebase that includes self"""
+        self.policy_indexes = dict()
+        self.flow_evaluator = None
+        for child in self.children:
+            child._invalidate_policy_indexes()
+
+    @staticmethod
+    def _namespace(cls):
+        """return the name_lookup and value_lookup namespace of an object class, None for policies"""
+        if cls == PaloAltoAddress or cls == PaloAltoAddressGroup:
+            return 'addresses'
+        elif cls == PaloAltoService or cls == PaloAltoServiceGroup:
+            return 'services'
         elif cls == PaloAltoApplication or cls == PaloAltoApplicationGroup:
-            obj = self.name_lookup['applications'].get(name)
+            return 'applications'
+        return None
 
-        elif cls == PaloAltoPolicy:
+    def find(self, name, cls, recursive=True):
+        """find an object by name"""
+
+        namespace = self._namespace(cls)
+
+        if namespace is not None:
+            if recursive:
+                return self._resolved('name_lookup', namespace).get(name)
+            return self.name_lookup[namespace].get(name)
+
+        obj = None
+
+        if cls == PaloAltoPolicy:
             obj = self.name_lookup['pre_rulebase'].get(name)
             if not obj:
                 obj = self.name_lookup['post_rulebase'].get(name)
@@ -653,38 +1072,37 @@ class _DeviceGroupNode(object):
     def find_by_value(self, value, cls, recursive=True):
         """find objects by value"""
 
-        objs = None
-
-        if cls == PaloAltoAddress or cls == PaloAltoAddressGroup:
-            objs = self.value_lookup['addresses'].get(missing_cidr(value))
-
-        elif cls == PaloAltoService or cls == PaloAltoServiceGroup:
-            objs = self.value_lookup['services'].get(value)
-
-        elif cls == PaloAltoApplication or cls == PaloAltoApplicationGroup:
-            objs = self.value_lookup['applications'].get(value)
+        namespace = self._namespace(cls)
+        if namespace is None:
+            return None
 
-        if not objs and recursive and self.parent:
-            objs = self.parent.find_by_value(value, cls, recursive)
+        if namespace == 'addresses':
+            value = missing_cidr(value)
 
-        return objs
+        if recursive:
+            return self._resolved('value_lookup', namespace).get(value)
+        return self.value_lookup[namespace].get(value)
 
     def find_by_name_value(self, name, value, cls, recursive=True):
         """find an object by both name AND value together"""
 
-        obj = None
+        namespace = self._namespace(cls)
 
-        if cls == PaloAltoAddress or cls == PaloAltoAddressGroup:
-            _obj = self.name_lookup['addresses'].get(name)
-            if _obj and _obj.value == value:
-                obj = _obj
+        if namespace is not None and recursive:
+            # the nearest object of that name is the answer unless its value differs,
+            # then a parent may still have an object of that name and value
+            obj = self._resolved('name_lookup', namespace).get(name)
+            if obj is None or namespace == 'applications' or obj.value == value:
+                return obj
 
-        elif cls == PaloAltoService or cls == PaloAltoServiceGroup:
-            _obj = self.name_lookup['services'].get(name)
+        obj = None
+
+        if namespace == 'addresses' or namespace == 'services':
+            _obj = self.name_lookup[namespace].get(name)
             if _obj and _obj.value == value:
                 obj = _obj
 
-        elif cls == PaloAltoApplication or cls == PaloAltoApplicationGroup:
+        elif namespace == 'applications':
             obj = self.name_lookup['applications'].get(name)
 
         if not obj and recursive and self.parent:
@@ -697,16 +1115,44 @@ class _DeviceGroupHierarchy(object):
     """Basically a doubly linked-list to create the device group hierarchy
     """
 
-    def __init__(self, panorama_obj, xml_hierarchy):
+    def __init__(self, panorama_obj=None, xml_hierarchy=None):
 
         self.lookup = {}
         self.root = _DeviceGroupNode()
-        self.root.device_group = panorama_obj.shared
+        self.root.name = 'shared'
         self.panorama_obj = panorama_obj
         self.lookup['shared'] = self.root
 
-        xml_hierarchy = xml_hierarchy.find('result/dg-hierarchy')
-        self._parse_nodes(xml_hierarchy, self.root)
+        if panorama_obj is not None:
+            self.root.device_group = panorama_obj.shared
+            xml_hierarchy = xml_hierarchy.find('result/dg-hierarchy')
+            self._parse_nodes(xml_hierarchy, self.root)
+
+    @classmethod
+    def from_config(cls, config):
+        """build the hierarchy of an exported Panorama config, the nodes hold their config xml"""
+
+        hierarchy = cls()
+        hierarchy.root.config = config.find('shared')
+
+        # parents are in the read only part of the config, dg-meta-data before PAN-OS 8.0
+        parents = {}
+        for path in ['readonly/devices/entry/device-group/entry', 'readonly/dg-meta-data/dg-info/entry']:
+            for e in config.iterfind(path):
+                parents.setdefault(e.get('name'), e.findtext('parent-dg'))
+
+        nodes = []
+        for e in config.iterfind('devices/entry/device-group/entry'):
+            node = _DeviceGroupNode()
+            node.name = e.get('name')
+            node.config = e
+            hierarchy.lookup[node.name] = node
+            nodes.append(node)
+        for node in nodes:
+            node.parent = hierarchy.lookup.get(parents.get(node.name)) or hierarchy.root
+            node.parent.children.append(node)
+
+        return hierarchy
 
     def _parse_nodes(self, xml, parent):
         if xml.tag == 'dg':
@@ -715,6 +1161,7 @@ class _DeviceGroupHierarchy(object):
         for dg in xml:
             node = _DeviceGroupNode()
             node.device_group = self.panorama_obj.find(dg.attrib['name'], panorama.DeviceGroup)
+            node.name = node.device_group.name
             node.parent = parent
             parent.children.append(node)
             self.lookup[node.device_group.name] = node
@@ -733,3 +1180,12 @@ class _DeviceGroupHierarchy(object):
 
     def get_all_nodes(self):
         return self.lookup.values()
+
+    def get_levels(self):
+        """return the nodes grouped by their depth in the hierarchy, shared first"""
+        levels = []
+        level = [self.root]
+        while level:
+            levels.append(level)
+            level = [child for node in level for child in node.children]
+        return levels
@@ -0,0 +1,14 @@
+# -*- coding: utf-8 -*-
+from orangengine.index.address import AddressIndex
+from orangengine.index.interval import IntervalIndex
+from orangengine.index.vector import VectorAddressIndex
+from orangengine.index.vector import HAS_NUMPY
+from orangengine.index.policy import PolicyIndex
+from orangengine.index.flow import FlowEvaluator
+from orangengine.index.packed import PackedRulebase
+from orangengine.index.packed import PackedPolicy
+from orangengine.index.packed import pack_rulebase
+
+
+__all__ = ['AddressIndex', 'IntervalIndex', 'VectorAddressIndex', 'HAS_NUMPY', 'PolicyIndex', 'FlowEvaluator',
+           'PackedRulebase', 'PackedPolicy', 'pack_rulebase', ]
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+from orangengine.index.bitset import bitset
+
+from collections import defaultdict
+
+
+ADDRESS_BITS = {
+    4: 32,
+    6: 128,
+}
+
+
+def prefix_length(version, first, last):
+    """Return the prefix length of the interval if it is a cidr block, else None
+    """
+    size = last - first + 1
+    if size & (size - 1) or first & (size - 1):
+        # not a power of two or not aligned on its size
+        return None
+    return ADDRESS_BITS[version] - (size.bit_length() - 1)
+
+
+class AddressIndex(object):
+    """Address containment index
+
+    Maps address values to bitsets of the positions of the policies that
+    reference them. Cidr blocks are kept in one hash table per prefix length
+    so finding every block that contains a given address is a longest prefix
+    walk of at most one dict lookup per populated prefix length. Non cidr
+    aligned ranges are kept aside and checked directly, as they are rare.
+    """
+
+    def __init__(self, entries):
+        """
+        :param entries: iterable of (address, policy position) tuples where address is either
+            a pre-parsed (version, first, last) ip interval or any other (fqdn) value
+        """
+
+        prefixes = defaultdict(lambda: defaultdict(list))
+        ranges = defaultdict(list)
+        names = defaultdict(list)
+        any_positions = []
+
+        for value, position in entries:
+            if not isinstance(value, tuple):
+                # fqdn and friends
+                if value == 'any':
+                    any_positions.append(position)
+                names[value].append(position)
+                continue
+            version, first, last = interval = value
+            length = prefix_length(version, first, last)
+            if length is None:
+                ranges[interval].append(position)
+            else:
+                shift = ADDRESS_BITS[version] - length
+                prefixes[(version, length)][first >> shift].append(position)
+
+        # (version, prefix length) -> {network >> host bits: bitset}
+        self._prefixes = dict()
+        for key, table in prefixes.iteritems():
+            self._prefixes[key] = dict((network, bitset(p)) for network, p in table.iteritems())
+
+        # version -> [(shift, table)] ordered from the shortest prefix
+        self._lengths = defaultdict(list)
+        for version, length in sorted(self._prefixes.keys()):
+            self._lengths[version].append((ADDRESS_BITS[version] - length, self._prefixes[(version, length)]))
+
+        self._ranges = defaultdict(list)
+        for (version, first, last), p in ranges.iteritems():
+            self._ranges[version].append((first, last, bitset(p)))
+
+        self._names = dict((name, bitset(p)) for name, p in names.iteritems())
+        self.any_mask = bitset(any_positions)
+
+    def containing(self, value):
+        """Return a bitset of the policies that reference an address containing value
+
+        value is a pre-parsed ip interval or a fqdn. Policies referencing 'any'
+        always contain value. Values that are not ip addresses can only be
+        contained by the very same value.
+        """
+
+        mask = self.any_mask
+
+        if not isinstance(value, tuple):
+            return mask | self._names.get(value, 0)
+
+        version, first, last = value
+        for shift, table in self._lengths[version]:
+            network = first >> shift
+            if network != last >> shift:
+                # longer prefixes cannot contain the value either
+                break
+            mask |= table.get(network, 0)
+
+        for r_first, r_last, r_mask in self._ranges[version]:
+            if r_first <= first and last <= r_last:
+                mask |= r_mask
+
+        return mask
+
+    def containing_batch(self, values):
+        """Return the containing bitset of every value, in order
+        """
+        return [self.containing(value) for value in values]
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+"""
+bitsets of policy positions
+
+A bitset is a plain (long) integer where bit n is set if the policy at
+position n of a rulebase is a member of the set. This keeps set operations
+(and, or) in C and makes "first match" a lowest set bit lookup.
+"""
+import binascii
+
+
+def bitset(positions):
+    """Build a bitset from an iterable of positions
+    """
+    positions = list(positions)
+    if not positions:
+        return 0
+    bits = bytearray(max(positions) // 8 + 1)
+    for p in positions:
+        bits[p // 8] |= 1 << (p % 8)
+    bits.reverse()
+    return int(binascii.hexlify(bits), 16)
+
+
+def iter_bits(mask):
+    """Generate the positions set in mask in ascending order
+    """
+    # least significant bit first
+    bits = bin(mask)[:1:-1]
+    position = bits.find('1')
+    while position != -1:
+        yield position
+        position = bits.find('1', position + 1)
+
+
+def lowest_bit(mask):
+    """Return the lowest position set in mask (the first match), or None if mask is empty
+    """
+    if not mask:
+        return None
+    return (mask & -mask).bit_length() - 1
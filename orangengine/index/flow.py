@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+from orangengine.index.address import AddressIndex
+from orangengine.index.bitset import bitset, lowest_bit
+from orangengine.index.interval import IntervalIndex
+from orangengine.index.vector import HAS_NUMPY, VectorAddressIndex
+from orangengine.utils import ip_interval, port_number, protocol_number
+
+from collections import defaultdict
+
+
+class FlowEvaluator(object):
+    """Compiled first match evaluation of flows against an ordered rulebase
+
+    Every field of the rulebase is compiled into bitsets of policy positions:
+    zones by name, addresses by containment and services by protocol and port
+    segments. Evaluating a flow ands one bitset per field, and the policy the
+    flow hits is the lowest position left, so there is no scan of the rulebase
+    per flow.
+
+    Applications are not identified from the 5-tuple, application based
+    policies are evaluated on their zones, addresses and services (the default
+    ports of their applications for application-default) only. Fqdn addresses
+    never match a flow, and neither do flows with an ip address or port that
+    cannot be parsed.
+
+    With vectorized, the addresses of a batch of flows are looked up with
+    a VectorAddressIndex when numpy is installed.
+    """
+
+    def __init__(self, policies, vectorized=False):
+
+        self.policies = policies
+
+        zones = {
+            'source_zones': defaultdict(list),
+            'destination_zones': defaultdict(list),
+        }
+        for position, policy in enumerate(policies):
+            for key in zones.keys():
+                for zone in getattr(policy, key):
+                    zones[key][zone].append(position)
+
+        self._zone_masks = dict()
+        for key, postings in zones.iteritems():
+            self._zone_masks[key] = dict((zone, bitset(p)) for zone, p in postings.iteritems())
+
+        address_index_class = VectorAddressIndex if vectorized and HAS_NUMPY else AddressIndex
+        self._address_indexes = dict()
+        for key in ['source_addresses', 'destination_addresses']:
+            self._address_indexes[key] = address_index_class(self._address_entries(policies, key))
+
+        # protocol number -> port segments. None is any protocol
+        self._services = IntervalIndex((protocol, first, last, position)
+                                       for position, policy in enumerate(policies)
+                                       for protocol, first, last in policy.service_intervals())
+
+    @staticmethod
+    def _address_entries(policies, key):
+        """generate the ip intervals and 'any' of every policy along with its position"""
+        for position, policy in enumerate(policies):
+            intervals, fqdns = policy.address_intervals(key)
+            for interval in intervals:
+                yield interval, position
+            if 'any' in fqdns:
+                yield 'any', position
+
+    def _zone_mask(self, key, zone):
+        masks = self._zone_masks[key]
+        return masks.get(zone, 0) | masks.get('any', 0)
+
+    @staticmethod
+    def _ip(ip):
+        """return the (version, ip, ip) interval of an ip string or integer (ipv4)"""
+        if isinstance(ip, (int, long)):
+            return 4, ip, ip
+        return ip_interval(ip)
+
+    def _address_mask(self, key, ip):
+        interval = self._ip(ip)
+        if interval is None:
+            return 0
+        return self._address_indexes[key].containing(interval)
+
+    def _service_mask(self, protocol, port):
+        port = port_number(port)
+        if port is None:
+            return 0
+        return self._services.stab(protocol_number(protocol), port) | self._services.stab(None, port)
+
+    def match_mask(self, src_zone, dst_zone, src_ip, dst_ip, protocol, port):
+        """Return the bitset of every policy matching the flow
+        """
+
+        mask = self._zone_mask('source_zones', src_zone)
+        if mask:
+            mask &= self._zone_mask('destination_zones', dst_zone)
+        if mask:
+            mask &= self._address_mask('source_addresses', src_ip)
+        if mask:
+            mask &= self._address_mask('destination_addresses', dst_ip)
+        if mask:
+            mask &= self._service_mask(protocol, port)
+        return mask
+
+    def evaluate(self, src_zone, dst_zone, src_ip, dst_ip, protocol, port):
+        """Return the first policy matching the flow in rule order, or None
+        """
+
+        position = lowest_bit(self.match_mask(src_zone, dst_zone, src_ip, dst_ip, protocol, port))
+        if position is None:
+            return None
+        return self.policies[position]
+
+    def _address_masks_batch(self, key, ips):
+        """return the containing bitset of every ip, 0 for the ones that cannot be parsed"""
+        intervals = [self._ip(ip) for ip in ips]
+        masks = self._address_indexes[key].containing_batch([i for i in intervals if i is not None])
+        masks.reverse()
+        return [0 if i is None else masks.pop() for i in intervals]
+
+    def evaluate_batch(self, flows):
+        """Return the first policy matching every (src_zone, dst_zone, src_ip, dst_ip, protocol, port) flow
+
+        The addresses of all of the flows are looked up at once.
+        """
+
+        flows = list(flows)
+        sources = self._address_masks_batch('source_addresses', [f[2] for f in flows])
+        destinations = self._address_masks_batch('destination_addresses', [f[3] for f in flows])
+
+        results = []
+        for flow, source_mask, destination_mask in zip(flows, sources, destinations):
+            src_zone, dst_zone, _, _, protocol, port = flow
+            mask = source_mask & destination_mask
+            if mask:
+                mask &= self._zone_mask('source_zones', src_zone) & self._zone_mask('destination_zones', dst_zone)
+            if mask:
+                mask &= self._service_mask(protocol, port)
+            position = lowest_bit(mask)
+            results.append(None if position is None else self.policies[position])
+        return results
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+from bisect import bisect_right
+from collections import defaultdict
+
+
+class IntervalIndex(object):
+    """Point stabbing index over keyed integer intervals
+
+    The intervals of every key (for example the ports of a protocol) are cut
+    into elementary segments at each interval boundary. Every segment carries
+    the bitset of the positions whose intervals cover it, so finding every
+    interval that contains a point is a single bisect, and finding the
+    positions whose intervals cover a whole range ands the segments in it.
+    """
+
+    def __init__(self, entries):
+        """
+        :param entries: iterable of (key, first, last, position) tuples
+        """
+
+        events = defaultdict(list)
+        for key, first, last, position in entries:
+            events[key].append((first, 1, position))
+            events[key].append((last + 1, -1, position))
+
+        # key -> (sorted segment starts, segment bitsets)
+        self._segments = dict()
+
+        for key, key_events in events.iteritems():
+            key_events.sort()
+            # a position may have several overlapping intervals of the same key
+            active = defaultdict(int)
+            mask = 0
+            starts = []
+            masks = []
+            i = 0
+            while i < len(key_events):
+                point = key_events[i][0]
+                # apply every event at this boundary before closing the segment
+                while i < len(key_events) and key_events[i][0] == point:
+                    _, delta, position = key_events[i]
+                    active[position] += delta
+                    if active[position] == 1 and delta == 1:
+                        mask |= 1 << position
+                    elif not active[position]:
+                        mask &= ~(1 << position)
+                    i += 1
+                starts.append(point)
+                masks.append(mask)
+            self._segments[key] = starts, masks
+
+    def stab(self, key, point):
+        """Return a bitset of the positions with an interval of key containing point
+        """
+
+        segments = self._segments.get(key)
+        if segments is None:
+            return 0
+
+        starts, masks = segments
+        i = bisect_right(starts, point) - 1
+        if i < 0:
+            return 0
+        return masks[i]
+
+    def covering(self, key, first, last):
+        """Return a bitset of the positions whose intervals of key together cover first through last
+        """
+
+        segments = self._segments.get(key)
+        if segments is None:
+            return 0
+
+        starts, masks = segments
+        i = bisect_right(starts, first) - 1
+        if i < 0:
+            return 0
+
+        # every segment overlapping the range has to be covered
+        mask = masks[i]
+        i += 1
+        while mask and i < len(starts) and starts[i] <= last:
+            mask &= masks[i]
+            i += 1
+        return mask
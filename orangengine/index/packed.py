@@ -0,0 +1,464 @@
+# -*- coding: utf-8 -*-
+"""
+read-only binary layout of an ordered rulebase
+
+A packed rulebase is a single file of flat little endian arrays: a sorted
+table of interned strings, and for every policy field an offsets array (the
+values of the policy at position p are values[offsets[p]:offsets[p + 1]]),
+an owners array (the policy position of every value) and the values
+themselves, as string ids or numeric address and port intervals.
+
+The file is mapped read-only, so any number of worker processes share the
+same pages instead of holding a copy of the parsed object graph each. Every
+query reads straight out of the mapping, with numpy views over the arrays
+when numpy is installed and struct otherwise.
+"""
+import mmap
+import struct
+
+from orangengine.utils import canonical_text, ip_interval, port_number, protocol_number
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+MAGIC = 'OEPR'
+
+# bump when the layout changes
+PACKED_FORMAT = 1
+
+# magic, format, policy count, fallback source zone id, fallback destination zone id
+HEADER = struct.Struct('<4sIIII')
+# offset and item count of a section
+SECTION = struct.Struct('<QQ')
+
+NO_STRING = 0xFFFFFFFF
+ANY_PROTOCOL = 0xFFFF
+
+# fields whose values are interned strings
+STRING_FIELDS = ('source_zones', 'destination_zones', 'applications', 'source_fqdns', 'destination_fqdns')
+
+ADDRESS_FIELDS = (
+    ('source_addresses', 'source'),
+    ('destination_addresses', 'destination'),
+)
+
+# (name, struct format character) of every section, in file order
+SECTIONS = [('strings.offsets', 'I'), ('strings.data', 'B'), ('policy.names', 'I'), ('policy.actions', 'i')]
+for _field in STRING_FIELDS:
+    SECTIONS.extend([(_field + '.offsets', 'I'), (_field + '.owners', 'I'), (_field + '.values', 'I')])
+for _, _field in ADDRESS_FIELDS:
+    SECTIONS.extend([(_field + '.v4.offsets', 'I'), (_field + '.v4.owners', 'I'),
+                     (_field + '.v4.starts', 'I'), (_field + '.v4.ends', 'I'),
+                     (_field + '.v6.offsets', 'I'), (_field + '.v6.owners', 'I'),
+                     (_field + '.v6.starts_high', 'Q'), (_field + '.v6.starts_low', 'Q'),
+                     (_field + '.v6.ends_high', 'Q'), (_field + '.v6.ends_low', 'Q')])
+SECTIONS.extend([('services.offsets', 'I'), ('services.owners', 'I'), ('services.protocols', 'H'),
+                 ('services.firsts', 'H'), ('services.lasts', 'H')])
+
+NUMPY_TYPES = {'B': '<u1', 'H': '<u2', 'I': '<u4', 'i': '<i4', 'Q': '<u8'}
+
+LOW_64 = (1 << 64) - 1
+
+
+def _text(value):
+    """return the utf-8 bytes of a string value"""
+    return canonical_text(value).encode('utf-8')
+
+
+class _Column(object):
+    """offsets, owners and value arrays of a policy field under construction"""
+
+    def __init__(self, names):
+        self.names = names
+        self.offsets = [0]
+        self.owners = []
+        self.values = dict((name, []) for name in names)
+
+    def add(self, position, rows):
+        """append the values of the policy at position, rows are tuples in the order of the value names"""
+        for row in rows:
+            self.owners.append(position)
+            for name, value in zip(self.names, row):
+                self.values[name].append(value)
+        self.offsets.append(len(self.owners))
+
+
+def pack_rulebase(policies, path, fallback_zone_pair=None):
+    """Write the packed layout of an ordered rulebase to path
+
+    :param policies: the rulebase, in rule order
+    :param fallback_zone_pair: (source zone, destination zone) a flow is evaluated
+        with when no policy of its own zones matches, e.g. the SRX global policies
+    """
+
+    policies = list(policies)
+
+    strings = set()
+    if fallback_zone_pair:
+        strings.update(_text(z) for z in fallback_zone_pair)
+
+    names = []
+    actions = []
+    string_columns = dict((f, _Column(['values'])) for f in STRING_FIELDS)
+    v4_columns = dict((f, _Column(['starts', 'ends'])) for _, f in ADDRESS_FIELDS)
+    v6_columns = dict((f, _Column(['starts_high', 'starts_low', 'ends_high', 'ends_low'])) for _, f in ADDRESS_FIELDS)
+    services = _Column(['protocols', 'firsts', 'lasts'])
+
+    field_strings = dict()
+    for position, policy in enumerate(policies):
+        names.append(_text(policy.name))
+        actions.append(policy.action)
+
+        field_strings['source_zones'] = [_text(z) for z in policy.source_zones]
+        field_strings['destination_zones'] = [_text(z) for z in policy.destination_zones]
+        field_strings['applications'] = [_text(a) for a in getattr(policy, 'applications', None) or ()]
+
+        for key, field in ADDRESS_FIELDS:
+            intervals, fqdns = policy.address_intervals(key)
+            field_strings[field + '_fqdns'] = [_text(f) for f in fqdns]
+            v4_columns[field].add(position, [(first, last) for version, first, last in intervals if version == 4])
+            v6_columns[field].add(position, [(first >> 64, first & LOW_64, last >> 64, last & LOW_64)
+                                             for version, first, last in intervals if version == 6])
+
+        for field in STRING_FIELDS:
+            string_columns[field].add(position, [(s,) for s in field_strings[field]])
+            strings.update(field_strings[field])
+
+        services.add(position, [(ANY_PROTOCOL if protocol is None else protocol, first, last)
+                                for protocol, first, last in policy.service_intervals()])
+
+    strings.update(names)
+    strings = sorted(strings)
+    string_ids = dict((s, i) for i, s in enumerate(strings))
+
+    sections = {
+        'strings.offsets': [0],
+        'strings.data': [],
+        'policy.names': [string_ids[n] for n in names],
+        'policy.actions': actions,
+    }
+    data = []
+    length = 0
+    for s in strings:
+        data.append(s)
+        length += len(s)
+        sections['strings.offsets'].append(length)
+
+    for field, column in string_columns.iteritems():
+        sections[field + '.offsets'] = column.offsets
+        sections[field + '.owners'] = column.owners
+        sections[field + '.values'] = [string_ids[s] for s in column.values['values']]
+    for field in v4_columns.keys():
+        for version, column in [('v4', v4_columns[field]), ('v6', v6_columns[field])]:
+            sections['{0}.{1}.offsets'.format(field, version)] = column.offsets
+            sections['{0}.{1}.owners'.format(field, version)] = column.owners
+            for name, values in column.values.iteritems():
+                sections['{0}.{1}.{2}'.format(field, version, name)] = values
+    sections['services.offsets'] = services.offsets
+    sections['services.owners'] = services.owners
+    for name, values in services.values.iteritems():
+        sections['services.' + name] = values
+
+    if fallback_zone_pair:
+        fallback = [string_ids[_text(z)] for z in fallback_zone_pair]
+    else:
+        fallback = [NO_STRING, NO_STRING]
+
+    # sections start on 8 byte boundaries after the header and the section directory
+    offset = HEADER.size + SECTION.size * len(SECTIONS)
+    directory = []
+    blobs = []
+    for name, code in SECTIONS:
+        offset += -offset % 8
+        if name == 'strings.data':
+            blob = ''.join(data)
+            count = len(blob)
+        else:
+            values = sections[name]
+            blob = struct.pack('<{0}{1}'.format(len(values), code), *values)
+            count = len(values)
+        directory.append((offset, count))
+        blobs.append((offset, blob))
+        offset += len(blob)
+
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, PACKED_FORMAT, len(policies), fallback[0], fallback[1]))
+        for entry in directory:
+            f.write(SECTION.pack(*entry))
+        for offset, blob in blobs:
+            f.write('\0' * (offset - f.tell()))
+            f.write(blob)
+
+
+class PackedPolicy(object):
+    """
+    view of a single policy of a PackedRulebase, with the field accessors of BasePolicy
+    """
+
+    __slots__ = ('rulebase', 'position')
+
+    def __init__(self, rulebase, position):
+        self.rulebase = rulebase
+        self.position = position
+
+    @property
+    def name(self):
+        return self.rulebase.string(self.rulebase.item('policy.names', self.position))
+
+    @property
+    def action(self):
+        return self.rulebase.item('policy.actions', self.position)
+
+    @property
+    def source_zones(self):
+        return self.rulebase.strings('source_zones', self.position)
+
+    @property
+    def destination_zones(self):
+        return self.rulebase.strings('destination_zones', self.position)
+
+    @property
+    def applications(self):
+        return self.rulebase.strings('applications', self.position)
+
+    def address_intervals(self, key):
+        return self.rulebase.address_intervals(key, self.position)
+
+    def service_intervals(self):
+        return self.rulebase.service_intervals(self.position)
+
+
+class PackedRulebase(object):
+    """Memory mapped, read-only packed rulebase, see pack_rulebase
+
+    Flows are evaluated in rule order like FlowEvaluator, but return the
+    position of the first matching policy rather than the policy itself.
+    """
+
+    def __init__(self, path):
+
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, packed_format, self.size, fallback_source, fallback_destination = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or packed_format != PACKED_FORMAT:
+            raise ValueError("{0} is not a packed rulebase of format {1}".format(path, PACKED_FORMAT))
+
+        self._sections = dict()
+        for i, (name, code) in enumerate(SECTIONS):
+            offset, count = SECTION.unpack_from(self._map, HEADER.size + SECTION.size * i)
+            self._sections[name] = offset, count, code
+
+        self._string_count = self._sections['strings.offsets'][1] - 1
+        self._data_offset = self._sections['strings.data'][0]
+        self._any = self.string_id('any')
+
+        self.fallback_zone_pair = None
+        if fallback_source != NO_STRING:
+            self.fallback_zone_pair = self.string(fallback_source), self.string(fallback_destination)
+
+        # numpy views over the mapping, created on first use
+        self._arrays = dict()
+
+    def __len__(self):
+        return self.size
+
+    def close(self):
+        self._arrays = dict()
+        self._map.close()
+
+    def item(self, name, i):
+        """return item i of a section"""
+        offset, _, code = self._sections[name]
+        return struct.unpack_from('<' + code, self._map, offset + struct.calcsize(code) * i)[0]
+
+    def items(self, name, first, last):
+        """return the items first up to last of a section"""
+        offset, _, code = self._sections[name]
+        return struct.unpack_from('<{0}{1}'.format(last - first, code), self._map,
+                                  offset + struct.calcsize(code) * first)
+
+    def array(self, name):
+        """return a read-only numpy view of a section"""
+        array = self._arrays.get(name)
+        if array is None:
+            offset, count, code = self._sections[name]
+            array = self._arrays[name] = numpy.frombuffer(self._map, NUMPY_TYPES[code], count, offset)
+        return array
+
+    def _range(self, field, position):
+        return self.item(field + '.offsets', position), self.item(field + '.offsets', position + 1)
+
+    def string(self, string_id):
+        """return the text of an interned string"""
+        first, last = self.items('strings.offsets', string_id, string_id + 2)
+        return self._map[self._data_offset + first:self._data_offset + last].decode('utf-8')
+
+    def string_id(self, value):
+        """return the id of an interned string, None if the rulebase does not reference it"""
+        text = _text(value)
+        low, high = 0, self._string_count
+        while low < high:
+            middle = (low + high) // 2
+            first, last = self.items('strings.offsets', middle, middle + 2)
+            if self._map[self._data_offset + first:self._data_offset + last] < text:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self._string_count:
+            first, last = self.items('strings.offsets', low, low + 2)
+            if self._map[self._data_offset + first:self._data_offset + last] == text:
+                return low
+        return None
+
+    def policy(self, position):
+        return PackedPolicy(self, position)
+
+    def policies(self):
+        """generate a PackedPolicy view of every policy, in rule order"""
+        for position in xrange(self.size):
+            yield PackedPolicy(self, position)
+
+    def strings(self, field, position):
+        """return the string values of a field of the policy at position"""
+        first, last = self._range(field, position)
+        return [self.string(i) for i in self.items(field + '.values', first, last)] if last > first else []
+
+    def address_intervals(self, key, position):
+        """return the (ip intervals, fqdns) of the policy at position, see BasePolicy.address_intervals"""
+        field = dict(ADDRESS_FIELDS)[key]
+        intervals = []
+        first, last = self._range(field + '.v4', position)
+        if last > first:
+            intervals.extend((4, start, end) for start, end in zip(self.items(field + '.v4.starts', first, last),
+                                                                   self.items(field + '.v4.ends', first, last)))
+        first, last = self._range(field + '.v6', position)
+        for i in xrange(first, last):
+            start = (self.item(field + '.v6.starts_high', i) << 64) | self.item(field + '.v6.starts_low', i)
+            end = (self.item(field + '.v6.ends_high', i) << 64) | self.item(field + '.v6.ends_low', i)
+            intervals.append((6, start, end))
+        return intervals, set(self.strings(field + '_fqdns', position))
+
+    def service_intervals(self, position):
+        """return the (protocol number, first port, last port) intervals of the policy at position"""
+        first, last = self._range('services', position)
+        if last == first:
+            return []
+        return [(None if protocol == ANY_PROTOCOL else protocol, low, high) for protocol, low, high in
+                zip(self.items('services.protocols', first, last), self.items('services.firsts', first, last),
+                    self.items('services.lasts', first, last))]
+
+    @staticmethod
+    def _ip(ip):
+        if isinstance(ip, (int, long)):
+            return 4, ip, ip
+        return ip_interval(ip)
+
+    def evaluate(self, src_zone, dst_zone, src_ip, dst_ip, protocol, port):
+        """Return the position of the first policy matching the flow, or None
+
+        Flows no policy of their own zones matches are evaluated again with the
+        fallback zone pair, if the rulebase has one.
+        """
+
+        flow = self._ip(src_ip), self._ip(dst_ip), protocol_number(protocol), port_number(port)
+        position = self._evaluate(self.string_id(src_zone), self.string_id(dst_zone), *flow)
+        if position is None and self.fallback_zone_pair:
+            position = self._evaluate(self.string_id(self.fallback_zone_pair[0]),
+                                      self.string_id(self.fallback_zone_pair[1]), *flow)
+        return position
+
+    def evaluate_batch(self, flows):
+        """Return the first matching position of every (src_zone, dst_zone, src_ip, dst_ip, protocol, port) flow
+        """
+        return [self.evaluate(*flow) for flow in flows]
+
+    def _evaluate(self, src_zone, dst_zone, src_ip, dst_ip, protocol, port):
+        if src_ip is None or dst_ip is None or port is None:
+            # unparseable addresses and ports match no policy
+            return None
+        if numpy is not None:
+            return self._evaluate_arrays(src_zone, dst_zone, src_ip, dst_ip, protocol, port)
+
+        for position in xrange(self.size):
+            if (self._zone_matches('source_zones', position, src_zone) and
+                    self._zone_matches('destination_zones', position, dst_zone) and
+                    self._address_matches('source', position, src_ip) and
+                    self._address_matches('destination', position, dst_ip) and
+                    self._service_matches(position, protocol, port)):
+                return position
+        return None
+
+    def _zone_matches(self, field, position, zone):
+        first, last = self._range(field, position)
+        values = self.items(field + '.values', first, last)
+        return (zone is not None and zone in values) or (self._any is not None and self._any in values)
+
+    def _address_matches(self, field, position, ip):
+        version, value, _ = ip
+        first, last = self._range(field + '.v4' if version == 4 else field + '.v6', position)
+        for i in xrange(first, last):
+            if version == 4:
+                start, end = self.item(field + '.v4.starts', i), self.item(field + '.v4.ends', i)
+            else:
+                start = (self.item(field + '.v6.starts_high', i) << 64) | self.item(field + '.v6.starts_low', i)
+                end = (self.item(field + '.v6.ends_high', i) << 64) | self.item(field + '.v6.ends_low', i)
+            if start <= value <= end:
+                return True
+        return self._zone_matches(field + '_fqdns', position, None)
+
+    def _service_matches(self, position, protocol, port):
+        for service_protocol, low, high in self.service_intervals(position):
+            if (service_protocol is None or service_protocol == protocol) and low <= port <= high:
+                return True
+        return False
+
+    def _hits(self, field, value_hits):
+        """return a boolean array over the policies that have a value of field for which value_hits is true"""
+        owners = self.array(field + '.owners')
+        return numpy.bincount(owners[value_hits], minlength=self.size)[:self.size] > 0
+
+    def _string_hits(self, field, string_id):
+        values = self.array(field + '.values')
+        value_hits = values == self._any if self._any is not None else numpy.zeros(len(values), dtype=bool)
+        if string_id is not None:
+            value_hits |= values == string_id
+        return self._hits(field, value_hits)
+
+    def _address_hits(self, field, ip):
+        version, value, _ = ip
+        if version == 4:
+            field_hits = (self.array(field + '.v4.starts') <= value) & (self.array(field + '.v4.ends') >= value)
+            hits = self._hits(field + '.v4', field_hits)
+        else:
+            high, low = value >> 64, value & LOW_64
+            starts_high, starts_low = self.array(field + '.v6.starts_high'), self.array(field + '.v6.starts_low')
+            ends_high, ends_low = self.array(field + '.v6.ends_high'), self.array(field + '.v6.ends_low')
+            field_hits = (((starts_high < high) | ((starts_high == high) & (starts_low <= low))) &
+                          ((ends_high > high) | ((ends_high == high) & (ends_low >= low))))
+            hits = self._hits(field + '.v6', field_hits)
+        return hits | self._string_hits(field + '_fqdns', None)
+
+    def _service_hits(self, protocol, port):
+        protocols = self.array('services.protocols')
+        protocol_hits = protocols == ANY_PROTOCOL
+        if protocol is not None and 0 <= protocol < ANY_PROTOCOL:
+            protocol_hits |= protocols == protocol
+        return self._hits('services', protocol_hits & (self.array('services.firsts') <= port) &
+                          (self.array('services.lasts') >= port))
+
+    def _evaluate_arrays(self, src_zone, dst_zone, src_ip, dst_ip, protocol, port):
+        hits = self._string_hits('source_zones', src_zone)
+        if hits.any():
+            hits &= self._string_hits('destination_zones', dst_zone)
+        if hits.any():
+            hits &= self._address_hits('source', src_ip)
+        if hits.any():
+            hits &= self._address_hits('destination', dst_ip)
+        if hits.any():
+            hits &= self._service_hits(protocol, port)
+        positions = numpy.flatnonzero(hits)
+        return int(positions[0]) if len(positions) else None
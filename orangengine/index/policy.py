@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+from orangengine.index.address import AddressIndex
+from orangengine.index.bitset import bitset, iter_bits
+from orangengine.index.interval import IntervalIndex
+from orangengine.index.vector import HAS_NUMPY, VectorAddressIndex
+from orangengine.models.base import BasePolicy, MatchCriteria
+
+from collections import defaultdict
+
+
+class PolicyIndex(object):
+    """Index over an ordered rulebase
+
+    Narrows a policy match down to the policies that can possibly match the
+    criteria. Every zone, address, service, application and logging value, as
+    well as every action, maps to a bitset of the positions of the policies
+    that reference it (an inverted index), so narrowing a query is a matter of
+    and-ing a handful of bitsets. Service port ranges are kept in an
+    IntervalIndex per protocol for range aware service matching, the whole
+    (frozen) value set of every field is hashed for exact matching and
+    policies are looked up by fingerprint for duplicate rules. Candidates are always returned in rule order
+    and must still be checked with BasePolicy.match.
+
+    With vectorized, address containment is answered by a VectorAddressIndex
+    when numpy is installed.
+    """
+
+    ADDRESS_KEYS = ('source_addresses', 'destination_addresses')
+
+    VALUE_KEYS = (
+        'source_zones',
+        'destination_zones',
+        'source_addresses',
+        'destination_addresses',
+        'services',
+        'applications',
+        'logging',
+    )
+
+    def __init__(self, policies, vectorized=False):
+
+        self.policies = policies
+
+        address_index_class = VectorAddressIndex if vectorized and HAS_NUMPY else AddressIndex
+        self.address_indexes = dict()
+        for key in self.ADDRESS_KEYS:
+            self.address_indexes[key] = address_index_class(self._address_entries(policies, key))
+
+        values = dict((key, defaultdict(list)) for key in self.VALUE_KEYS)
+        value_sets = dict((key, defaultdict(list)) for key in self.VALUE_KEYS)
+        actions = defaultdict(list)
+        # fingerprint -> positions
+        self.rule_lookup = defaultdict(list)
+        for position, policy in enumerate(policies):
+            for key in self.VALUE_KEYS:
+                policy_values = getattr(policy, key, None) or ()
+                for value in policy_values:
+                    values[key][value].append(position)
+                value_sets[key][frozenset(policy_values)].append(position)
+            actions[policy.action].append(position)
+            self.rule_lookup[policy.fingerprint].append(position)
+
+        # protocol number -> port segments. None is any protocol
+        self.service_index = IntervalIndex((protocol, first, last, position)
+                                           for position, policy in enumerate(policies)
+                                           for protocol, first, last in policy.service_intervals())
+
+        # key -> value -> bitset
+        self.value_masks = dict()
+        for key, postings in values.iteritems():
+            self.value_masks[key] = dict((value, bitset(p)) for value, p in postings.iteritems())
+
+        # key -> frozenset of values -> bitset
+        self.exact_masks = dict()
+        for key, postings in value_sets.iteritems():
+            self.exact_masks[key] = dict((value, bitset(p)) for value, p in postings.iteritems())
+
+        # action -> bitset
+        self.action_masks = dict((action, bitset(p)) for action, p in actions.iteritems())
+
+    def find_rule(self, values, action):
+        """Return the policies matching exactly the same traffic as the given rule with the same action
+        """
+        return [self.policies[p] for p in self.rule_lookup.get(BasePolicy.make_fingerprint(values, action), [])]
+
+    def duplicates(self):
+        """Return the lists of policies that are duplicates of each other, in rule order
+        """
+        groups = sorted(positions for positions in self.rule_lookup.itervalues() if len(positions) > 1)
+        return [[self.policies[p] for p in positions] for positions in groups]
+
+    @staticmethod
+    def _address_entries(policies, key):
+        """generate the pre-parsed address values of every policy along with its position"""
+        for position, policy in enumerate(policies):
+            intervals, fqdns = policy.address_intervals(key)
+            for interval in intervals:
+                yield interval, position
+            for fqdn in fqdns:
+                yield fqdn, position
+
+    def _action_mask(self, value):
+        """return the bitset of the given (human readable) action, or None if it cannot be mapped"""
+        if not self.policies:
+            return 0
+        try:
+            action = self.policies[0].ActionMap[value]
+        except KeyError:
+            return None
+        return self.action_masks.get(action, 0)
+
+    def _service_mask(self, protocol, first, last):
+        """return the bitset of the policies whose services cover the ports of the protocol"""
+        mask = self.service_index.covering(None, first, last)
+        if protocol is not None:
+            mask |= self.service_index.covering(protocol, first, last)
+        return mask
+
+    def candidate_mask(self, match_criteria, match_containing_networks=True, match_containing_services=False,
+                       exact=False):
+        """Return a bitset of the candidate policy positions, or None if the index cannot narrow the search
+        """
+
+        if not isinstance(match_criteria, MatchCriteria):
+            match_criteria = MatchCriteria(match_criteria)
+
+        mask = None
+
+        for key, value in match_criteria.iteritems():
+            if not value:
+                continue
+
+            if key == 'action':
+                key_mask = self._action_mask(value)
+                if key_mask is None:
+                    continue
+            elif match_containing_services and key == 'services' and match_criteria.service_intervals is not None:
+                # the ports of every value must be covered by the policy services
+                key_mask = None
+                for interval in match_criteria.service_intervals:
+                    covering = self._service_mask(*interval)
+                    key_mask = covering if key_mask is None else key_mask & covering
+            elif match_containing_networks and key in self.ADDRESS_KEYS:
+                # every value must be contained by one of the policy addresses
+                key_mask = None
+                for address in match_criteria.address_values[key]:
+                    containing = self.address_indexes[key].containing(address)
+                    key_mask = containing if key_mask is None else key_mask & containing
+            elif exact and key in self.exact_masks:
+                # the policy has to have the very same values
+                key_mask = self.exact_masks[key].get(match_criteria.value_sets[key], 0)
+            elif key in self.value_masks:
+                # subset matches need every value to be present in the policy
+                key_mask = None
+                value_masks = self.value_masks[key]
+                for v in match_criteria.value_sets[key]:
+                    key_mask = value_masks.get(v, 0) if key_mask is None else key_mask & value_masks.get(v, 0)
+            else:
+                continue
+
+            mask = key_mask if mask is None else mask & key_mask
+            if not mask:
+                # nothing left to narrow down
+                break
+
+        return mask
+
+    def candidates(self, match_criteria, match_containing_networks=True, match_containing_services=False,
+                   exact=False):
+        """Return the candidate policies in rule order
+        """
+
+        mask = self.candidate_mask(match_criteria, match_containing_networks, match_containing_services, exact)
+        if mask is None:
+            return self.policies
+
+        return [self.policies[p] for p in iter_bits(mask)]
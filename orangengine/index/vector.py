@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+numpy backed address containment
+
+Optional, everything falls back to the pure python AddressIndex when numpy
+is not installed.
+"""
+from orangengine.index.address import AddressIndex
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+HAS_NUMPY = numpy is not None
+
+# upper bound of the number of (query, range) comparisons done at once by the batch queries
+BATCH_CELLS = 1 << 22
+
+
+class VectorAddressIndex(object):
+    """Address containment index answering batches of ipv4 lookups with numpy
+
+    Built on top of an AddressIndex over the same entries. Its cidr tables of
+    every ipv4 prefix length are kept as sorted network arrays as well, so the
+    longest prefix walk of a whole batch of values is one searchsorted per
+    populated prefix length, and only the hits are or-ed together in python.
+    Single values, ipv6 and fqdn values are looked up in the AddressIndex.
+    """
+
+    def __init__(self, entries):
+        """
+        :param entries: iterable of (address, policy position) tuples, see AddressIndex
+        """
+
+        if not HAS_NUMPY:
+            raise ImportError("numpy is required for VectorAddressIndex")
+
+        self._index = AddressIndex(entries)
+        self.any_mask = self._index.any_mask
+
+        # [(host bits, sorted network array, bitsets in network order)] of the ipv4 prefix lengths
+        self._tables = []
+        for shift, table in self._index._lengths[4]:
+            networks = sorted(table)
+            self._tables.append((shift, numpy.array(networks, dtype=numpy.uint32),
+                                 [table[n] for n in networks]))
+
+        ranges = self._index._ranges[4]
+        self._range_firsts = numpy.array([r[0] for r in ranges], dtype=numpy.uint32)
+        self._range_lasts = numpy.array([r[1] for r in ranges], dtype=numpy.uint32)
+        self._range_masks = [r[2] for r in ranges]
+
+    def containing(self, value):
+        """Return a bitset of the policies that reference an address containing value
+
+        see AddressIndex.containing
+        """
+
+        return self._index.containing(value)
+
+    def containing_batch(self, values):
+        """Return the containing bitset of every value, in order
+        """
+
+        results = [None] * len(values)
+        batch = []
+        for i, value in enumerate(values):
+            if isinstance(value, tuple) and value[0] == 4:
+                batch.append(i)
+                results[i] = self.any_mask
+            else:
+                results[i] = self._index.containing(value)
+
+        if not batch:
+            return results
+
+        firsts = numpy.array([values[i][1] for i in batch], dtype=numpy.uint32)
+        lasts = numpy.array([values[i][2] for i in batch], dtype=numpy.uint32)
+
+        for shift, networks, masks in self._tables:
+            if shift == 32:
+                # the /0 table, numpy shifts of the full width are undefined
+                for row in xrange(len(batch)):
+                    results[batch[row]] |= masks[0]
+                continue
+            queried = firsts >> shift
+            positions = numpy.searchsorted(networks, queried)
+            found = positions < len(networks)
+            found[found] = networks[positions[found]] == queried[found]
+            # the prefix has to contain the whole value
+            found &= queried == (lasts >> shift)
+            for row in numpy.nonzero(found)[0]:
+                results[batch[row]] |= masks[positions[row]]
+
+        if self._range_masks:
+            step = max(1, BATCH_CELLS // len(self._range_masks))
+            for chunk in xrange(0, len(batch), step):
+                hits = ((self._range_firsts[numpy.newaxis, :] <= firsts[chunk:chunk + step, numpy.newaxis]) &
+                        (self._range_lasts[numpy.newaxis, :] >= lasts[chunk:chunk + step, numpy.newaxis]))
+                for row, column in zip(*numpy.nonzero(hits)):
+                    results[batch[chunk + row]] |= self._range_masks[column]
+
+        return results
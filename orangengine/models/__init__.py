@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 from orangengine.models.base import CandidatePolicy
 from orangengine.models.base import EffectivePolicy
+from orangengine.models.base import MatchCriteria
 
-__all__ = ['CandidatePolicy', 'EffectivePolicy', ]
+__all__ = ['CandidatePolicy', 'EffectivePolicy', 'MatchCriteria', ]
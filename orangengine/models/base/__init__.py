@@ -9,8 +9,9 @@ from orangengine.models.base.baseservice import BaseServiceTerm
 from orangengine.models.base.baseservice import BasePortRange
 from orangengine.models.base.basepolicy import CandidatePolicy
 from orangengine.models.base.basepolicy import EffectivePolicy
+from orangengine.models.base.basepolicy import MatchCriteria
 
 
 __all__ = ['BaseAddressGroup', 'BaseAddress', 'BasePolicy', 'BaseService',
            'BaseServiceGroup', 'BaseServiceTerm', 'BasePortRange',
-           'CandidatePolicy', 'EffectivePolicy', 'BaseObject', ]
+           'CandidatePolicy', 'EffectivePolicy', 'MatchCriteria', 'BaseObject', ]
@@ -1,5 +1,5 @@
 # -*- coding: utf-8 -*-
-from orangengine.utils import enum, bidict
+from orangengine.utils import enum, bidict, ip_interval
 from orangengine.models.base import BaseObject
 
 
@@ -20,6 +20,16 @@ class BaseAddress(BaseObject):
         self.value = value
         self.a_type = a_type
 
+        # pre-parsed value used for matching
+        # numeric (version, first, last) intervals for ip values, the raw value otherwise
+        interval = ip_interval(value)
+        if interval is None:
+            self.ip_intervals = ()
+            self.fqdns = (value,)
+        else:
+            self.ip_intervals = (interval,)
+            self.fqdns = ()
+
     def __getattr__(self, item):
 
         if item == 'value':
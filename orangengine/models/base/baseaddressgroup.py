@@ -10,10 +10,16 @@ class BaseAddressGroup(BaseObject):
         self.name = name
         self.elements = list()
 
+        # pre-parsed values of all the elements, see BaseAddress
+        self.ip_intervals = list()
+        self.fqdns = list()
+
     def add(self, address):
         """add an address(group) object to the elements list"""
 
         self.elements.append(address)
+        self.ip_intervals.extend(getattr(address, 'ip_intervals', ()))
+        self.fqdns.extend(getattr(address, 'fqdns', ()))
 
     def __getattr__(self, item):
         """
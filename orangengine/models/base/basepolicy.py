@@ -1,9 +1,9 @@
 # -*- coding: utf-8 -*-
-from orangengine.utils import is_ipv4, enum, bidict, flatten
+from orangengine.utils import ip_interval, service_intervals, enum, bidict, flatten, canonical_text
 from orangengine.models.base import BaseObject
 
 from collections import defaultdict
-from netaddr import IPRange, IPNetwork
+from hashlib import sha1
 from terminaltables import AsciiTable
 from functools import partial
 
@@ -20,6 +20,16 @@ class BasePolicy(BaseObject):
         Action.DROP: 'Drop',
     })
 
+    # the fields (and the action) that decide which traffic a policy matches and what happens to it
+    FINGERPRINT_KEYS = (
+        'source_zones',
+        'destination_zones',
+        'source_addresses',
+        'destination_addresses',
+        'services',
+        'applications',
+    )
+
     def __init__(self, name, action, description, logging):
         """init policy"""
 
@@ -33,20 +43,70 @@ class BasePolicy(BaseObject):
         self.description = description
         self.logging = logging
 
+        # flattened values and pre-parsed addresses, keyed by match key
+        # dropped by the add_* methods when the underlying objects change
+        self._value_cache = dict()
+        self._interval_cache = dict()
+        # (action, digest of the match fields), see fingerprint
+        self._fingerprint = None
+
     def add_src_zone(self, zone):
         self.src_zones.append(zone)
+        self._invalidate('source_zones')
 
     def add_dst_zone(self, zone):
         self.dst_zones.append(zone)
+        self._invalidate('destination_zones')
 
     def add_src_address(self, address):
         self.src_addresses.append(address)
+        self._invalidate('source_addresses')
 
     def add_dst_address(self, address):
         self.dst_addresses.append(address)
+        self._invalidate('destination_addresses')
 
     def add_service(self, service):
         self._services.append(service)
+        self._invalidate('services')
+
+    def _invalidate(self, key):
+        """drop the cached values of the given match key"""
+        self._value_cache.pop(key, None)
+        self._interval_cache.pop(key, None)
+        self._fingerprint = None
+
+    def _flattened_values(self, key, objects):
+        """return the cached set of flattened object values for the given match key"""
+        values = self._value_cache.get(key)
+        if values is None:
+            values = self._value_cache[key] = frozenset(flatten([o.value for o in objects]))
+        return values
+
+    @classmethod
+    def make_fingerprint(cls, values, action):
+        """Return the fingerprint of a rule given the flattened values of its fields (a dict) and its action
+
+        The values of every field are normalized to sorted, de-duplicated text, so the fingerprint
+        does not depend on object names, ordering or the process it was computed in.
+        """
+        fields = []
+        for key in cls.FINGERPRINT_KEYS:
+            fields.append(u','.join(sorted(set(canonical_text(v) for v in values.get(key) or ()))))
+        fields.append(unicode(action))
+        return sha1(u'|'.join(fields).encode('utf-8')).hexdigest()
+
+    @property
+    def fingerprint(self):
+        """Stable digest of the zones, flattened addresses, services, applications and action
+
+        Two policies with the same fingerprint match the same traffic with the same action. Cached
+        until the policy is mutated through its add_* methods.
+        """
+        if self._fingerprint is None or self._fingerprint[0] != self.action:
+            values = dict((key, getattr(self, key, None)) for key in self.FINGERPRINT_KEYS)
+            self._fingerprint = self.action, self.make_fingerprint(values, self.action)
+        return self._fingerprint[1]
 
     def serialize(self):
         """Searialize self to a json acceptable data structure
@@ -87,38 +147,101 @@ class BasePolicy(BaseObject):
         elif item == 'destination_zones':
             return self.dst_zones
         elif item == 'source_addresses':
-            return set(flatten([a.value for a in self.src_addresses]))
+            return self._flattened_values(item, self.src_addresses)
         elif item == 'destination_addresses':
-            return set(flatten([a.value for a in self.dst_addresses]))
+            return self._flattened_values(item, self.dst_addresses)
         elif item == 'services':
-            return set(flatten([s.value for s in self._services]))
+            return self._flattened_values(item, self._services)
         elif item == 'services_objects':
             return self._services
 
         else:
             raise AttributeError()
 
+    def address_intervals(self, key):
+        """
+        return the pre-parsed (ip intervals, fqdns) of the source or destination address objects
+        """
+
+        cached = self._interval_cache.get(key)
+        if cached is not None:
+            return cached
+
+        if key == 'source_addresses':
+            addresses = self.src_addresses
+        elif key == 'destination_addresses':
+            addresses = self.dst_addresses
+        else:
+            raise KeyError(key)
+
+        intervals = []
+        fqdns = set()
+        for a in addresses:
+            intervals.extend(a.ip_intervals)
+            fqdns.update(a.fqdns)
+
+        self._interval_cache[key] = intervals, fqdns
+        return intervals, fqdns
+
+    def service_intervals(self):
+        """
+        return the pre-parsed (protocol number, first port, last port) intervals of the services
+        """
+
+        intervals = self._interval_cache.get('services')
+        if intervals is None:
+            intervals = []
+            for s in self._services:
+                intervals.extend(getattr(s, 'service_intervals', ()))
+            self._interval_cache['services'] = intervals
+        return intervals
+
     @staticmethod
-    def _in_network(value, p_value, exact_match=False):
+    def _parse_services(value):
         """
+        convert service values (protocol, port) or 'any' into numeric service intervals
+        """
+
+        intervals = []
+        for s in value:
+            if s == 'any':
+                intervals.extend(service_intervals('any', 'any'))
+            else:
+                intervals.extend(service_intervals(s[0], s[1]))
+
+        return intervals
 
+    @staticmethod
+    def _parse_addresses(value):
+        """
+        split address values into numeric ip intervals and the remaining (fqdn) values
+        """
+
+        intervals = []
+        fqdns = set()
+        for a in value:
+            interval = ip_interval(a)
+            if interval is None:
+                fqdns.add(a)
+            else:
+                intervals.append(interval)
+
+        return intervals, fqdns
+
+    @staticmethod
+    def _in_intervals(intervals, fqdns, p_intervals, p_fqdns, exact_match=False):
+        """
+        determine if every interval is contained in one of the policy intervals and the fqdns agree
         """
 
         # 'any' address is an automatic match if we are exact
-        if exact_match and 'any' in p_value:
+        if exact_match and 'any' in p_fqdns:
             return True
 
-        addresses = [IPRange(a.split('-')[0], a.split('-')[1]) if '-' in a else IPNetwork(a)
-                     for a in value if is_ipv4(a)]
-        fqdns = [a for a in value if not is_ipv4(a)]
-        p_addresses = [IPRange(a.split('-')[0], a.split('-')[1]) if '-' in a else IPNetwork(a)
-                       for a in p_value if is_ipv4(a)]
-        p_fqdns = [a for a in p_value if not is_ipv4(a)]
-
         # network containment implies exact match... i think?
-        for a in addresses:
-            addr_result = any(a == b or a in b for b in p_addresses)
-            if not addr_result:
+        for version, first, last in intervals:
+            if not any(version == p_version and p_first <= first and last <= p_last
+                       for p_version, p_first, p_last in p_intervals):
                 return False
 
         # now match the fqdns
@@ -129,44 +252,121 @@ class BasePolicy(BaseObject):
 
         return fqdn_result
 
-    def match(self, match_criteria, exact=False, match_containing_networks=True):
+    @staticmethod
+    def _in_service_intervals(intervals, p_intervals):
+        """
+        determine if the ports of every service interval are covered by the policy service intervals
+        """
+
+        for protocol, first, last in intervals:
+            # any protocol policy intervals cover every port of every protocol
+            ranges = sorted((p_first, p_last) for p_protocol, p_first, p_last in p_intervals
+                            if p_protocol is None or p_protocol == protocol)
+            covered = first
+            for p_first, p_last in ranges:
+                if p_first > covered:
+                    # gap
+                    break
+                covered = max(covered, p_last + 1)
+                if covered > last:
+                    break
+            if covered <= last:
+                return False
+
+        return True
+
+    @classmethod
+    def _in_network(cls, value, p_value, exact_match=False):
+        """
+        string based wrapper around _in_intervals
+        """
+
+        intervals, fqdns = cls._parse_addresses(value)
+        p_intervals, p_fqdns = cls._parse_addresses(p_value)
+
+        return cls._in_intervals(intervals, fqdns, p_intervals, p_fqdns, exact_match=exact_match)
+
+    def match(self, match_criteria, exact=False, match_containing_networks=True, match_containing_services=False):
         """
         determine if self is a match for the given criteria
+
+        with match_containing_services, services match when their ports are covered by the port
+        ranges of the policy services rather than by value
         """
+        if not isinstance(match_criteria, MatchCriteria):
+            match_criteria = MatchCriteria(match_criteria)
+
         for key, value in match_criteria.iteritems():
-            if not value:
-                # this key was included but has no value so skip it
-                continue
-
-            p_value = getattr(self, key, [])
-
-            if p_value == 'any' and key in ['source_addresses', 'destination_addresses', 'services']:
-                # 'any' as address constitutes a match, so move on
-                continue
-            elif key == 'action':
-                # compare against the converted value
-                if self.ActionMap[value] != p_value:
-                    return False
-            elif len(value) > len(p_value):
-                # more values in the match than the policy, fail
-                return False
-            elif match_containing_networks and key in ['source_addresses', 'destination_addresses']:
-                if not self._in_network(value, p_value, exact_match=True):
-                    return False
-            elif exact and not set(p_value) == set(value):
-                return False
-            elif not exact and not set(value).issubset(set(p_value)):
+            if not self._match_key(match_criteria, key, value, exact, match_containing_networks,
+                                   match_containing_services):
                 return False
 
         return True
 
-    def candidate_match(self, match_criteria, exact=False, match_containing_networks=True):
+    # result of comparing a single key of the criteria, see _compare_key
+    NO_MATCH, SUBSET_MATCH, EXACT_MATCH = range(3)
+
+    def _match_key(self, match_criteria, key, value, exact, match_containing_networks,
+                   match_containing_services=False):
+        """
+        determine if self is a match for a single key of the compiled criteria
+        """
+        required = self.EXACT_MATCH if exact else self.SUBSET_MATCH
+        return self._compare_key(match_criteria, key, value, match_containing_networks,
+                                 match_containing_services) >= required
+
+    def _compare_key(self, match_criteria, key, value, match_containing_networks, match_containing_services=False):
+        """
+        compare a single key of the compiled criteria with self once, for both exact and subset matching
+
+        returns EXACT_MATCH if the key matches exactly, SUBSET_MATCH if it only matches as a subset
+        and NO_MATCH otherwise
+        """
+        if not value:
+            # this key was included but has no value so skip it
+            return self.EXACT_MATCH
+
+        p_value = getattr(self, key, [])
+
+        if p_value == 'any' and key in ['source_addresses', 'destination_addresses', 'services']:
+            # 'any' as address constitutes a match, so move on
+            return self.EXACT_MATCH
+        elif key == 'action':
+            # compare against the converted value
+            return self.EXACT_MATCH if self.ActionMap[value] == p_value else self.NO_MATCH
+        elif match_containing_services and key == 'services' and match_criteria.service_intervals is not None:
+            if self._in_service_intervals(match_criteria.service_intervals, self.service_intervals()):
+                return self.EXACT_MATCH
+            return self.NO_MATCH
+        elif len(value) > len(p_value):
+            # more values in the match than the policy, fail
+            return self.NO_MATCH
+        elif match_containing_networks and key in ['source_addresses', 'destination_addresses']:
+            intervals, fqdns = match_criteria.addresses[key]
+            p_intervals, p_fqdns = self.address_intervals(key)
+            if self._in_intervals(intervals, fqdns, p_intervals, p_fqdns, exact_match=True):
+                return self.EXACT_MATCH
+            return self.NO_MATCH
+
+        values = match_criteria.value_sets[key]
+        if not values.issubset(p_value):
+            return self.NO_MATCH
+        elif values == frozenset(p_value):
+            return self.EXACT_MATCH
+        return self.SUBSET_MATCH
+
+    def candidate_match(self, match_criteria, exact=False, match_containing_networks=True,
+                        match_containing_services=False):
         """
         wrap the match method in some extra logic to determine if this is a candidate for policy addition
         """
+        if not isinstance(match_criteria, MatchCriteria):
+            match_criteria = MatchCriteria(match_criteria)
+
         unique_key = None
         for key, value in match_criteria.iteritems():
-            match = self.match({key: value}, exact, match_containing_networks)
+            match = self._match_key(match_criteria, key, value, exact, match_containing_networks,
+                                    match_containing_services)
             if not match:
                 if unique_key:
                     # the unique key is already set so we fail
@@ -178,6 +378,35 @@ class BasePolicy(BaseObject):
         # if we survived, this is a candidate policy so return which key is unique
         return unique_key
 
+    def shadow_candidate_match(self, match_criteria, match_containing_networks=True, match_containing_services=False):
+        """
+        compute match (not exact) and candidate_match (exact) with a single comparison per key
+
+        returns a (shadows, unique_key) tuple where shadows is the result of match and unique_key
+        the result of candidate_match
+        """
+        if not isinstance(match_criteria, MatchCriteria):
+            match_criteria = MatchCriteria(match_criteria)
+
+        shadows = True
+        candidate = True
+        unique_key = None
+        for key, value in match_criteria.iteritems():
+            result = self._compare_key(match_criteria, key, value, match_containing_networks,
+                                       match_containing_services)
+            if result == self.NO_MATCH:
+                shadows = False
+            if result != self.EXACT_MATCH:
+                if unique_key:
+                    # the unique key is already set so this is no candidate
+                    candidate = False
+                else:
+                    unique_key = key
+            if not shadows and not candidate:
+                break
+
+        return shadows, unique_key if candidate else False
+
     @staticmethod
     def table_address_cell(addresses, with_names=False):
         return "\n".join([a.table_value(with_names) for a in addresses]) + '\n'
@@ -237,6 +466,46 @@ class BasePolicy(BaseObject):
         return cls(criteria['name'], cls.ActionMap[criteria['action']], criteria.get('description'), logging)
 
 
+class MatchCriteria(dict):
+    """
+    match criteria compiled once so it can be handed to any number of policies (and rulebases)
+
+    Behaves like the criteria dict it was built from, with the values of every key also kept
+    as a frozenset and the addresses and services pre-parsed into numeric intervals. Treat it as read only,
+    compile new criteria rather than modifying an existing one.
+    """
+
+    ADDRESS_KEYS = ('source_addresses', 'destination_addresses')
+
+    def __init__(self, *args, **kwargs):
+
+        super(MatchCriteria, self).__init__(*args, **kwargs)
+
+        # frozen values for set comparisons
+        self.value_sets = dict()
+        for key, value in self.iteritems():
+            if key != 'action' and value:
+                self.value_sets[key] = frozenset(value)
+
+        # pre-parsed addresses, both as (intervals, fqdns) and value by value
+        self.addresses = dict()
+        self.address_values = dict()
+        for key in self.ADDRESS_KEYS:
+            values = self.get(key) or []
+            intervals, fqdns = BasePolicy._parse_addresses(values)
+            self.addresses[key] = intervals, frozenset(fqdns)
+            self.address_values[key] = [ip_interval(v) or v for v in values]
+
+        # pre-parsed service intervals, None if a service cannot be parsed into intervals
+        self.service_intervals = []
+        for value in self.get('services') or []:
+            intervals = BasePolicy._parse_services([value])
+            if not intervals:
+                self.service_intervals = None
+                break
+            self.service_intervals.extend(intervals)
+
+
 class CandidatePolicy(BaseObject):
     """
     candidate policy stores the target element(s) or new policy and a list of the best matched policies
@@ -306,7 +575,7 @@ class CandidatePolicy(BaseObject):
                     new_objects[key][k] = v
 
         if self.context:
-            context = self.context.device_group.name
+            context = self.context.name
         else:
             context = None
 
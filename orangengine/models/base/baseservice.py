@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 from orangengine.models.base import BaseObject
+from orangengine.utils import service_intervals
 
 
 class BasePortRange(BaseObject):
@@ -39,6 +40,9 @@ class BaseServiceTerm(BaseObject):
         self.protocol = protocol if protocol else "unknown"
         self.port = port if port else "unknown"
 
+        # numeric (protocol number, first port, last port) intervals
+        self.service_intervals = service_intervals(*self.value)
+
     def __getattr__(self, item):
 
         if item == 'value':
@@ -78,10 +82,17 @@ class BaseService(BaseObject):
             self.port = port if port else "unknown"
         self.terms = list()
 
+        # numeric (protocol number, first port, last port) intervals
+        self.service_intervals = service_intervals(*self.value)
+
     def add_term(self, term):
         """append a service term"""
 
+        if not self.terms:
+            # the terms replace the protocol and port of the service
+            self.service_intervals = []
         self.terms.append(term)
+        self.service_intervals.extend(term.service_intervals)
 
     def __getattr__(self, item):
 
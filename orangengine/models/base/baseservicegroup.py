@@ -9,11 +9,13 @@ class BaseServiceGroup(BaseObject):
 
         self.name = name
         self.elements = list()
+        self.service_intervals = list()
 
     def add(self, service):
         """add a service"""
 
         self.elements.append(service)
+        self.service_intervals.extend(getattr(service, 'service_intervals', ()))
 
     def __getattr__(self, item):
         """
@@ -25,7 +25,8 @@ class PaloAltoApplicationGroup(BaseObject):
         """
 
         if item == 'value':
-            if isinstance(self.pandevice_object, ApplicationContainer):
+            if isinstance(self.pandevice_object, ApplicationContainer) or \
+                    getattr(self.pandevice_object, 'is_container', False):
                 # we treat app containers like regular apps for the purposes of their value
                 return self.name
             else:
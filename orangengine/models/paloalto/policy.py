@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 from orangengine.models.base import BasePolicy
-from orangengine.utils import bidict, flatten
+from orangengine.utils import bidict, service_intervals
 
 from pandevice import policies
 
@@ -31,6 +31,43 @@ class PaloAltoPolicy(BasePolicy):
 
     def add_application(self, app):
         self._applications.append(app)
+        self._invalidate('applications')
+        # application-default services depend on the applications
+        self._invalidate('services')
+
+    def service_intervals(self):
+        """expand the application-default service into the default ports of the applications"""
+
+        if not any(s.name == 'application-default' for s in self._services):
+            return super(PaloAltoPolicy, self).service_intervals()
+
+        intervals = self._interval_cache.get('services')
+        if intervals is None:
+            intervals = []
+            for s in self._services:
+                if s.name != 'application-default':
+                    intervals.extend(getattr(s, 'service_intervals', ()))
+            intervals.extend(self._application_default_intervals(self._applications))
+            self._interval_cache['services'] = intervals
+        return intervals
+
+    @classmethod
+    def _application_default_intervals(cls, applications):
+        """return the default service intervals of the applications, any when they have no known ports"""
+
+        intervals = []
+        for app in applications:
+            elements = getattr(app, 'elements', None)
+            if elements:
+                # application groups and containers
+                intervals.extend(cls._application_default_intervals(elements))
+            elif app is not None and getattr(app, 'services', None):
+                for s in app.services:
+                    intervals.extend(s.service_intervals)
+            else:
+                # 'any' or identified by something other than ports
+                intervals.extend(service_intervals('any', 'any'))
+        return intervals
 
     def serialize(self):
         """Searialize self to a json acceptable data structure
@@ -49,7 +86,7 @@ class PaloAltoPolicy(BasePolicy):
         """add applications access or call super"""
 
         if item == 'applications':
-            return set(flatten([a.value for a in self._applications]))
+            return self._flattened_values(item, self._applications)
         else:
             return super(PaloAltoPolicy, self).__getattr__(item)
 
@@ -2,13 +2,50 @@
 """
 utility functions
 """
+import os
 from collections import Iterable
+from hashlib import sha1
 
 from netaddr import IPNetwork, IPAddress, IPRange
 from lxml import etree as letree
 
-__all__ = ['is_ipv4', 'missing_cidr', 'enum', 'create_element',
-           'bidict', ]
+__all__ = ['is_ipv4', 'missing_cidr', 'ip_interval', 'protocol_number', 'port_intervals',
+           'service_intervals', 'enum', 'create_element', 'bidict', 'canonical_text', 'value_digest',
+           'file_version', ]
+
+
+# ip protocol numbers by name
+PROTOCOL_NUMBERS = {
+    'icmp': 1,
+    'igmp': 2,
+    'tcp': 6,
+    'udp': 17,
+    'gre': 47,
+    'esp': 50,
+    'ah': 51,
+    'icmp6': 58,
+    'ospf': 89,
+    'pim': 103,
+    'sctp': 132,
+}
+
+# well known destination port names (as used in junos applications)
+PORT_NUMBERS = {
+    'bgp': 179, 'biff': 512, 'bootpc': 68, 'bootps': 67, 'cmd': 514, 'cvspserver': 2401,
+    'dhcp': 67, 'domain': 53, 'eklogin': 2105, 'ekshell': 2106, 'exec': 512, 'finger': 79,
+    'ftp': 21, 'ftp-data': 20, 'http': 80, 'https': 443, 'ident': 113, 'imap': 143,
+    'kerberos-sec': 88, 'klogin': 543, 'kpasswd': 761, 'krb-prop': 754, 'krbupdate': 760,
+    'kshell': 544, 'ldap': 389, 'ldp': 646, 'login': 513, 'mobileip-agent': 434,
+    'mobilip-mn': 435, 'msdp': 639, 'netbios-dgm': 138, 'netbios-ns': 137, 'netbios-ssn': 139,
+    'nfsd': 2049, 'nntp': 119, 'ntalk': 518, 'ntp': 123, 'pop3': 110, 'pptp': 1723,
+    'printer': 515, 'radacct': 1813, 'radius': 1812, 'rip': 520, 'rkinit': 2108, 'smtp': 25,
+    'snmp': 161, 'snmptrap': 162, 'snpp': 444, 'socks': 1080, 'ssh': 22, 'sunrpc': 111,
+    'syslog': 514, 'tacacs': 49, 'tacacs-ds': 65, 'talk': 517, 'telnet': 23, 'tftp': 69,
+    'timed': 525, 'who': 513, 'xdmcp': 177, 'zephyr-clt': 2103, 'zephyr-hm': 2104,
+    'zephyr-srv': 2102,
+}
+
+ANY_PORT = (0, 65535)
 
 
 def is_ipv4(value):
@@ -40,6 +77,92 @@ def missing_cidr(address):
     return address
 
 
+def ip_interval(value):
+    """IP Interval
+
+    :returns a tuple of (version, first, last) integers describing the address
+        space covered by value if it is any kind of ip address (address, network,
+        or range). Else return None.
+    """
+    try:
+        if '-' in value:
+            addr_range = value.split('-')
+            ip = IPRange(addr_range[0], addr_range[1])
+        else:
+            ip = IPNetwork(value)
+    except Exception:
+        return None
+    return ip.version, ip.first, ip.last
+
+
+def protocol_number(protocol):
+    """Protocol Number
+
+    :returns the ip protocol number of protocol, given by name or number. None
+        for 'any' and -1 if the protocol is unknown.
+    """
+    protocol = str(protocol).lower()
+    if protocol == 'any':
+        return None
+    if protocol.isdigit():
+        return int(protocol)
+    return PROTOCOL_NUMBERS.get(protocol, -1)
+
+
+def port_number(port):
+    """Port Number
+
+    :returns the integer port of a flow, 0 for a flow without a port (None or
+        '') and None if the port is not a number, such flows match no policy.
+    """
+    if not port:
+        return 0
+    try:
+        return int(port)
+    except (TypeError, ValueError):
+        return None
+
+
+def port_intervals(port):
+    """Port Intervals
+
+    :returns a list of (first, last) integer port intervals for a port value
+        such as '443', '1024-65535', '80,8080-8090' or a well known port name.
+        Values without a port ('any', 'unknown', None) cover all ports. Parts
+        that cannot be understood are left out.
+    """
+    if port is None or str(port).lower() in ['any', 'unknown', '']:
+        return [ANY_PORT]
+
+    intervals = []
+    for part in str(port).split(','):
+        bounds = [PORT_NUMBERS.get(b.strip(), b.strip()) for b in part.split('-', 1)]
+        try:
+            bounds = [int(b) for b in bounds]
+        except ValueError:
+            continue
+        intervals.append((bounds[0], bounds[-1]))
+    return intervals
+
+
+def service_intervals(protocol, port):
+    """Service Intervals
+
+    :returns a list of (protocol number, first port, last port) tuples for a
+        service value. The protocol number is None for any protocol. Unknown
+        protocols yield no intervals, and ports are not meaningful for anything
+        but tcp, udp and sctp so those protocols cover every port.
+    """
+    number = protocol_number(protocol)
+    if number is None:
+        return [(None,) + ANY_PORT]
+    if number == -1:
+        return []
+    if number not in [PROTOCOL_NUMBERS['tcp'], PROTOCOL_NUMBERS['udp'], PROTOCOL_NUMBERS['sctp']]:
+        return [(number,) + ANY_PORT]
+    return [(number, first, last) for first, last in port_intervals(port)]
+
+
 # Enumerator type
 def enum(*sequential, **named):
     enums = dict(zip(sequential, range(len(sequential))), **named)
@@ -102,3 +225,35 @@ def flatten(l):
                 yield sub
         else:
             yield el
+
+
+def canonical_text(value):
+    """Return the text of a (flattened) value, the same for str and unicode values
+    """
+    if isinstance(value, tuple):
+        return u'/'.join(canonical_text(v) for v in value)
+    if isinstance(value, str):
+        return value.decode('utf-8')
+    return unicode(value)
+
+
+def value_digest(value):
+    """Return a stable digest of an object value, independent of the order of nested values
+    """
+    if value is None:
+        values = []
+    elif isinstance(value, (basestring, tuple)) or not isinstance(value, Iterable):
+        values = [value]
+    else:
+        values = flatten(value)
+    return sha1(u','.join(sorted(set(canonical_text(v) for v in values))).encode('utf-8')).hexdigest()
+
+
+def file_version(*paths):
+    """Return the version of a config read from files, their modification times and sizes
+    """
+    versions = []
+    for path in paths:
+        stat = os.stat(path)
+        versions.append('{0} {1}'.format(stat.st_mtime, stat.st_size))
+    return ', '.join(versions)
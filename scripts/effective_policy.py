@@ -13,16 +13,20 @@ parser.add_argument('target', type=str, help='Target host/network to pull policy
 parser.add_argument('--username', type=str, help='Username to connect to the firewall',)
 parser.add_argument('--password', type=str, help='Password to connect to the firewall', default=None)
 parser.add_argument('--match-containing-networks', type=bool, help='Match target containging networks', default=False)
+parser.add_argument('--cache-dir', type=str, help='Directory to cache the parsed policy in', default=None)
+parser.add_argument('--offline', action='store_true', help='Use the cached policy without connecting to the firewall')
+parser.add_argument('--config-file', type=str, help='Saved config to read, for the juniper_srx_file type', default=None)
 
 args = parser.parse_args()
 
 
-def get_effective_policy(host, target, device_type, username, password, match_containing_networks):
+def get_effective_policy(host, target, device_type, username, password, match_containing_networks, cache_dir=None,
+                         offline=False, config_file=None):
     """
     Use orangeengine to get the effective policy
     """
 
-    if password is None:
+    if password is None and not offline and config_file is None:
         password = getpass()
 
     dev_params = {
@@ -30,7 +34,11 @@ def get_effective_policy(host, target, device_type, username, password, match_co
         'device_type': device_type,
         'username': username,
         'password': password,
+        'cache_dir': cache_dir,
+        'cache_offline': offline,
     }
+    if config_file is not None:
+        dev_params['config_file'] = config_file
 
     dev = orangengine.dispatch(**dev_params)
     dev.refresh()
@@ -39,4 +47,5 @@ def get_effective_policy(host, target, device_type, username, password, match_co
 
 
 if __name__ == '__main__':
-    get_effective_policy(args.firewall, args.target, args.type, args.username, args.password, args.match_containing_networks)
+    get_effective_policy(args.firewall, args.target, args.type, args.username, args.password, args.match_containing_networks,
+                         args.cache_dir, args.offline, args.config_file)
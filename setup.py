@@ -5,8 +5,10 @@ except ImportError:
 
 requirements = ['pandevice', 'lxml', 'netaddr', 'junos-eznc', 'terminaltables']
 packages = ['orangengine',
+            'orangengine/analysis',
             'orangengine/drivers',
             'orangengine/errors',
+            'orangengine/index',
             'orangengine/models',
             'orangengine/models/base',
             'orangengine/models/juniper',
@@ -22,6 +24,7 @@ config = {
     'scripts': [],
     'name': 'orangengine',
     'install_requires': requirements,
+    'extras_require': {'vectorized': ['numpy']},
     'packages': packages
 }
 
@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import orangengine
 from orangengine.models.base import BasePolicy
 from orangengine.models.base import BaseAddress
 from orangengine.models.base import BaseServiceTerm
@@ -18,7 +19,51 @@ from orangengine.models.paloalto import PaloAltoAddressGroup
 from orangengine.models.paloalto import PaloAltoService
 from orangengine.models.paloalto import PaloAltoServiceGroup
 
+from orangengine.models import MatchCriteria
+from orangengine.drivers import BaseDriver
+from orangengine.errors import ShadowedPolicyError
+from orangengine.errors import DuplicatePolicyError
+from orangengine.models import CandidatePolicy
+from orangengine.drivers import JuniperSRXDriver
+from orangengine.drivers import JuniperSRXFileDriver
+from orangengine.drivers._palo_alto_utils import XmlEntry
+from orangengine.drivers._juniper_utils import parse_set_config
+from orangengine.index import AddressIndex
+from orangengine.index import VectorAddressIndex, HAS_NUMPY
+from orangengine.analysis import FlowLogClassifier, pan_traffic_flow, srx_rt_flow
+from orangengine.analysis import ShadowedPolicy
+from orangengine.analysis import Change
+from orangengine.utils import ip_interval, value_digest
+from orangengine.cache import ModelCache
+from orangengine.index import PackedRulebase
+from orangengine.index import packed
+
+from lxml import etree
+
 import unittest
+import os
+import shutil
+import tempfile
+
+
+def build_policy(name, src, dst, services=(('tcp', '443'),), action=BasePolicy.Action.ALLOW, zones=('trust', 'untrust')):
+    policy = JuniperSRXPolicy(name=name, action=action, description='', logging=[])
+    policy.add_src_zone(zones[0])
+    policy.add_dst_zone(zones[1])
+    for a in src:
+        policy.add_src_address(JuniperSRXAddress(name=a, value=a, a_type=BaseAddress.AddressTypes.IPv4))
+    for a in dst:
+        policy.add_dst_address(JuniperSRXAddress(name=a, value=a, a_type=BaseAddress.AddressTypes.IPv4))
+    for protocol, port in services:
+        policy.add_service(JuniperSRXService('{0}-{1}'.format(protocol, port), protocol=protocol, port=port))
+    return policy
+
+
+def build_driver(policies, cls=BaseDriver):
+    driver = cls(username='', password='', host='')
+    for p in policies:
+        driver._add_policy(p)
+    return driver
 
 
 class TestPolicyAddressMatching(unittest.TestCase):
@@ -37,6 +82,1116 @@ class TestPolicyAddressMatching(unittest.TestCase):
         self.assertEqual(self.policy.match({'destination_addresses': ['2.2.2.2/32']}), True)
 
 
+class TestPolicyIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.policies = [
+            build_policy('p0', ['10.0.0.0/8'], ['any']),
+            build_policy('p1', ['10.1.0.0/16'], ['2.2.2.2/32']),
+            build_policy('p2', ['192.168.0.0/24'], ['2.2.2.2/32']),
+            build_policy('p3', ['10.1.1.1-10.1.1.10'], ['2.2.2.2/32']),
+            build_policy('p4', ['www.example.com'], ['2.2.2.2/32']),
+            build_policy('p5', ['any'], ['3.3.3.0/24']),
+        ]
+        self.driver = build_driver(self.policies)
+
+    def test_address_index_containing(self):
+        index = AddressIndex([(ip_interval('10.0.0.0/8'), 0), (ip_interval('10.1.1.0-10.1.1.20'), 1), ('any', 2),
+                              ('www.example.com', 3)])
+        self.assertEqual(index.containing(ip_interval('10.1.1.5/32')), 0b111)
+        self.assertEqual(index.containing(ip_interval('10.1.2.0/24')), 0b101)
+        self.assertEqual(index.containing('www.example.com'), 0b1100)
+
+    def test_policy_match_containing_networks(self):
+        matches = self.driver.policy_match({'source_addresses': ['10.1.1.5']})
+        self.assertEqual([p.name for p in matches], ['p0', 'p1', 'p3', 'p5'])
+
+    def test_policy_match_same_as_scan(self):
+        for criteria in [{'source_addresses': ['10.1.1.5/32'], 'destination_addresses': ['2.2.2.2/32']},
+                         {'destination_addresses': ['3.3.3.3']},
+                         {'source_addresses': ['www.example.com']}]:
+            scan = [p for p in self.policies if p.match(dict(criteria))]
+            self.assertEqual(self.driver.policy_match(dict(criteria)), scan)
+
+
+class TestPreParsedAddresses(unittest.TestCase):
+
+    def test_address_intervals(self):
+        address = JuniperSRXAddress('net', '10.0.0.0/24', BaseAddress.AddressTypes.IPv4)
+        self.assertEqual(address.ip_intervals, ((4, 167772160, 167772415),))
+        self.assertEqual(address.fqdns, ())
+        dns = JuniperSRXAddress('dns', 'www.example.com', BaseAddress.AddressTypes.DNS)
+        self.assertEqual(dns.ip_intervals, ())
+        group = JuniperSRXAddressGroup('group')
+        group.add(address)
+        group.add(dns)
+        self.assertEqual(group.ip_intervals, [(4, 167772160, 167772415)])
+        self.assertEqual(group.fqdns, ['www.example.com'])
+
+    def test_policy_address_intervals(self):
+        policy = build_policy('p', ['10.0.0.0/24', '10.0.1.1-10.0.1.9'], ['any'])
+        self.assertEqual(policy.address_intervals('source_addresses'),
+                         ([(4, 167772160, 167772415), (4, 167772417, 167772425)], set()))
+        self.assertTrue(policy.match({'source_addresses': ['10.0.1.2/32'], 'destination_addresses': ['8.8.8.8/32']}))
+        self.assertFalse(policy.match({'source_addresses': ['10.0.1.2-10.0.1.10']}))
+
+
+class TestPolicyValueCache(unittest.TestCase):
+
+    def test_flattened_values_cached_and_invalidated(self):
+        policy = build_policy('p', ['1.1.1.1/32'], ['2.2.2.2/32'])
+        self.assertIs(policy.source_addresses, policy.source_addresses)
+        self.assertEqual(policy.source_addresses, frozenset(['1.1.1.1/32']))
+
+        group = JuniperSRXAddressGroup('group')
+        group.add(JuniperSRXAddress('a', '3.3.3.3/32', BaseAddress.AddressTypes.IPv4))
+        policy.add_src_address(group)
+        self.assertEqual(policy.source_addresses, frozenset(['1.1.1.1/32', '3.3.3.3/32']))
+        self.assertTrue(policy.match({'source_addresses': ['3.3.3.3/32']}))
+
+        policy.add_service(JuniperSRXService('ssh', protocol='tcp', port='22'))
+        self.assertIn(('tcp', '22'), policy.services)
+
+
+class TestInvertedPolicyIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.policies = [
+            build_policy('p0', ['10.0.0.0/8'], ['2.2.2.2/32'], zones=('trust', 'dmz')),
+            build_policy('p1', ['10.0.0.0/8'], ['2.2.2.2/32'], services=[('tcp', '22'), ('tcp', '443')]),
+            build_policy('p2', ['any'], ['2.2.2.2/32'], action=BasePolicy.Action.DENY),
+            build_policy('p3', ['10.0.0.0/8'], ['any'], services=[('udp', '53')]),
+        ]
+        self.driver = build_driver(self.policies)
+
+    def test_candidates_narrowed(self):
+        criteria = self.driver.compile_match_criteria({'source_zones': ['trust'], 'destination_zones': ['untrust'],
+                                                       'services': [('tcp', '443')], 'action': 'permit'})
+        self.assertEqual(self.driver._get_policy_index().candidates(criteria), [self.policies[1]])
+
+    def test_policy_match_same_as_scan(self):
+        for criteria in [{'source_zones': ['trust'], 'services': [('tcp', 443)]},
+                         {'destination_addresses': ['2.2.2.2'], 'action': 'deny'},
+                         {'services': [('udp', 53), ('tcp', 22)]},
+                         {'services': [('tcp', 22)], 'source_addresses': ['10.0.0.0/8']}]:
+            for exact in [True, False]:
+                for containing in [True, False]:
+                    compiled = self.driver.compile_match_criteria(criteria)
+                    scan = [p for p in self.policies if p.match(compiled, exact, containing)]
+                    self.assertEqual(self.driver.policy_match(criteria, containing, exact), scan)
+
+
+class TestZonePairBuckets(unittest.TestCase):
+
+    def setUp(self):
+        self.policies = [
+            build_policy('p0', ['10.0.0.0/8'], ['any'], zones=('trust', 'untrust')),
+            build_policy('p1', ['10.0.0.0/8'], ['any'], zones=('trust', 'untrust')),
+            build_policy('p2', ['10.0.0.0/8'], ['any'], zones=('trust', 'dmz')),
+            build_policy('p3', ['10.0.0.0/8'], ['any'], zones=('dmz', 'untrust')),
+            build_policy('p4', ['any'], ['any'], zones=('global', 'global')),
+        ]
+        self.driver = build_driver(self.policies, cls=JuniperSRXDriver)
+
+    def test_buckets(self):
+        self.assertEqual(list(self.driver.zone_pair_policies.keys()),
+                         [('trust', 'untrust'), ('trust', 'dmz'), ('dmz', 'untrust')])
+        self.assertEqual(self.driver.get_zone_pair_policies('trust', 'untrust'), self.policies[:2])
+        self.assertEqual(self.driver.global_policies, self.policies[4:])
+
+    def test_policy_match_by_zone(self):
+        for criteria in [{'source_zones': ['trust'], 'source_addresses': ['10.1.1.1']},
+                         {'destination_zones': ['untrust']},
+                         {'source_zones': ['trust'], 'destination_zones': ['dmz']},
+                         {'source_zones': ['global']},
+                         {'source_zones': ['trust', 'dmz']}]:
+            compiled = self.driver.compile_match_criteria(criteria)
+            scan = [p for p in self.policies if p.match(compiled)]
+            self.assertEqual(self.driver.policy_match(criteria), scan)
+
+
+class TestBatchPolicyMatch(unittest.TestCase):
+
+    def setUp(self):
+        self.policies = [
+            build_policy('p0', ['10.0.0.0/8'], ['2.2.2.2/32']),
+            build_policy('p1', ['10.0.0.0/8'], ['3.3.3.3/32'], services=[('tcp', '22')]),
+        ]
+        self.driver = build_driver(self.policies, cls=JuniperSRXDriver)
+        self.criteria = [
+            {'source_addresses': ['10.1.1.1'], 'destination_addresses': ['2.2.2.2']},
+            {'source_zones': ['trust'], 'services': [('tcp', 22)]},
+            {'source_addresses': ['11.1.1.1']},
+        ]
+
+    def test_batch_same_as_single(self):
+        expected = [self.driver.policy_match(dict(c)) for c in self.criteria]
+        self.assertEqual(self.driver.policy_match_batch(self.criteria), expected)
+        self.assertEqual(self.driver.policy_match_batch(self.criteria, policies=self.policies), expected)
+
+    def test_iter_streams_pairs(self):
+        results = self.driver.iter_policy_match(iter(self.criteria))
+        criteria, matches = next(results)
+        self.assertIs(criteria, self.criteria[0])
+        self.assertEqual([p.name for p in matches], ['p0'])
+
+    def test_candidate_batch_keeps_going_when_shadowed(self):
+        results = self.driver.candidate_policy_match_batch([
+            {'source_addresses': ['10.1.1.1'], 'destination_addresses': ['2.2.2.2'], 'services': [('tcp', 443)]},
+            {'source_addresses': ['10.1.1.1'], 'destination_addresses': ['4.4.4.4'], 'services': [('tcp', 22)]},
+        ])
+        self.assertIsInstance(results[0], ShadowedPolicyError)
+        self.assertEqual(results[1].policy_criteria, {'destination_addresses': ['4.4.4.4/32']})
+
+
+class TestMatchCriteria(unittest.TestCase):
+
+    def setUp(self):
+        self.driver = build_driver([
+            build_policy('p0', ['10.0.0.0/8'], ['2.2.2.2/32']),
+            build_policy('p1', ['10.0.0.0/8'], ['3.3.3.3/32'], services=[('tcp', '22')]),
+        ])
+
+    def test_compile_normalizes_once(self):
+        criteria = self.driver.compile_match_criteria({'source_addresses': ['10.1.1.1'], 'services': [('tcp', 443)],
+                                                       'action': 'PERMIT'})
+        self.assertIsInstance(criteria, MatchCriteria)
+        self.assertEqual(criteria['source_addresses'], ['10.1.1.1/32'])
+        self.assertEqual(criteria.value_sets['services'], frozenset([('tcp', '443')]))
+        self.assertEqual(criteria.addresses['source_addresses'], ([(4, 167837953, 167837953)], frozenset()))
+        self.assertIs(self.driver.compile_match_criteria(criteria), criteria)
+
+    def test_compiled_criteria_reused(self):
+        criteria = self.driver.compile_match_criteria({'source_addresses': ['10.1.1.1'], 'services': [('tcp', 22)]})
+        self.assertEqual([p.name for p in self.driver.policy_match(criteria)], ['p1'])
+        self.assertEqual([p.name for p in self.driver.policy_match(criteria, policies=self.driver.policies[:1])], [])
+
+    def test_candidate_policy_match(self):
+        candidate = self.driver.candidate_policy_match({'source_addresses': ['10.1.1.1'],
+                                                        'destination_addresses': ['4.4.4.4'],
+                                                        'services': [('tcp', 22)]})
+        self.assertEqual(candidate.method, candidate.Method.APPEND)
+        self.assertEqual(candidate.policy_criteria, {'destination_addresses': ['4.4.4.4/32']})
+        self.assertEqual([p.name for p in candidate.matched_policies], ['p1'])
+
+
+class TestShadowCandidateMatch(unittest.TestCase):
+
+    def test_same_as_match_and_candidate_match(self):
+        policies = [
+            build_policy('p0', ['10.0.0.0/8'], ['2.2.2.2/32']),
+            build_policy('p1', ['10.0.0.0/8', '11.0.0.0/8'], ['3.3.3.3/32'], services=[('tcp', '22'), ('tcp', '23')]),
+            build_policy('p2', ['any'], ['4.4.4.4/32'], action=BasePolicy.Action.DENY),
+        ]
+        driver = build_driver([])
+        criteria = [
+            {'source_addresses': ['10.1.1.1'], 'destination_addresses': ['2.2.2.2']},
+            {'source_addresses': ['10.1.1.1'], 'destination_addresses': ['5.5.5.5'], 'services': [('tcp', 22)]},
+            {'source_zones': ['trust'], 'services': [('tcp', 22)], 'action': 'permit'},
+            {'destination_addresses': ['4.4.4.4'], 'services': [('tcp', 443)], 'action': 'permit'},
+            {'source_zones': ['dmz'], 'destination_zones': ['dmz']},
+        ]
+        for c in criteria:
+            c = driver.compile_match_criteria(c)
+            for p in policies:
+                self.assertEqual(p.shadow_candidate_match(c),
+                                 (p.match(c), p.candidate_match(c, exact=True)))
+
+
+class TestFlowMatch(unittest.TestCase):
+
+    def setUp(self):
+        self.policies = [
+            build_policy('p0', ['10.1.0.0/16'], ['2.2.2.2/32'], services=[('tcp', '443')]),
+            build_policy('p1', ['10.0.0.0/8'], ['2.2.2.0/24'], services=[('udp', '1000-2000')],
+                         action=BasePolicy.Action.DENY),
+            build_policy('p2', ['10.0.0.0/8'], ['any'], services=[('tcp', '443'), ('tcp', '80')]),
+            build_policy('p3', ['any'], ['any'], services=[('tcp', '22')], zones=('untrust', 'trust')),
+            build_policy('g0', ['any'], ['any'], services=[('tcp', '25')], zones=('global', 'global')),
+        ]
+        self.driver = build_driver(self.policies[:4])
+
+    def test_first_match(self):
+        self.assertEqual(self.driver.flow_match('trust', 'untrust', '10.1.1.1', '2.2.2.2', 'tcp', 443).name, 'p0')
+        self.assertEqual(self.driver.flow_match('trust', 'untrust', '10.2.1.1', '2.2.2.2', 'tcp', 443).name, 'p2')
+        self.assertEqual(self.driver.flow_match('trust', 'untrust', '10.2.1.1', '2.2.2.9', 'udp', 1500).name, 'p1')
+        self.assertEqual(self.driver.flow_match('trust', 'untrust', '10.2.1.1', '2.2.2.9', 'udp', 2001), None)
+        self.assertEqual(self.driver.flow_match('untrust', 'trust', '10.2.1.1', '8.8.8.8', 'tcp', 443), None)
+        self.assertEqual(self.driver.flow_match('untrust', 'trust', '10.2.1.1', '8.8.8.8', 'tcp', 22).name, 'p3')
+
+    def test_evaluator_invalidated(self):
+        self.assertEqual(self.driver.flow_match('untrust', 'trust', '1.1.1.1', '8.8.8.8', 'tcp', 23), None)
+        self.driver._add_policy(build_policy('p4', ['any'], ['any'], services=[('tcp', '20-25')],
+                                             zones=('untrust', 'trust')))
+        self.assertEqual(self.driver.flow_match('untrust', 'trust', '1.1.1.1', '8.8.8.8', 'tcp', 23).name, 'p4')
+
+    def test_iter_flow_match(self):
+        flows = [('trust', 'untrust', '10.1.1.1', '2.2.2.2', 'tcp', 443),
+                 ('trust', 'untrust', '10.1.1.1', '2.2.2.2', 'tcp', 444)]
+        results = [(f, p and p.name) for f, p in self.driver.iter_flow_match(flows)]
+        self.assertEqual(results, [(flows[0], 'p0'), (flows[1], None)])
+
+    def test_srx_global_policies_last(self):
+        driver = build_driver(self.policies, cls=JuniperSRXDriver)
+        self.assertEqual(driver.flow_match('trust', 'untrust', '10.1.1.1', '2.2.2.2', 'tcp', 443).name, 'p0')
+        self.assertEqual(driver.flow_match('trust', 'untrust', '10.1.1.1', '2.2.2.2', 'tcp', 25).name, 'g0')
+        self.assertEqual(driver.flow_match('dmz', 'untrust', '10.1.1.1', '2.2.2.2', 'tcp', 25).name, 'g0')
+
+
+class TestServiceIntervals(unittest.TestCase):
+
+    def setUp(self):
+        self.policies = [
+            build_policy('p0', ['10.0.0.0/8'], ['any'], services=[('tcp', '400-500'), ('tcp', '501-600')]),
+            build_policy('p1', ['10.0.0.0/8'], ['any'], services=[('udp', '53')]),
+            build_policy('p2', ['any'], ['any'], services=[('any', 'any')]),
+        ]
+
+    def test_service_models(self):
+        service = JuniperSRXService('term-service')
+        service.add_term(BaseServiceTerm('t1', 'tcp', BasePortRange('1000', '2000')))
+        service.add_term(BaseServiceTerm('t2', 'udp', 'domain'))
+        self.assertEqual(service.service_intervals, [(6, 1000, 2000), (17, 53, 53)])
+        group = JuniperSRXServiceGroup('group')
+        group.add(service)
+        group.add(JuniperSRXService('icmp', 'icmp', '8,0'))
+        self.assertEqual(group.service_intervals, [(6, 1000, 2000), (17, 53, 53), (1, 0, 65535)])
+        self.assertEqual(self.policies[0].service_intervals(), [(6, 400, 500), (6, 501, 600)])
+
+    def test_range_aware_policy_match(self):
+        driver = build_driver(self.policies)
+        for criteria, names in [
+            ({'services': [('tcp', '443')]}, ['p0', 'p2']),
+            ({'services': [('tcp', '450-550')]}, ['p0', 'p2']),
+            ({'services': [('tcp', '450-650')]}, ['p2']),
+            ({'services': [('udp', '53'), ('tcp', '443')]}, ['p2']),
+            ({'services': [('tcp', '443')], 'source_addresses': ['10.1.1.1']}, ['p0', 'p2']),
+        ]:
+            matches = driver.policy_match(criteria, match_containing_services=True)
+            self.assertEqual([p.name for p in matches], names)
+            matches = driver.policy_match(criteria, policies=self.policies, match_containing_services=True)
+            self.assertEqual([p.name for p in matches], names)
+        self.assertEqual(driver.policy_match({'services': [('tcp', '443')]}), [])
+
+
+class TestExactIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.policies = [
+            build_policy('p0', ['10.0.0.0/8'], ['2.2.2.2/32'], services=[('tcp', '443'), ('tcp', '80')]),
+            build_policy('p1', ['10.0.0.0/8'], ['2.2.2.2/32'], services=[('tcp', '443')]),
+            build_policy('p2', ['10.0.0.0/8'], ['2.2.2.2/32'], services=[('tcp', '80'), ('tcp', '443')]),
+            build_policy('p3', ['10.0.0.0/8'], ['2.2.2.2/32'], services=[('tcp', '443')],
+                         action=BasePolicy.Action.DENY),
+        ]
+        self.driver = build_driver(self.policies)
+
+    def test_exact_candidates(self):
+        index = self.driver._get_policy_index()
+        criteria = self.driver.compile_match_criteria({'services': [('tcp', 443)]})
+        self.assertEqual([p.name for p in index.candidates(criteria, exact=True)], ['p1', 'p3'])
+        self.assertEqual([p.name for p in self.driver.policy_match(criteria, exact=True)],
+                         [p.name for p in self.policies if p.match(criteria, exact=True)])
+
+    def test_duplicates(self):
+        self.assertEqual([[p.name for p in d] for d in self.driver.find_duplicate_policies()], [['p0', 'p2']])
+
+    def test_duplicate_candidate(self):
+        index = self.driver._get_policy_index()
+        criteria = {'source_zones': ['trust'], 'destination_zones': ['untrust'], 'source_addresses': ['10.0.0.0/8'],
+                    'destination_addresses': ['2.2.2.2/32'], 'services': [('tcp', '443')], 'action': 'Allow'}
+        candidate = CandidatePolicy(criteria)
+        with self.assertRaises(DuplicatePolicyError):
+            self.driver._duplicate_candidate_check(candidate, index)
+        candidate = CandidatePolicy({'services': [('tcp', '80')]}, [self.policies[1]], CandidatePolicy.Method.APPEND)
+        with self.assertRaises(DuplicatePolicyError):
+            self.driver._duplicate_candidate_check(candidate, index)
+        candidate = CandidatePolicy({'services': [('tcp', '22')]}, [self.policies[1]], CandidatePolicy.Method.APPEND)
+        self.driver._duplicate_candidate_check(candidate, index)
+
+    def test_fingerprint(self):
+        p0, p1, p2, p3 = self.policies
+        self.assertEqual(p0.fingerprint, p2.fingerprint)
+        self.assertEqual(len(set([p0.fingerprint, p1.fingerprint, p3.fingerprint])), 3)
+        # cached until mutated
+        fingerprint = p1.fingerprint
+        p1.add_src_address(JuniperSRXAddress(name='n', value=u'10.0.0.0/8', a_type=BaseAddress.AddressTypes.IPv4))
+        self.assertEqual(p1.fingerprint, fingerprint)
+        p1.add_src_address(JuniperSRXAddress(name='m', value='11.0.0.0/8', a_type=BaseAddress.AddressTypes.IPv4))
+        self.assertNotEqual(p1.fingerprint, fingerprint)
+        p3.action = BasePolicy.Action.ALLOW
+        self.assertEqual(p3.fingerprint, fingerprint)
+        self.assertEqual(sorted(len(g) for g in self.driver.fingerprint_policies().values()), [1, 1, 2])
+
+
+class TestSnapshotDiff(unittest.TestCase):
+
+    def build(self, names, address_value='10.0.0.0/8', description=''):
+        policies = []
+        for name in names:
+            services = [('tcp', '443'), ('tcp', '22')] if name == 'p0*' else [('tcp', '443')]
+            policy = build_policy(name.rstrip('*'), ['10.0.0.0/8'], ['2.2.2.2/32'], services=services)
+            if name == 'p2':
+                policy.description = description
+            policies.append(policy)
+        driver = build_driver(policies)
+        driver.address_name_lookup['net'] = JuniperSRXAddress(name='net', value=address_value,
+                                                              a_type=BaseAddress.AddressTypes.IPv4)
+        return driver.snapshot()
+
+    def test_no_changes(self):
+        self.assertEqual(len(self.build(['p0', 'p1', 'p2']).diff(self.build(['p0', 'p1', 'p2']))), 0)
+
+    def test_changes(self):
+        old = self.build(['p0', 'p1', 'p2', 'p3', 'p4'])
+        new = self.build(['p4', 'p0*', 'p2', 'p3', 'p5'], address_value='10.0.0.0/16', description='changed')
+        changes = old.diff(new)
+
+        self.assertEqual([c.name for c in changes.added_policies], ['p5'])
+        self.assertEqual([c.name for c in changes.removed_policies], ['p1'])
+        self.assertEqual([(c.name, c.fields) for c in changes.modified_policies],
+                         [('p0', ['match']), ('p2', ['attributes'])])
+        self.assertEqual([(c.name, c.old_position, c.new_position) for c in changes.moved_policies], [('p4', 4, 0)])
+        self.assertEqual([(c.kind, c.name) for c in changes.object_changes], [(Change.Kind.MODIFIED, 'net')])
+        self.assertIn('p5', changes.table())
+
+    def test_objects_without_value(self):
+        old = self.build(['p0'])
+        new = self.build(['p0'], address_value=None)
+        self.assertEqual([(c.kind, c.name) for c in old.diff(new).object_changes], [(Change.Kind.MODIFIED, 'net')])
+        self.assertEqual(len(new.diff(self.build(['p0'], address_value=None))), 0)
+        self.assertNotEqual(value_digest(8443), value_digest(None))
+
+
+class TestModelCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.policies = [
+            build_policy('p0', ['10.0.0.0/8'], ['2.2.2.2/32']),
+            build_policy('p1', ['any'], ['any'], zones=('global', 'global')),
+        ]
+        self.driver = build_driver(self.policies, JuniperSRXDriver)
+        self.driver.address_name_lookup['net'] = self.policies[0].src_addresses[0]
+        self.driver.model_cache = ModelCache(self.directory)
+        self.identity = self.driver._cache_identity()
+        self.driver.model_cache.save(self.identity, 'v1', self.driver._model_state(), self.driver.device)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_offline_refresh(self):
+        # the host is bogus, so loading anything but the cached model would fail
+        driver = JuniperSRXDriver(username='', password='', host='', cache_dir=self.directory, cache_offline=True)
+        driver.refresh()
+        self.assertEqual([p.name for p in driver.policies], ['p0', 'p1'])
+        self.assertEqual([p.name for p in driver.global_policies], ['p1'])
+        self.assertEqual(driver.policies[0].fingerprint, self.policies[0].fingerprint)
+        self.assertIs(driver.address_name_lookup['net'], driver.policies[0].src_addresses[0])
+        self.assertEqual(driver.flow_match('trust', 'untrust', '10.1.1.1', '2.2.2.2', 'tcp', 443).name, 'p0')
+        self.assertEqual(driver.flow_match('trust', 'dmz', '10.1.1.1', '2.2.2.2', 'tcp', 443).name, 'p1')
+
+    def test_version(self):
+        cache = self.driver.model_cache
+        self.assertEqual(cache.version(self.identity), 'v1')
+        self.assertIsNone(cache.load(self.identity, 'v2'))
+        self.assertEqual(len(cache.load(self.identity, 'v1')['policies']), 2)
+        self.assertIsNone(cache.load(('JuniperSRXDriver', 'other')))
+
+
+def zone_set_xml(zone_pair, rules):
+    if zone_pair == ('global', 'global'):
+        head, tail = '<global>', '</global>'
+    else:
+        head = '<policy><from-zone-name>{0}</from-zone-name><to-zone-name>{1}</to-zone-name>'.format(*zone_pair)
+        tail = '</policy>'
+    return head + ''.join(
+        '<policy><name>{0}</name><match><source-address>net</source-address><destination-address>host'
+        '</destination-address><application>https</application></match><then><{1} /></then></policy>'.format(*r)
+        for r in rules) + tail
+
+
+class PatchedJuniperSRXDriver(JuniperSRXDriver):
+
+    zone_pair_configs = {}
+
+    def _get_zone_pair_config(self, zone_pair):
+        xml = self.zone_pair_configs.get(zone_pair)
+        return etree.fromstring(xml) if xml else None
+
+
+class TestIncrementalRefresh(unittest.TestCase):
+
+    def setUp(self):
+        self.driver = PatchedJuniperSRXDriver(username='', password='', host='')
+        self.driver.address_name_lookup['net'] = JuniperSRXAddress(name='net', value='10.0.0.0/8',
+                                                                   a_type=BaseAddress.AddressTypes.IPv4)
+        self.driver.address_name_lookup['host'] = JuniperSRXAddress(name='host', value='2.2.2.2/32',
+                                                                    a_type=BaseAddress.AddressTypes.IPv4)
+        self.driver.service_name_lookup['https'] = JuniperSRXService('https', protocol='tcp', port='443')
+        self.driver.config_output['policies'] = etree.fromstring('<policies>' + ''.join([
+            zone_set_xml(('trust', 'untrust'), [('p0', 'permit')]),
+            zone_set_xml(('trust', 'dmz'), [('p1', 'permit')]),
+            zone_set_xml(('global', 'global'), [('p2', 'deny')]),
+        ]) + '</policies>')
+        self.driver._parse_policies()
+        self.driver._model_loaded()
+
+    def test_parse_config_diff(self):
+        diff = '\n'.join([
+            '[edit security policies from-zone trust to-zone untrust]',
+            '+    policy p3 {',
+            '[edit security policies global]',
+            '-    policy p2 {',
+        ])
+        self.assertEqual(JuniperSRXDriver._parse_config_diff(diff),
+                         (set(['policies']), set([('trust', 'untrust'), ('global', 'global')])))
+        diff = '[edit security address-book global]\n[edit security policies]\n'
+        self.assertEqual(JuniperSRXDriver._parse_config_diff(diff), (set(['policies', 'address_book']), None))
+        self.assertIsNone(JuniperSRXDriver._parse_config_diff('[edit groups junos-defaults]'))
+        self.assertEqual(JuniperSRXDriver._parse_config_diff(''), (set(), set()))
+
+    def test_changed_hierarchies(self):
+        driver = self.driver
+        driver.device = type('FakeDevice', (object,), {})()
+        driver.device.rpc = FakeJuniperCompareRPC(
+            [('admin', '2017-01-01 10:00:01 UTC'), ('admin', '2017-01-01 10:00:01 UTC'),
+             ('admin', '2017-01-01 10:00:00 UTC')],
+            {'1': '[edit security policies from-zone trust to-zone untrust]\n[edit applications]',
+             '0': '[edit security policies global]'})
+
+        # commits of the same second and author have versions of their own
+        versions = driver._commit_versions(driver._commit_history())
+        self.assertEqual(len(set(versions)), 3)
+        self.assertEqual(driver._config_version(), versions[0])
+
+        # the uncommitted candidate edits are added, the sections are then pulled from the committed config
+        driver.config_version = versions[1]
+        self.assertEqual(driver._changed_hierarchies(versions),
+                         (set(['policies', 'output_applications']),
+                          set([('trust', 'untrust'), ('global', 'global')])))
+        self.assertEqual(driver.device.rpc.rollbacks, ['1', '0'])
+
+    def test_patch_zone_pairs(self):
+        driver = self.driver
+        self.assertEqual(driver.flow_match('trust', 'dmz', '10.1.1.1', '2.2.2.2', 'tcp', 443).name, 'p1')
+        dmz_index = driver._get_zone_pair_index(('trust', 'dmz'))
+
+        driver.zone_pair_configs = {
+            ('trust', 'untrust'): zone_set_xml(('trust', 'untrust'), [('p3', 'deny'), ('p0', 'permit')]),
+            ('untrust', 'trust'): zone_set_xml(('untrust', 'trust'), [('p4', 'permit')]),
+        }
+        driver._patch_model(set(['policies']), set([('trust', 'untrust'), ('untrust', 'trust'), ('global', 'global')]))
+        driver._model_loaded()
+
+        self.assertEqual([p.name for p in driver.policies], ['p3', 'p0', 'p1', 'p4'])
+        self.assertEqual(driver.global_policies, [])
+        self.assertIs(driver._get_zone_pair_index(('trust', 'dmz')), dmz_index)
+        self.assertEqual(driver.flow_match('trust', 'untrust', '10.1.1.1', '2.2.2.2', 'tcp', 443).name, 'p3')
+        self.assertEqual(driver.flow_match('untrust', 'trust', '10.1.1.1', '2.2.2.2', 'tcp', 443).name, 'p4')
+        self.assertEqual([c.name for c in driver.changes.added_policies], ['p3', 'p4'])
+        self.assertEqual([c.name for c in driver.changes.removed_policies], ['p2'])
+
+
+class FakeJuniperCompareRPC(object):
+
+    def __init__(self, history, diffs):
+        self.history = history
+        self.diffs = diffs
+        self.rollbacks = []
+
+    def get_commit_information(self):
+        return etree.fromstring('<commit-information>' + ''.join(
+            '<commit-history><sequence-number>{0}</sequence-number><user>{1}</user>'
+            '<date-time>{2}</date-time></commit-history>'.format(i, user, date_time)
+            for i, (user, date_time) in enumerate(self.history)) + '</commit-information>')
+
+    def get_configuration(self, options):
+        self.rollbacks.append(options['rollback'])
+        return etree.fromstring('<rpc-reply><configuration-output>{0}</configuration-output></rpc-reply>'.format(
+            self.diffs[options['rollback']]))
+
+
+class FakeJuniperRPC(object):
+
+    def __init__(self, configuration):
+        self.configuration = configuration
+        self.filters = []
+
+    def get_config(self, filter_xml=None, options=None):
+        self.filters.append(filter_xml)
+        self.options = options
+        self.reply = etree.fromstring(self.configuration)
+        return self.reply
+
+
+class TestJuniperSRXConfig(unittest.TestCase):
+
+    CONFIGURATION = (
+        '<configuration><groups><name>junos-defaults</name><applications><application><name>https</name>'
+        '<protocol>tcp</protocol><destination-port>443</destination-port></application></applications></groups>'
+        '<groups><name>other</name><applications><application><name>ssh</name>'
+        '<protocol>tcp</protocol><destination-port>22</destination-port></application></applications></groups>'
+        '<system><host-name>srx</host-name></system>'
+        '<security><address-book><name>global</name>'
+        '<address><name>net</name><ip-prefix>10.0.0.0/8</ip-prefix></address>'
+        '<address><name>host</name><ip-prefix>2.2.2.2/32</ip-prefix></address>'
+        '<address-set><name>hosts</name><address><name>host</name></address></address-set>'
+        '</address-book><policies>' + zone_set_xml(('trust', 'untrust'), [('p0', 'permit'), ('p1', 'deny')]) +
+        zone_set_xml(('global', 'global'), [('p2', 'deny')]) + '</policies></security>'
+        '<applications><application><name>dns</name><protocol>udp</protocol>'
+        '<destination-port>53</destination-port></application></applications>'
+        '</configuration>'
+    )
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.driver = JuniperSRXDriver(username='', password='', host='')
+        self.driver.device = type('FakeDevice', (object,), {})()
+        self.driver.device.rpc = FakeJuniperRPC(self.CONFIGURATION)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_single_rpc(self):
+        driver = self.driver
+        driver._get_config()
+        self.assertEqual(len(driver.device.rpc.filters), 1)
+        self.assertEqual(driver.device.rpc.options, {'database': 'committed'})
+        self.assertEqual(driver.config_output['address_book'].tag, 'address-book')
+        self.assertEqual(len(driver.config_output['output_applications']), 1)
+        # applications of other groups are not part of the model
+        self.assertEqual(len(driver.config_output['output_junos_default']), 1)
+
+        for parse in [driver._parse_addresses, driver._parse_address_groups, driver._parse_services,
+                      driver._parse_service_groups, driver._parse_policies]:
+            parse()
+        self.assertEqual(driver.flow_match('trust', 'untrust', '10.1.1.1', '2.2.2.2', 'tcp', 443).name, 'p0')
+
+    def test_streaming(self):
+        self.driver._get_config()
+        self.driver._parse_config()
+
+        driver = JuniperSRXDriver(username='', password='', host='', streaming=True)
+        driver.device = self.driver.device
+        driver._get_config()
+        driver._parse_config()
+
+        self.assertEqual(driver.config_output, {})
+        self.assertEqual([p.name for p in driver.policies], [p.name for p in self.driver.policies])
+        self.assertEqual([p.fingerprint for p in driver.policies], [p.fingerprint for p in self.driver.policies])
+        self.assertEqual(sorted(driver.address_name_lookup), ['any', 'host', 'net'])
+        self.assertEqual(sorted(driver.address_group_name_lookup), ['hosts'])
+        self.assertEqual(sorted(driver.service_name_lookup), sorted(self.driver.service_name_lookup))
+        self.assertNotIn('ssh', driver.service_name_lookup)
+        self.assertEqual(driver.flow_match('trust', 'dmz', '10.1.1.1', '2.2.2.2', 'tcp', 443).name, 'p2')
+
+        # the consumed hierarchies are released
+        self.assertEqual([len(e) for e in driver.device.rpc.reply], [0, 0, 0, 0])
+
+    def test_cached_config_output(self):
+        driver = self.driver
+        driver._get_config()
+        driver.model_cache = ModelCache(self.directory)
+        driver.config_version = 'v1'
+        driver._save_cached_model()
+
+        cached = JuniperSRXDriver(username='', password='', host='', cache_dir=self.directory)
+        self.assertTrue(cached._load_cached_model('v1'))
+        self.assertEqual(cached.config_output['policies'].find('policy/policy/name').text, 'p0')
+
+
+class TestJuniperSRXFileDriver(unittest.TestCase):
+
+    SET_LINES = [
+        'set version 15.1X49-D100',
+        'set system host-name srx',
+        'set groups junos-defaults applications application https protocol tcp',
+        'set groups junos-defaults applications application https destination-port 443',
+        'set groups other applications application ssh protocol tcp',
+        'set security address-book global address net 10.0.0.0/8',
+        'set security address-book global address host 2.2.2.2/32',
+        'set security address-book global address-set hosts address host',
+        'set security policies from-zone trust to-zone untrust policy p0 description "first policy"',
+        'set security policies from-zone trust to-zone untrust policy p0 match source-address net',
+        'set security policies from-zone trust to-zone untrust policy p0 match destination-address host',
+        'set security policies from-zone trust to-zone untrust policy p0 match application https',
+        'set security policies from-zone trust to-zone untrust policy p0 then permit',
+        'set security policies from-zone trust to-zone untrust policy p1 match source-address net',
+        'set security policies from-zone trust to-zone untrust policy p1 match destination-address host',
+        'set security policies from-zone trust to-zone untrust policy p1 match application https',
+        'set security policies from-zone trust to-zone untrust policy p1 then deny',
+        'set security policies global policy p2 match source-address net',
+        'set security policies global policy p2 match destination-address host',
+        'set security policies global policy p2 match application https',
+        'set security policies global policy p2 then deny',
+        'set security policies default-policy deny-all',
+        'set applications application dns protocol udp',
+        'set applications application dns destination-port 53',
+    ]
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.reference = JuniperSRXDriver(username='', password='', host='')
+        self.reference.device = type('FakeDevice', (object,), {})()
+        self.reference.device.rpc = FakeJuniperRPC(TestJuniperSRXConfig.CONFIGURATION)
+        self.reference._get_config()
+        self.reference._parse_config()
+
+        self.xml_file = os.path.join(self.directory, 'srx.xml')
+        with open(self.xml_file, 'w') as f:
+            f.write('<rpc-reply xmlns:junos="http://xml.juniper.net/junos/15.1X49/junos">\n' +
+                    TestJuniperSRXConfig.CONFIGURATION.replace(
+                        '<configuration>', '<configuration xmlns="http://xml.juniper.net/xnm/1.1/xnm">') +
+                    '\n<!-- end -->\n</rpc-reply>\n')
+        self.set_file = os.path.join(self.directory, 'srx.set')
+        with open(self.set_file, 'w') as f:
+            f.write('\n'.join(self.SET_LINES) + '\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_formats(self):
+        for config_file in [self.xml_file, self.set_file]:
+            for streaming in [False, True]:
+                driver = orangengine.dispatch(device_type='juniper_srx_file', config_file=config_file,
+                                              streaming=streaming)
+                driver.refresh()
+                self.assertEqual([(p.name, p.fingerprint) for p in driver.policies],
+                                 [(p.name, p.fingerprint) for p in self.reference.policies])
+                self.assertEqual(sorted(driver.address_group_name_lookup), ['hosts'])
+                self.assertEqual(sorted(driver.service_name_lookup), ['dns', 'https'])
+                self.assertEqual(driver.flow_match('trust', 'dmz', '10.1.1.1', '2.2.2.2', 'tcp', 443).name, 'p2')
+
+        self.assertEqual(driver.policy_name_lookup['p0'].description, 'first policy')
+        self.assertEqual(JuniperSRXFileDriver(config_file=self.xml_file).config_format, 'xml')
+
+    def test_model_cache(self):
+        driver = JuniperSRXFileDriver(config_file=self.set_file, cache_dir=self.directory)
+        driver.refresh()
+        self.assertEqual(driver.model_cache.version(driver._cache_identity()), driver._config_version())
+
+    def test_undefined_applications(self):
+        with open(self.set_file, 'w') as f:
+            f.write('\n'.join([
+                'set security address-book global address net 10.0.0.0/8',
+                'set applications application-set web application junos-http',
+                'set security policies global policy p0 match source-address net',
+                'set security policies global policy p0 match destination-address any',
+                'set security policies global policy p0 match application web',
+                'set security policies global policy p0 then deny',
+                'set security policies global policy p1 match source-address net',
+                'set security policies global policy p1 match destination-address any',
+                'set security policies global policy p1 match application any',
+                'set security policies global policy p1 then permit',
+            ]) + '\n')
+        driver = JuniperSRXFileDriver(config_file=self.set_file)
+        driver.refresh()
+
+        p0, p1 = driver.policies
+        self.assertEqual(p1.services, frozenset([('any', 'any')]))
+        self.assertEqual(p0.services, frozenset([('unknown', 'unknown')]))
+        # junos-http is not known without the junos-defaults group, so p0 matches no flow
+        self.assertEqual(driver.flow_match('trust', 'untrust', '10.1.1.1', '2.2.2.2', 'tcp', 80).name, 'p1')
+
+    def test_inactive_and_ranges(self):
+        with open(self.set_file, 'w') as f:
+            f.write('\n'.join([
+                'set security address-book global address r1 range-address 10.0.0.1 to 10.0.0.9',
+                'set security address-book global address old 10.0.0.0/8',
+                'deactivate security address-book global address old',
+                'set security policies global policy p0 match source-address old',
+                'set security policies global policy p0 match destination-address any',
+                'set security policies global policy p0 match application any',
+                'set security policies global policy p0 then deny',
+                'deactivate security policies global policy p0',
+                'set security policies global policy p1 match source-address r1',
+                'set security policies global policy p1 match destination-address any',
+                'set security policies global policy p1 match application any',
+                'set security policies global policy p1 then permit',
+            ]) + '\n')
+        xml_file = os.path.join(self.directory, 'inactive.xml')
+        with open(xml_file, 'w') as f:
+            f.write('<configuration><security><address-book><name>global</name>'
+                    '<address><name>r1</name><range-address><name>10.0.0.1</name>'
+                    '<to><range-high>10.0.0.9</range-high></to></range-address></address>'
+                    '<address inactive="inactive"><name>old</name><ip-prefix>10.0.0.0/8</ip-prefix></address>'
+                    '</address-book><policies><global>'
+                    '<policy inactive="inactive"><name>p0</name><match><source-address>old</source-address>'
+                    '<destination-address>any</destination-address><application>any</application></match>'
+                    '<then><deny /></then></policy>'
+                    '<policy><name>p1</name><match><source-address>r1</source-address>'
+                    '<source-address inactive="inactive">any</source-address>'
+                    '<destination-address>any</destination-address><application>any</application></match>'
+                    '<then><permit /></then></policy>'
+                    '</global></policies></security></configuration>')
+
+        for config_file in [self.set_file, xml_file]:
+            for streaming in [False, True]:
+                driver = JuniperSRXFileDriver(config_file=config_file, streaming=streaming)
+                driver.refresh()
+                self.assertEqual([p.name for p in driver.policies], ['p1'])
+                self.assertNotIn('old', driver.address_name_lookup)
+                self.assertEqual(driver.address_name_lookup['r1'].value, '10.0.0.1-10.0.0.9')
+                self.assertEqual(driver.flow_match('trust', 'untrust', '10.0.0.5', '2.2.2.2', 'tcp', 80).name, 'p1')
+                self.assertIsNone(driver.flow_match('trust', 'untrust', '10.0.0.10', '2.2.2.2', 'tcp', 80))
+
+    def test_set_statements(self):
+        configuration = parse_set_config([
+            'set security address-book global address r1 range-address 10.0.0.1 to 10.0.0.9',
+            'set security address-book global address w1 wildcard-address 10.0.0.0/255.0.255.0',
+            'set security policies global policy p3 match dynamic-application junos:HTTP',
+            'set security policies global policy p3 match application any',
+            'set security policies global policy p3 then permit application-services idp-policy 10.0.0.1',
+            'set security policies global policy p3 then log session-init',
+        ])
+        book = configuration.find('security/address-book')
+        self.assertEqual(book.findtext("address[name='r1']/range-address/low"), '10.0.0.1')
+        self.assertEqual(book.findtext("address[name='r1']/range-address/high"), '10.0.0.9')
+        self.assertEqual(book.findtext("address[name='w1']/wildcard-address"), '10.0.0.0/255.0.255.0')
+
+        policy = configuration.find("security/policies/global/policy[name='p3']")
+        self.assertEqual(policy.findtext('match/dynamic-application'), 'junos:HTTP')
+        self.assertEqual(policy.findtext('match/application'), 'any')
+        # the unknown permit option is skipped, the action is kept
+        self.assertEqual([e.tag for e in policy.find('then')], ['permit', 'log'])
+        self.assertEqual(len(policy.find('then/permit')), 0)
+
+
+def pan_entries(tag, entries):
+    return '<{0}>{1}</{0}>'.format(tag, ''.join('<entry name="{0}">{1}</entry>'.format(*e) for e in entries))
+
+
+def pan_rule(name, source, application, service, action):
+    return (name, '<from><member>any</member></from><to><member>any</member></to>'
+                  '<source><member>{0}</member></source><destination><member>any</member></destination>'
+                  '<application><member>{1}</member></application><service><member>{2}</member></service>'
+                  '<action>{3}</action><log-end>yes</log-end>'.format(source, application, service, action))
+
+
+class TestPanoramaConfigFile(unittest.TestCase):
+
+    CONFIG = (
+        '<config>'
+        '<shared>' +
+        pan_entries('address', [('bad', '<ip-netmask>10.6.6.6/32</ip-netmask>')]) +
+        pan_entries('service', [('tcp-8443', '<protocol><tcp><port>8443</port></tcp></protocol>')]) +
+        pan_entries('pre-rulebase', [('security', '')]).replace(
+            '<entry name="security"></entry>',
+            '<security>' + pan_entries('rules', [pan_rule('deny-bad', 'bad', 'any', 'any', 'deny')]) + '</security>') +
+        '</shared>'
+        '<devices><entry name="localhost.localdomain"><device-group>' +
+        ''.join('<entry name="{0}">{1}</entry>'.format(*dg) for dg in [
+            ('parent', pan_entries('address', [('net', '<ip-netmask>10.0.0.0/8</ip-netmask>')]) +
+             pan_entries('address-group', [('nets', '<static><member>net</member></static>')]) +
+             '<post-rulebase><security>' +
+             pan_entries('rules', [pan_rule('allow-web', 'nets', 'web', 'application-default', 'allow')]) +
+             '</security></post-rulebase>'),
+            ('child', pan_entries('address', [('net', '<ip-netmask>10.1.0.0/16</ip-netmask>')]) +
+             pan_entries('application-group', [('web', '<members><member>ssl</member></members>')]) +
+             '<post-rulebase><security>' +
+             pan_entries('rules', [pan_rule('allow-8443', 'net', 'any', 'tcp-8443', 'allow')]) +
+             '</security></post-rulebase>'),
+            ('other', pan_entries('address', [('net', '<ip-netmask>10.9.0.0/16</ip-netmask>')]) +
+             '<pre-rulebase><security>' +
+             pan_entries('rules', [pan_rule('allow-other', 'net', 'web', 'application-default', 'allow')]) +
+             '</security></pre-rulebase>'),
+        ]) +
+        '</device-group></entry></devices>'
+        '<readonly><devices><entry name="localhost.localdomain"><device-group>'
+        '<entry name="parent" />'
+        '<entry name="child"><parent-dg>parent</parent-dg></entry>'
+        '</device-group></entry></devices></readonly>'
+        '</config>'
+    )
+
+    PREDEFINED = (
+        '<response><result><predefined>' +
+        pan_entries('application', [('ssl', '<default><port><member>tcp/443</member></port></default>'),
+                                    ('ping', '<default><ident-by-icmp-type><type>8</type></ident-by-icmp-type>'
+                                             '</default>')]) +
+        pan_entries('application-container', [('web', '<functions><member>ssl</member></functions>')]) +
+        '</predefined></result></response>'
+    )
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.config_file = os.path.join(self.directory, 'running-config.xml')
+        with open(self.config_file, 'w') as f:
+            f.write(self.CONFIG)
+        self.predefined_file = os.path.join(self.directory, 'predefined.xml')
+        with open(self.predefined_file, 'w') as f:
+            f.write(self.PREDEFINED)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_parse(self):
+        driver = orangengine.dispatch(device_type='palo_alto_panorama', config_file=self.config_file,
+                                      predefined_file=self.predefined_file)
+        driver.refresh()
+
+        child = driver.dg_hierarchy.get_node('child')
+        self.assertIs(child.parent, driver.dg_hierarchy.get_node('parent'))
+        self.assertIs(child.parent.parent, driver.dg_hierarchy.root)
+        self.assertIsNone(child.config)
+
+        # names resolve in the device group first, then up the hierarchy
+        self.assertEqual(child.find('net', PaloAltoAddress).value, '10.1.0.0/16')
+        self.assertEqual(child.find('bad', PaloAltoAddress).value, '10.6.6.6/32')
+        # the device group application group shadows the predefined container
+        self.assertEqual(child.find('web', PaloAltoApplicationGroup).value, ['ssl'])
+        self.assertEqual(driver.dg_hierarchy.root.find('web', PaloAltoApplicationGroup).value, 'web')
+
+        self.assertEqual([p.name for p in driver.get_flow_rulebase('child')], ['deny-bad', 'allow-8443', 'allow-web'])
+        self.assertEqual(driver.flow_match('trust', 'untrust', '10.6.6.6', '1.1.1.1', 'tcp', 443, 'child').name,
+                         'deny-bad')
+        self.assertEqual(driver.flow_match('trust', 'untrust', '10.1.1.1', '1.1.1.1', 'tcp', 8443, 'child').name,
+                         'allow-8443')
+        self.assertEqual(driver.flow_match('trust', 'untrust', '10.2.1.1', '1.1.1.1', 'tcp', 443, 'child').name,
+                         'allow-web')
+        self.assertIsNone(driver.flow_match('trust', 'untrust', '10.2.1.1', '1.1.1.1', 'tcp', 80, 'child'))
+        self.assertEqual(driver.dg_hierarchy.root.objects['pre_rulebase'][0].logging, [BasePolicy.Logging.END])
+
+    def test_parse_levels(self):
+        driver = orangengine.dispatch(device_type='palo_alto_panorama', config_file=self.config_file,
+                                      predefined_file=self.predefined_file)
+        driver.refresh()
+
+        self.assertEqual([sorted(n.name for n in level) for level in driver.dg_hierarchy.get_levels()],
+                         [['shared'], ['other', 'parent'], ['child']])
+        self.assertEqual(driver.flow_match('trust', 'untrust', '10.9.1.1', '1.1.1.1', 'tcp', 443, 'other').name,
+                         'allow-other')
+
+    def test_model_cache(self):
+        driver = orangengine.dispatch(device_type='palo_alto_panorama', config_file=self.config_file,
+                                      cache_dir=self.directory)
+        driver.refresh()
+
+        cached = orangengine.dispatch(device_type='palo_alto_panorama', config_file=self.config_file,
+                                      cache_dir=self.directory, cache_offline=True)
+        cached.refresh()
+        self.assertEqual([p.name for p in cached.get_flow_rulebase('child')],
+                         ['deny-bad', 'allow-8443', 'allow-web'])
+
+    def test_without_predefined(self):
+        with open(self.config_file, 'w') as f:
+            f.write(self.CONFIG.replace(
+                pan_entries('rules', [pan_rule('deny-bad', 'bad', 'any', 'any', 'deny')]),
+                pan_entries('rules', [pan_rule('allow-ssl', 'any', 'ssl', 'application-default', 'allow'),
+                                      pan_rule('deny-web-browsing', 'any', 'web-browsing', 'application-default',
+                                               'deny')])))
+        driver = orangengine.dispatch(device_type='palo_alto_panorama', config_file=self.config_file)
+        driver.refresh()
+        root = driver.dg_hierarchy.root
+
+        # predefined applications are stand-ins with their name only
+        allow_ssl, deny_web_browsing = root.objects['pre_rulebase']
+        self.assertEqual(allow_ssl.applications, frozenset(['ssl']))
+        self.assertEqual(deny_web_browsing.applications, frozenset(['web-browsing']))
+        self.assertNotEqual(allow_ssl.fingerprint, deny_web_browsing.fingerprint)
+        self.assertEqual(driver.find_shadowed_policies(root.get_rulebase()), [])
+        self.assertEqual(driver.dg_hierarchy.get_node('child').find('web', PaloAltoApplicationGroup).value,
+                         ['ssl'])
+
+    def test_resolved_lookups(self):
+        driver = orangengine.dispatch(device_type='palo_alto_panorama', config_file=self.config_file,
+                                      predefined_file=self.predefined_file)
+        driver.refresh()
+        root = driver.dg_hierarchy.root
+        parent = driver.dg_hierarchy.get_node('parent')
+        child = driver.dg_hierarchy.get_node('child')
+
+        # the child address shadows the parent one of the same name, by name and by value
+        self.assertEqual(child.find('net', PaloAltoAddress).value, '10.1.0.0/16')
+        self.assertEqual(child.find_by_name_value('net', '10.0.0.0/8', PaloAltoAddress).value, '10.0.0.0/8')
+        self.assertEqual([a.name for a in child.find_by_value('10.0.0.0/8', PaloAltoAddress)], ['net'])
+        self.assertIsNone(child.find('bad', PaloAltoAddress, recursive=False))
+
+        # device groups without services of their own share the shared namespace
+        self.assertIs(child.find('tcp-8443', PaloAltoService), root.find('tcp-8443', PaloAltoService))
+        self.assertIs(child._resolved('name_lookup', 'services'), root.name_lookup['services'])
+
+        # objects inserted after the namespaces were resolved are found from the children
+        service = PaloAltoService(XmlEntry(name='tcp-9443', protocol='tcp', source_port=None,
+                                           destination_port='9443', description=None, tag=None))
+        parent.insert(service)
+        self.assertIs(child.find('tcp-9443', PaloAltoService), service)
+        self.assertIsNone(root.find('tcp-9443', PaloAltoService))
+        self.assertEqual(child.find_by_value(service.value, PaloAltoService), [service])
+
+
+class TestShadowAnalysis(unittest.TestCase):
+
+    def setUp(self):
+        self.policies = [
+            build_policy('p0', ['10.0.0.0/8'], ['any'], services=[('tcp', '1-1024')]),
+            build_policy('p1', ['10.1.0.0/16'], ['2.2.2.2/32'], services=[('tcp', '80')]),
+            build_policy('p2', ['10.1.1.1-10.1.1.10'], ['3.3.3.3/32'], services=[('tcp', '443')],
+                         action=BasePolicy.Action.DENY),
+            build_policy('p3', ['10.0.0.0/8'], ['any'], services=[('tcp', '1000-2000')]),
+            build_policy('p4', ['10.0.0.0/8'], ['any'], services=[('tcp', '443')], zones=('untrust', 'trust')),
+            build_policy('p5', ['any'], ['any'], services=[('tcp', '443')], zones=('untrust', 'trust')),
+            build_policy('p6', ['10.2.0.0/16'], ['any'], services=[('tcp', '443')], zones=('untrust', 'trust')),
+        ]
+
+    def test_shadowed_and_redundant(self):
+        for cls in [BaseDriver, JuniperSRXDriver]:
+            driver = build_driver(self.policies, cls=cls)
+            results = driver.find_shadowed_policies()
+            self.assertEqual([(r.policy.name, r.kind, [p.name for p in r.covered_by]) for r in results], [
+                ('p1', ShadowedPolicy.Kind.REDUNDANT, ['p0']),
+                ('p2', ShadowedPolicy.Kind.SHADOWED, ['p0']),
+                ('p6', ShadowedPolicy.Kind.REDUNDANT, ['p4', 'p5']),
+            ])
+            # the analysis reuses the rulebase indexes of the driver
+            if cls is JuniperSRXDriver:
+                self.assertEqual(len(driver._zone_pair_indexes), 2)
+            else:
+                self.assertIsNotNone(driver.policy_index)
+
+
+@unittest.skipUnless(HAS_NUMPY, 'numpy is not installed')
+class TestVectorizedBackend(unittest.TestCase):
+
+    def setUp(self):
+        self.policies = [
+            build_policy('p0', ['10.1.0.0/16', '2001:db8::/32'], ['2.2.2.2/32']),
+            build_policy('p1', ['10.0.0.0/8'], ['any'], services=[('tcp', '80')]),
+            build_policy('p2', ['192.168.0.0/24'], ['2.2.2.0/24']),
+            build_policy('p3', ['10.1.1.1-10.1.1.10', 'www.example.com'], ['2.2.2.2/32']),
+        ]
+        self.values = [ip_interval(v) or v for v in ['10.1.1.1/32', '10.1.1.0/24', '192.168.0.1/32', '8.8.8.8/32',
+                                                     '2001:db8::1/128', 'www.example.com', 'any']]
+
+    def test_same_as_address_index(self):
+        entries = [(ip_interval(a) or a, i) for i, p in enumerate(self.policies) for a in p.source_addresses]
+        python = AddressIndex(entries)
+        vector = VectorAddressIndex(entries)
+        self.assertEqual([vector.containing(v) for v in self.values], [python.containing(v) for v in self.values])
+        self.assertEqual(vector.containing_batch(self.values), python.containing_batch(self.values))
+
+        # a default route and values only partly inside a prefix
+        entries.append((ip_interval('0.0.0.0/0'), 4))
+        values = self.values + [ip_interval(v) for v in ['10.1.255.0-10.2.0.5', '10.1.1.5-10.1.1.10']]
+        self.assertEqual(VectorAddressIndex(entries).containing_batch(values),
+                         AddressIndex(entries).containing_batch(values))
+
+    def test_vectorized_driver(self):
+        python = build_driver(self.policies)
+        vector = build_driver(self.policies)
+        vector.vectorized = True
+        criteria = {'source_addresses': ['10.1.1.1']}
+        self.assertEqual(vector.policy_match(criteria), python.policy_match(criteria))
+        flows = [('trust', 'untrust', '10.1.1.1', '2.2.2.2', 'tcp', 443),
+                 ('trust', 'untrust', '10.2.1.1', '9.9.9.9', 'tcp', 80),
+                 ('trust', 'untrust', '10.2.1.1', '9.9.9.9', 'tcp', 443)]
+        self.assertEqual(vector.flow_match_batch(flows), [python.flow_match(*f) for f in flows])
+
+
+class TestPackedRulebase(unittest.TestCase):
+
+    FLOWS = [
+        ('trust', 'untrust', '10.1.1.1', '2.2.2.2', 'tcp', 443),
+        ('trust', 'untrust', '10.1.1.1', '2.2.2.3', 'tcp', 443),
+        ('trust', 'untrust', '11.1.1.1', '2.2.2.2', 'udp', 53),
+        ('trust', 'untrust', '2001:db8::1', '2.2.2.2', 'tcp', 8443),
+        ('dmz', 'untrust', '10.1.1.1', '2.2.2.2', 'tcp', 443),
+        ('dmz', 'trust', '10.1.1.1', '2.2.2.2', 'tcp', 22),
+        ('trust', 'untrust', '10.1.1.1', '2.2.2.2', 'icmp', 0),
+    ]
+
+    def setUp(self):
+        self.policies = [
+            build_policy('p0', ['10.1.0.0/16'], ['2.2.2.2/32'], services=[('tcp', '443')]),
+            build_policy('p1', ['2001:db8::/32', 'www.example.com'], ['2.2.2.0/24'], services=[('tcp', '8000-9000')]),
+            build_policy('p2', ['any'], ['any'], services=[('udp', '53'), ('any', 'any')]),
+            build_policy('p3', ['any'], ['2.2.2.2/32'], services=[('tcp', '22')], zones=('global', 'global')),
+        ]
+        self.driver = build_driver(self.policies, cls=JuniperSRXDriver)
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.driver.pack_flow_rulebase(self.path)
+        self.rulebase = PackedRulebase(self.path)
+
+    def tearDown(self):
+        self.rulebase.close()
+        os.remove(self.path)
+
+    def test_fields(self):
+        self.assertEqual(len(self.rulebase), 4)
+        self.assertEqual(self.rulebase.fallback_zone_pair, ('global', 'global'))
+        for policy, view in zip(self.policies, self.rulebase.policies()):
+            self.assertEqual(view.name, policy.name)
+            self.assertEqual(view.action, policy.action)
+            self.assertEqual(view.source_zones, policy.source_zones)
+            for key in ['source_addresses', 'destination_addresses']:
+                self.assertEqual(view.address_intervals(key), policy.address_intervals(key))
+            self.assertEqual(view.service_intervals(), policy.service_intervals())
+
+    def test_evaluate(self):
+        expected = [self.policies.index(p) if p else None for p in self.driver.flow_match_batch(self.FLOWS)]
+        self.assertEqual(self.rulebase.evaluate_batch(self.FLOWS), expected)
+
+        # without numpy, straight out of the mapping
+        numpy_module = packed.numpy
+        packed.numpy = None
+        try:
+            self.assertEqual(self.rulebase.evaluate_batch(self.FLOWS), expected)
+        finally:
+            packed.numpy = numpy_module
+
+
+    def test_unparseable(self):
+        # p2 is any to any, so these would hit it if the bad fields were taken for any
+        flows = [('trust', 'untrust', 'garbage', '2.2.2.2', 'udp', 53),
+                 ('trust', 'untrust', '10.1.1.1', None, 'udp', 53),
+                 ('trust', 'untrust', '10.1.1.1', '2.2.2.2', 'udp', 'dns')]
+        self.assertEqual([self.driver.flow_match(*f) for f in flows], [None] * 3)
+        self.assertEqual(self.driver.flow_match_batch(flows), [None] * 3)
+        self.assertEqual(self.rulebase.evaluate_batch(flows), [None] * 3)
+        self.assertEqual(self.driver.flow_match('trust', 'untrust', '10.1.1.1', '2.2.2.2', 'udp', '53').name, 'p2')
+
+class TestFlowLogs(unittest.TestCase):
+
+    PAN_LINE = ('1,2017/01/01 00:00:00,0001,TRAFFIC,end,1,2017/01/01 00:00:00,{src},{dst},0.0.0.0,0.0.0.0,'
+                'rule,,,ssl,vsys1,trust,untrust,ethernet1/1,ethernet1/2,fwd,2017/01/01 00:00:00,1,1,51234,{port},'
+                '0,0,0x0,tcp,allow,100,50,50,2')
+    SRX_LINE = ('<14>1 2017-01-01T00:00:00 srx RT_FLOW - RT_FLOW_SESSION_CREATE [junos@2636.1.1.1.2.40 '
+                'source-address="10.1.1.1" source-port="51234" destination-address="2.2.2.2" '
+                'destination-port="22" service-name="junos-ssh" protocol-id="6" policy-name="p3" '
+                'source-zone-name="untrust" destination-zone-name="trust"]')
+    SRX_PLAIN_LINE = ('srx RT_FLOW: RT_FLOW_SESSION_CREATE: session created 10.1.1.1/51234->2.2.2.2/22 0x0 '
+                      'junos-ssh 10.1.1.1/51234->2.2.2.2/22 0x0 N/A N/A N/A N/A 6 p3 untrust trust 1234 N/A(N/A)')
+
+    def setUp(self):
+        self.policies = [
+            build_policy('p0', ['10.1.0.0/16'], ['2.2.2.2/32'], services=[('tcp', '443')]),
+            build_policy('p1', ['10.0.0.0/8'], ['any'], services=[('tcp', '80')]),
+            build_policy('p2', ['any'], ['any'], services=[('tcp', '22')], zones=('untrust', 'trust')),
+        ]
+        self.driver = build_driver(self.policies, cls=JuniperSRXDriver)
+
+    def test_parsers(self):
+        self.assertEqual(pan_traffic_flow(self.PAN_LINE.format(src='10.1.1.1', dst='2.2.2.2', port=443)),
+                         ('trust', 'untrust', '10.1.1.1', '2.2.2.2', 'tcp', 443))
+        self.assertEqual(pan_traffic_flow('Domain,Receive Time,Serial #,Type,Threat/Content Type'), None)
+        flow = ('untrust', 'trust', '10.1.1.1', '2.2.2.2', '6', 22)
+        self.assertEqual(srx_rt_flow(self.SRX_LINE), flow)
+        self.assertEqual(srx_rt_flow(self.SRX_PLAIN_LINE), flow)
+        self.assertEqual(srx_rt_flow('srx sshd: Accepted password'), None)
+
+    def test_hit_counts(self):
+        lines = [self.PAN_LINE.format(src='10.1.1.1', dst='2.2.2.2', port=443)] * 3 + \
+                [self.PAN_LINE.format(src='10.2.1.1', dst='2.2.2.2', port=443), 'garbage']
+        for processes, packed in [(1, False), (2, False), (2, True)]:
+            hits = FlowLogClassifier(self.driver).hit_counts(lines, pan_traffic_flow, processes=processes,
+                                                             chunk_size=2, packed=packed)
+            self.assertEqual(hits.hits, [3, 0, 0])
+            self.assertEqual((hits.unmatched, hits.skipped), (1, 1))
+            self.assertEqual([p.name for p in hits.zero_hit_policies()], ['p1', 'p2'])
+
+
 class TestJuniperSRXModelsToXML(unittest.TestCase):
 
     def setUp(self):